@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any, Generic, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_MISSING: Any = object()
+
+
+class LRUCache(Generic[K, V]):
+    """
+    Bounded in-memory cache evicting the least recently used entries.
+
+    Entries older than `ttl` seconds are considered as misses.
+    It's safe to use from several threads.
+    """
+
+    def __init__(self, *, maxsize: int = 1024, ttl: float | None = None) -> None:
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        with self._lock:
+            value = self._get(key)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def invalidate(self, predicate: Callable[[K], bool]) -> int:
+        """Removes the entries whose key matches the predicate"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _get(self, key: K) -> V:
+        try:
+            created_at, value = self._data[key]
+        except KeyError:
+            return _MISSING
+        if self.ttl is not None and time.monotonic() - created_at > self.ttl:
+            del self._data[key]
+            self.evictions += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
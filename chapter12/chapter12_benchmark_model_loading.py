@@ -0,0 +1,86 @@
+import gc
+import multiprocessing
+import time
+from multiprocessing.connection import Connection
+from multiprocessing.synchronize import Barrier
+
+import joblib
+from sklearn.pipeline import Pipeline
+
+from chapter12.chapter12_prediction_endpoint import MODEL_FILE
+
+MODES = ["default", "mmap", "preload"]
+NUM_WORKERS = 4
+
+
+def read_memory() -> dict[str, int]:
+    """Returns the RSS and PSS of the current process in kB (Linux only)"""
+    memory: dict[str, int] = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, value, *_ = line.split()
+            if key in {"Rss:", "Pss:"}:
+                memory[key[:-1].lower()] = int(value)
+    return memory
+
+
+def worker(
+    mode: str,
+    preloaded_model: tuple[Pipeline, list[str]] | None,
+    barrier: Barrier,
+    connection: Connection,
+):
+    start = time.perf_counter()
+    if preloaded_model is None:
+        model, targets = joblib.load(
+            MODEL_FILE, mmap_mode="r" if mode == "mmap" else None
+        )
+    else:
+        model, targets = preloaded_model
+    model.predict(["computer cpu memory ram"])
+    load_time = time.perf_counter() - start
+
+    # Measure while every worker is alive, so shared pages are split between them
+    barrier.wait()
+    connection.send({"load_time": load_time, **read_memory()})
+    barrier.wait()
+
+
+def benchmark(mode: str, num_workers: int = NUM_WORKERS) -> list[dict[str, float]]:
+    """Forks workers loading the model in the given mode and reports their stats"""
+    context = multiprocessing.get_context("fork")
+    preloaded_model = None
+    if mode == "preload":
+        preloaded_model = joblib.load(MODEL_FILE)
+        gc.freeze()
+
+    barrier = context.Barrier(num_workers)
+    processes = []
+    connections = []
+    for _ in range(num_workers):
+        parent_connection, child_connection = context.Pipe(duplex=False)
+        process = context.Process(
+            target=worker,
+            args=(mode, preloaded_model, barrier, child_connection),
+        )
+        process.start()
+        processes.append(process)
+        connections.append(parent_connection)
+
+    results = [connection.recv() for connection in connections]
+    for process in processes:
+        process.join()
+
+    if mode == "preload":
+        gc.unfreeze()
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{'mode':<10}{'load (ms)':>12}{'RSS (MB)':>12}{'PSS (MB)':>12}")
+    for mode in MODES:
+        results = benchmark(mode)
+        load_time = max(result["load_time"] for result in results) * 1000
+        rss = sum(result["rss"] for result in results) / 1024
+        pss = sum(result["pss"] for result in results) / 1024
+        print(f"{mode:<10}{load_time:>12.1f}{rss:>12.1f}{pss:>12.1f}")
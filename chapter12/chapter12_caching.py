@@ -1,11 +1,17 @@
 import contextlib
+import hashlib
 import os
+import threading
+import time
+from datetime import datetime
 
 import joblib
-from fastapi import Depends, FastAPI, status
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, status
 from pydantic import BaseModel
 from sklearn.pipeline import Pipeline
 
+from chapter12.cache import LRUCache
+
 
 class PredictionInput(BaseModel):
     text: str
@@ -15,35 +21,158 @@ class PredictionOutput(BaseModel):
     category: str
 
 
+class ModelReload(BaseModel):
+    fingerprint: str
+    load_time: float
+    warmup_time: float
+    swap_latency: float
+    invalidated_entries: int
+    reloaded_at: datetime
+
+
+class ModelStatus(BaseModel):
+    fingerprint: str | None
+    reloading: bool
+    last_reload: ModelReload | None
+
+
+DISK_CACHE_BYTES_LIMIT = "100M"
+DISK_CACHE_REDUCE_EVERY = 100
+MODEL_FILE = os.path.join(os.path.dirname(__file__), "newsgroups_model.joblib")
+WARMUP_TEXTS = [
+    "computer cpu memory ram",
+    "encryption key escrow",
+    "god jesus church bible",
+]
+
 memory = joblib.Memory(location="cache.joblib")
+memory_cache: LRUCache[tuple[str, str], int] = LRUCache(maxsize=1024, ttl=3600)
+disk_cache_stats = {"misses": 0, "writes_since_reduce": 0}
 
 
 @memory.cache(ignore=["model"])
-def predict(model: Pipeline, text: str) -> int:
+def predict(model: Pipeline, model_fingerprint: str, text: str) -> int:
+    # Only runs when the disk cache misses
+    disk_cache_stats["misses"] += 1
+    disk_cache_stats["writes_since_reduce"] += 1
     prediction = model.predict([text])
     return prediction[0]
 
 
+def reduce_disk_cache() -> None:
+    """Evicts the oldest disk cache entries beyond the size limit"""
+    memory.reduce_size(bytes_limit=DISK_CACHE_BYTES_LIMIT)
+    disk_cache_stats["writes_since_reduce"] = 0
+
+
+def clear_caches() -> None:
+    memory_cache.clear()
+    memory.clear(warn=False)
+
+
+class LoadedModel:
+    """A model with its targets and version, always swapped as a whole"""
+
+    def __init__(self, model: Pipeline, targets: list[str], fingerprint: str) -> None:
+        self.model = model
+        self.targets = targets
+        self.fingerprint = fingerprint
+
+
 class NewsgroupsModel:
-    model: Pipeline | None = None
-    targets: list[str] | None = None
+    loaded_model: LoadedModel | None = None
+    last_reload: ModelReload | None = None
+
+    def __init__(self, model_file: str = MODEL_FILE) -> None:
+        self.model_file = model_file
+        self._reload_lock = threading.Lock()
 
     def load_model(self) -> None:
         """Loads the model"""
-        model_file = os.path.join(os.path.dirname(__file__), "newsgroups_model.joblib")
-        loaded_model: tuple[Pipeline, list[str]] = joblib.load(model_file)
-        model, targets = loaded_model
-        self.model = model
-        self.targets = targets
+        self.loaded_model = self._load()
+
+    def is_reloading(self) -> bool:
+        return self._reload_lock.locked()
+
+    def begin_reload(self) -> bool:
+        """Reserves the reload, returns `False` if one is already in progress"""
+        return self._reload_lock.acquire(blocking=False)
+
+    def finish_reload(self) -> ModelReload:
+        """Runs the reload reserved with `begin_reload`, possibly in another thread"""
+        try:
+            return self._reload()
+        finally:
+            self._reload_lock.release()
+
+    def reload_model(self) -> ModelReload:
+        """
+        Loads and warms up the model file again, then swaps it in.
+
+        Predictions keep being served by the previous model in the meantime:
+        the swap is a single attribute assignment, so in-flight requests
+        finish with the model they started with.
+        """
+        with self._reload_lock:
+            return self._reload()
+
+    def _reload(self) -> ModelReload:
+        start = time.perf_counter()
+        loaded_model = self._load()
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded_model.model.predict(WARMUP_TEXTS)
+        warmup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        previous_model = self.loaded_model
+        self.loaded_model = loaded_model
+        invalidated_entries = 0
+        if previous_model and previous_model.fingerprint != loaded_model.fingerprint:
+            # Old disk entries are unreachable too and will be evicted by size
+            previous_fingerprint = previous_model.fingerprint
+            invalidated_entries = memory_cache.invalidate(
+                lambda key: key[0] == previous_fingerprint
+            )
+        swap_latency = time.perf_counter() - start
+
+        self.last_reload = ModelReload(
+            fingerprint=loaded_model.fingerprint,
+            load_time=load_time,
+            warmup_time=warmup_time,
+            swap_latency=swap_latency,
+            invalidated_entries=invalidated_entries,
+            reloaded_at=datetime.now(),
+        )
+        return self.last_reload
 
     def predict(self, input: PredictionInput) -> PredictionOutput:
         """Runs a prediction"""
-        if not self.model or not self.targets:
+        # Read once, so a concurrent reload can't mix two models
+        loaded_model = self.loaded_model
+        if loaded_model is None:
             raise RuntimeError("Model is not loaded")
-        prediction = predict(self.model, input.text)
-        category = self.targets[prediction]
+        key = (loaded_model.fingerprint, input.text)
+        prediction = memory_cache.get(key)
+        if prediction is None:
+            prediction = predict(
+                loaded_model.model, loaded_model.fingerprint, input.text
+            )
+            memory_cache.set(key, prediction)
+            if disk_cache_stats["writes_since_reduce"] >= DISK_CACHE_REDUCE_EVERY:
+                reduce_disk_cache()
+        category = loaded_model.targets[prediction]
         return PredictionOutput(category=category)
 
+    def _load(self) -> LoadedModel:
+        with open(self.model_file, "rb") as f:
+            # Part of the cache keys, so a new model never serves stale categories
+            fingerprint = hashlib.sha256(f.read()).hexdigest()
+        loaded_model: tuple[Pipeline, list[str]] = joblib.load(self.model_file)
+        model, targets = loaded_model
+        return LoadedModel(model, targets, fingerprint)
+
 
 newgroups_model = NewsgroupsModel()
 
@@ -51,6 +180,7 @@ newgroups_model = NewsgroupsModel()
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
     newgroups_model.load_model()
+    reduce_disk_cache()
     yield
 
 
@@ -64,6 +194,39 @@ def prediction(
     return output
 
 
+@app.get("/cache/stats")
+def get_cache_stats():
+    memory_stats = memory_cache.stats()
+    return {
+        "memory": memory_stats,
+        "disk": {
+            "hits": memory_stats["misses"] - disk_cache_stats["misses"],
+            "misses": disk_cache_stats["misses"],
+        },
+    }
+
+
+@app.get("/model")
+def get_model() -> ModelStatus:
+    loaded_model = newgroups_model.loaded_model
+    return ModelStatus(
+        fingerprint=loaded_model.fingerprint if loaded_model else None,
+        reloading=newgroups_model.is_reloading(),
+        last_reload=newgroups_model.last_reload,
+    )
+
+
+@app.post("/model/reload", status_code=status.HTTP_202_ACCEPTED)
+def reload_model(background_tasks: BackgroundTasks):
+    # Reserved right away, so concurrent requests can't both start a reload
+    if not newgroups_model.begin_reload():
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The model is already being reloaded.",
+        )
+    background_tasks.add_task(newgroups_model.finish_reload)
+
+
 @app.delete("/cache", status_code=status.HTTP_204_NO_CONTENT)
 def delete_cache():
-    memory.clear()
+    clear_caches()
@@ -1,11 +1,37 @@
+import asyncio
 import contextlib
+import gc
+import json
 import os
+from collections.abc import AsyncGenerator, AsyncIterable
 
 import joblib
-from fastapi import Depends, FastAPI
-from pydantic import BaseModel
+from fastapi import Depends, FastAPI, Query, Request, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from sklearn.pipeline import Pipeline
 
+from chapter12.batching import MicroBatcher
+from chapter12.compiled_model import CompiledPipeline
+from chapter12.executor import InferenceExecutor, InferenceQueueFull
+
+MODEL_NAME = "newsgroups"
+BATCH_MODEL_NAME = "newsgroups-batch"
+PREDICTIONS_CHUNK_SIZE = 256
+# Either a joblib pipeline or a `.npz` artifact from `chapter12.compiled_export`
+MODEL_FILE = os.environ.get(
+    "NEWSGROUPS_MODEL_FILE",
+    os.path.join(os.path.dirname(__file__), "newsgroups_model.joblib"),
+)
+
+# How workers get the model:
+# * "default": each worker loads its own copy in the lifespan
+# * "mmap": the naive Bayes arrays are memory-mapped from the file, so the OS page
+#   cache is shared. The TF-IDF weights, stored as a sparse matrix, and its
+#   vocabulary dict, most of the model, aren't: each worker has its own copy.
+# * "preload": loaded at import, so `gunicorn --preload` shares it copy-on-write
+MODEL_LOAD_MODE = os.environ.get("NEWSGROUPS_MODEL_LOAD_MODE", "default")
+
 
 class PredictionInput(BaseModel):
     text: str
@@ -15,41 +41,188 @@ class PredictionOutput(BaseModel):
     category: str
 
 
+inference_executor = InferenceExecutor(max_workers=2)
+inference_executor.register(MODEL_NAME, max_concurrency=2, max_queue_size=16)
+# Bulk jobs get their own slot so they don't starve the interactive endpoint
+inference_executor.register(BATCH_MODEL_NAME, max_concurrency=1, max_queue_size=4)
+
+
 class NewsgroupsModel:
-    model: Pipeline | None = None
+    model: Pipeline | CompiledPipeline | None = None
     targets: list[str] | None = None
 
+    def __init__(
+        self,
+        *,
+        model_file: str = MODEL_FILE,
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+        mmap_mode: str | None = None,
+    ) -> None:
+        self.model_file = model_file
+        self.mmap_mode = mmap_mode
+        self.batcher: MicroBatcher[str, int] = MicroBatcher(
+            self._run_batch, max_batch_size=max_batch_size, max_wait=max_wait
+        )
+
     def load_model(self) -> None:
         """Loads the model"""
-        model_file = os.path.join(os.path.dirname(__file__), "newsgroups_model.joblib")
-        loaded_model: tuple[Pipeline, list[str]] = joblib.load(model_file)
+        if self.model_file.endswith(".npz"):
+            self.model, self.targets = CompiledPipeline.load(self.model_file)
+            return
+        loaded_model: tuple[Pipeline, list[str]] = joblib.load(
+            self.model_file, mmap_mode=self.mmap_mode
+        )
         model, targets = loaded_model
         self.model = model
         self.targets = targets
 
+    def predict_batch(self, texts: list[str]) -> list[int]:
+        """Runs a single vectorized prediction over several texts"""
+        if not self.model:
+            raise RuntimeError("Model is not loaded")
+        return self.model.predict(texts).tolist()
+
+    async def _run_batch(self, texts: list[str]) -> list[int]:
+        return await inference_executor.run(MODEL_NAME, self.predict_batch, texts)
+
     async def predict(self, input: PredictionInput) -> PredictionOutput:
         """Runs a prediction"""
         if not self.model or not self.targets:
             raise RuntimeError("Model is not loaded")
-        prediction = self.model.predict([input.text])
-        category = self.targets[prediction[0]]
+        prediction = await self.batcher.submit(input.text)
+        category = self.targets[prediction]
         return PredictionOutput(category=category)
 
-
-newgroups_model = NewsgroupsModel()
+    async def predict_chunk(
+        self, inputs: list[PredictionInput]
+    ) -> list[PredictionOutput]:
+        """Runs a prediction over a chunk of a bulk job"""
+        if not self.model or not self.targets:
+            raise RuntimeError("Model is not loaded")
+        texts = [input.text for input in inputs]
+        while True:
+            try:
+                predictions = await inference_executor.run(
+                    BATCH_MODEL_NAME, self.predict_batch, texts
+                )
+                break
+            except InferenceQueueFull:
+                # Bulk jobs favor throughput: wait for a free slot instead of failing
+                await asyncio.sleep(0.1)
+        return [
+            PredictionOutput(category=self.targets[prediction])
+            for prediction in predictions
+        ]
+
+
+newgroups_model = NewsgroupsModel(mmap_mode="r" if MODEL_LOAD_MODE == "mmap" else None)
+if MODEL_LOAD_MODE == "preload":
+    newgroups_model.load_model()
+    # Keep the garbage collector from writing to the shared pages after fork
+    gc.freeze()
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
-    newgroups_model.load_model()
+    inference_executor.start()
+    if newgroups_model.model is None:
+        newgroups_model.load_model()
+    await newgroups_model.batcher.start()
     yield
+    await newgroups_model.batcher.stop()
+    inference_executor.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+@app.exception_handler(InferenceQueueFull)
+async def inference_queue_full_handler(request: Request, exc: InferenceQueueFull):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"},
+    )
+
+
 @app.post("/prediction")
 async def prediction(
     output: PredictionOutput = Depends(newgroups_model.predict),
 ) -> PredictionOutput:
     return output
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+    """
+    Streams the response while the request body is still being read.
+
+    Starlette's `StreamingResponse` listens for the client disconnection
+    during the whole response, which would swallow the request body messages.
+    """
+
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def iter_ndjson(stream: AsyncIterable[bytes]) -> AsyncGenerator[bytes, None]:
+    """Splits a byte stream into non-empty lines"""
+    buffer = b""
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def predict_ndjson_chunk(
+    chunk: list[PredictionInput | ValidationError],
+) -> list[str]:
+    inputs = [item for item in chunk if isinstance(item, PredictionInput)]
+    outputs = iter(await newgroups_model.predict_chunk(inputs) if inputs else [])
+    # Invalid lines are reported in place so the output stays aligned on the input
+    return [
+        json.dumps({"error": str(item)}) + "\n"
+        if isinstance(item, ValidationError)
+        else next(outputs).json() + "\n"
+        for item in chunk
+    ]
+
+
+async def predict_ndjson(
+    lines: AsyncIterable[bytes], chunk_size: int
+) -> AsyncGenerator[str, None]:
+    chunk: list[PredictionInput | ValidationError] = []
+    async for line in lines:
+        try:
+            chunk.append(PredictionInput.parse_raw(line))
+        except ValidationError as e:
+            chunk.append(e)
+        if len(chunk) >= chunk_size:
+            yield "".join(await predict_ndjson_chunk(chunk))
+            chunk = []
+    if chunk:
+        yield "".join(await predict_ndjson_chunk(chunk))
+
+
+@app.post("/predictions", response_class=NDJSONStreamingResponse)
+async def predictions(
+    request: Request,
+    chunk_size: int = Query(PREDICTIONS_CHUNK_SIZE, gt=0, le=10_000),
+) -> NDJSONStreamingResponse:
+    """
+    Runs predictions on a NDJSON body with one `PredictionInput` per line.
+
+    Results are streamed back in the same order as NDJSON `PredictionOutput`,
+    chunk by chunk, so memory stays constant whatever the input size.
+    """
+    return NDJSONStreamingResponse(
+        predict_ndjson(iter_ndjson(request.stream()), chunk_size)
+    )
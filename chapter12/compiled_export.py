@@ -0,0 +1,67 @@
+import os
+from os import PathLike
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.pipeline import Pipeline
+
+from chapter12.compiled_model import ARTIFACT_VERSION
+
+
+def check_pipeline(pipeline: Pipeline) -> tuple[TfidfVectorizer, MultinomialNB]:
+    """Checks that the pipeline only uses features the compiled scorer reproduces"""
+    steps = [step for _, step in pipeline.steps]
+    if (
+        len(steps) != 2
+        or not isinstance(steps[0], TfidfVectorizer)
+        or not isinstance(steps[1], MultinomialNB)
+    ):
+        raise ValueError("Only TfidfVectorizer + MultinomialNB pipelines are supported")
+    vectorizer, classifier = steps
+    supported_params = {
+        "input": "content",
+        "analyzer": "word",
+        "preprocessor": None,
+        "tokenizer": None,
+        "strip_accents": None,
+        "ngram_range": (1, 1),
+        "binary": False,
+        "use_idf": True,
+        "sublinear_tf": False,
+        "norm": "l2",
+    }
+    for name, supported_value in supported_params.items():
+        if getattr(vectorizer, name) != supported_value:
+            raise ValueError(f"Unsupported TfidfVectorizer parameter {name}")
+    return vectorizer, classifier
+
+
+def export_pipeline(
+    pipeline: Pipeline, targets: list[str], file: str | PathLike
+) -> None:
+    """Exports a fitted pipeline to a compiled NumPy artifact"""
+    vectorizer, classifier = check_pipeline(pipeline)
+    vocabulary: dict[str, int] = vectorizer.vocabulary_
+    terms = sorted(vocabulary, key=vocabulary.__getitem__)
+    np.savez(
+        file,
+        version=np.array(ARTIFACT_VERSION),
+        # Tokens never contain new lines, so they can be packed in one buffer
+        terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+        lowercase=np.array(vectorizer.lowercase),
+        token_pattern=np.array(vectorizer.token_pattern),
+        idf=vectorizer.idf_,
+        feature_log_prob=classifier.feature_log_prob_,
+        class_log_prior=classifier.class_log_prior_,
+        classes=classifier.classes_,
+        targets=np.array(targets),
+    )
+
+
+if __name__ == "__main__":
+    model_file = os.path.join(os.path.dirname(__file__), "newsgroups_model.joblib")
+    loaded_model: tuple[Pipeline, list[str]] = joblib.load(model_file)
+    model, targets = loaded_model
+    export_pipeline(model, targets, model_file.replace(".joblib", ".npz"))
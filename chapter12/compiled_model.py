@@ -0,0 +1,93 @@
+import re
+from collections import Counter
+from os import PathLike
+
+import numpy as np
+from scipy import sparse
+from scipy.special import logsumexp
+
+ARTIFACT_VERSION = 1
+
+
+class CompiledPipeline:
+    """
+    NumPy/SciPy-only scorer reproducing the `predict` and `predict_proba`
+    of a TfidfVectorizer + MultinomialNB pipeline, without sklearn validation.
+
+    It doesn't import sklearn at all: artifacts are created with
+    `chapter12.compiled_export`.
+    """
+
+    def __init__(
+        self,
+        *,
+        vocabulary: dict[str, int],
+        lowercase: bool,
+        token_pattern: str,
+        idf: np.ndarray,
+        feature_log_prob: np.ndarray,
+        class_log_prior: np.ndarray,
+        classes: np.ndarray,
+    ) -> None:
+        self.vocabulary = vocabulary
+        self.lowercase = lowercase
+        self.token_pattern = re.compile(token_pattern)
+        self.idf = idf
+        self.feature_log_prob_t = np.ascontiguousarray(feature_log_prob.T)
+        self.class_log_prior = class_log_prior
+        self.classes = classes
+
+    @classmethod
+    def load(cls, file: str | PathLike) -> tuple["CompiledPipeline", list[str]]:
+        """Loads a compiled artifact and its target names"""
+        with np.load(file, allow_pickle=False) as artifact:
+            if artifact["version"] != ARTIFACT_VERSION:
+                raise ValueError("Unsupported artifact version")
+            terms = artifact["terms"].tobytes().decode("utf-8").split("\n")
+            pipeline = cls(
+                vocabulary={term: i for i, term in enumerate(terms)},
+                lowercase=bool(artifact["lowercase"]),
+                token_pattern=str(artifact["token_pattern"]),
+                idf=artifact["idf"],
+                feature_log_prob=artifact["feature_log_prob"],
+                class_log_prior=artifact["class_log_prior"],
+                classes=artifact["classes"],
+            )
+            targets = artifact["targets"].tolist()
+        return pipeline, targets
+
+    def transform(self, texts: list[str]) -> sparse.csr_matrix:
+        """Computes the L2-normalized TF-IDF matrix"""
+        indptr = [0]
+        indices: list[int] = []
+        counts: list[int] = []
+        for text in texts:
+            if self.lowercase:
+                text = text.lower()
+            tokens = Counter(
+                index
+                for token in self.token_pattern.findall(text)
+                if (index := self.vocabulary.get(token)) is not None
+            )
+            indices.extend(tokens.keys())
+            counts.extend(tokens.values())
+            indptr.append(len(indices))
+
+        indices_array = np.array(indices, dtype=np.int32)
+        data = np.array(counts, dtype=np.float64) * self.idf[indices_array]
+        rows = np.repeat(np.arange(len(texts)), np.diff(indptr))
+        norms = np.sqrt(np.bincount(rows, weights=data**2, minlength=len(texts)))
+        data /= norms[rows]
+        return sparse.csr_matrix(
+            (data, indices_array, indptr), shape=(len(texts), len(self.idf))
+        )
+
+    def joint_log_likelihood(self, texts: list[str]) -> np.ndarray:
+        return self.transform(texts) @ self.feature_log_prob_t + self.class_log_prior
+
+    def predict(self, texts: list[str]) -> np.ndarray:
+        return self.classes[np.argmax(self.joint_log_likelihood(texts), axis=1)]
+
+    def predict_proba(self, texts: list[str]) -> np.ndarray:
+        jll = self.joint_log_likelihood(texts)
+        return np.exp(jll - logsumexp(jll, axis=1, keepdims=True))
@@ -0,0 +1,95 @@
+import asyncio
+import functools
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import ParamSpec, TypeVar
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+class InferenceQueueFull(Exception):
+    """Raised when too many calls are already waiting for a model"""
+
+    def __init__(self, model_name: str) -> None:
+        super().__init__(f"Too many pending inferences for {model_name}")
+        self.model_name = model_name
+
+
+class ModelSlot:
+    def __init__(self, max_concurrency: int, max_queue_size: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.pending = 0
+
+
+class InferenceExecutor:
+    """
+    Runs blocking model inference in a bounded thread pool,
+    so the event loop stays free to serve other requests.
+
+    Each model is registered with its own concurrency cap and queue depth:
+    calls exceeding the queue depth fail fast with `InferenceQueueFull`
+    instead of piling up.
+    """
+
+    def __init__(self, *, max_workers: int = 4) -> None:
+        self.max_workers = max_workers
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots: dict[str, ModelSlot] = {}
+
+    def register(
+        self, model_name: str, *, max_concurrency: int = 1, max_queue_size: int = 32
+    ) -> None:
+        """Declares a model and its limits"""
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if max_queue_size < max_concurrency:
+            raise ValueError("max_queue_size must be at least max_concurrency")
+        self._slots[model_name] = ModelSlot(max_concurrency, max_queue_size)
+
+    def start(self) -> None:
+        """Starts the thread pool"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="inference"
+            )
+
+    def shutdown(self) -> None:
+        """Waits for the running inferences and stops the thread pool"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def pending(self, model_name: str) -> int:
+        """Number of calls waiting or running for a model"""
+        return self._slots[model_name].pending
+
+    async def run(
+        self,
+        model_name: str,
+        function: Callable[P, R],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ) -> R:
+        """Runs `function` in the thread pool within the model limits"""
+        if self._executor is None:
+            raise RuntimeError("Executor is not started")
+        try:
+            slot = self._slots[model_name]
+        except KeyError as e:
+            raise KeyError(f"Model {model_name} is not registered") from e
+
+        if slot.pending >= slot.max_queue_size:
+            raise InferenceQueueFull(model_name)
+
+        slot.pending += 1
+        try:
+            async with slot.semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, functools.partial(function, *args, **kwargs)
+                )
+        finally:
+            slot.pending -= 1
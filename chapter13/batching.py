@@ -0,0 +1,141 @@
+import asyncio
+import contextlib
+from collections.abc import Awaitable, Callable, Sequence
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Coalesces concurrent calls into a single vectorized call.
+
+    Items submitted while a batch is being collected are grouped together
+    until either `max_batch_size` items are waiting or `max_wait` seconds
+    have passed since the first one arrived. Each batch is processed in
+    its own task, so the next one can be collected in the meantime.
+
+    With `max_concurrency`, no new batch is collected while that many are
+    running: items keep piling up instead, so batches grow with the load.
+
+    The batch function can return an exception in place of a result:
+    it only fails the call of this item, not the whole batch.
+    """
+
+    def __init__(
+        self,
+        batch_function: Callable[[list[T]], Awaitable[Sequence[R | Exception]]],
+        *,
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+        max_concurrency: int | None = None,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_wait < 0:
+            raise ValueError("max_wait must be positive")
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self._semaphore: asyncio.Semaphore | None = None
+        self._queue: asyncio.Queue[tuple[T, asyncio.Future[R]]] | None = None
+        self._task: asyncio.Task | None = None
+        self._batch_tasks: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        """Starts the background task collecting the batches"""
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        if self.max_concurrency is not None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops collecting batches and waits for the running ones"""
+        if self._task is None or self._queue is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            self._fail_stopped(future)
+        self._task = None
+        self._queue = None
+
+    async def submit(self, item: T) -> R:
+        """Queues an item and waits for its result"""
+        if self._queue is None:
+            raise RuntimeError("Batcher is not started")
+        future: asyncio.Future[R] = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _collect(self) -> list[tuple[T, asyncio.Future[R]]]:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        try:
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            for _, future in batch:
+                self._fail_stopped(future)
+            raise
+        return batch
+
+    def _fail_stopped(self, future: asyncio.Future[R]) -> None:
+        if not future.done():
+            future.set_exception(RuntimeError("Batcher is stopped"))
+
+    async def _run(self) -> None:
+        while True:
+            if self._semaphore is not None:
+                await self._semaphore.acquire()
+            batch = await self._collect()
+            # Callers may have given up while we were waiting
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                self._release()
+                continue
+            task = asyncio.create_task(self._process(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _process(self, batch: list[tuple[T, asyncio.Future[R]]]) -> None:
+        try:
+            results = await self.batch_function([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._release()
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _release(self) -> None:
+        if self._semaphore is not None:
+            self._semaphore.release()
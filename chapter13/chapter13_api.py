@@ -1,11 +1,26 @@
+import asyncio
 import contextlib
+import json
+from collections.abc import AsyncGenerator
+from typing import BinaryIO
 
 import torch
-from fastapi import FastAPI, File, UploadFile
-from PIL import Image
+from fastapi import FastAPI, File, Query, Request, UploadFile, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image, UnidentifiedImageError
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from transformers import YolosForObjectDetection, YolosImageProcessor
 
+from chapter13.executor import InferenceExecutor, InferenceQueueFull
+from chapter13.postprocessing import get_labels, post_process
+from chapter13.preprocessing import FramePreprocessor
+from chapter13.runtime import RuntimeSettings, configure_threads, optimize_model
+
+MODEL_NAME = "object-detection"
+BATCH_SIZE = 8
+MAX_BATCH_SIZE = 32
+
 
 class Object(BaseModel):
     box: tuple[float, float, float, float]
@@ -18,49 +33,162 @@ class Objects(BaseModel):
 
 class ObjectDetection:
     image_processor: YolosImageProcessor | None = None
+    frame_preprocessor: FramePreprocessor | None = None
     model: YolosForObjectDetection | None = None
 
+    def __init__(self, settings: RuntimeSettings | None = None) -> None:
+        self.settings = settings or RuntimeSettings()
+
     def load_model(self) -> None:
         """Loads the model"""
+        configure_threads(self.settings)
         self.image_processor = YolosImageProcessor.from_pretrained("hustvl/yolos-tiny")
-        self.model = YolosForObjectDetection.from_pretrained("hustvl/yolos-tiny")
+        self.frame_preprocessor = FramePreprocessor(self.image_processor)
+        self.model = optimize_model(
+            YolosForObjectDetection.from_pretrained("hustvl/yolos-tiny"), self.settings
+        )
 
     def predict(self, image: Image.Image) -> Objects:
         """Runs a prediction"""
-        if not self.image_processor or not self.model:
+        if not self.frame_preprocessor:
             raise RuntimeError("Model is not loaded")
-        inputs = self.image_processor(images=image, return_tensors="pt")
-        outputs = self.model(**inputs)
+        pixel_values, original_sizes = self.frame_preprocessor([image])
+        return self._predict(pixel_values, original_sizes)[0]
 
-        target_sizes = torch.tensor([image.size[::-1]])
-        results = self.image_processor.post_process_object_detection(
-            outputs, threshold=0.7, target_sizes=target_sizes
-        )[0]
+    def decode(self, file: BinaryIO) -> tuple[Image.Image, tuple[int, int]]:
+        """Decodes an image file at the model input size, with its original size"""
+        if not self.frame_preprocessor:
+            raise RuntimeError("Model is not loaded")
+        image = Image.open(file)
+        original_size = image.size
+        return self.frame_preprocessor.decode(image), original_size
+
+    def predict_decoded(
+        self, images: list[Image.Image], original_sizes: list[tuple[int, int]]
+    ) -> list[Objects]:
+        """Runs a single forward pass over images returned by `decode`"""
+        if not self.frame_preprocessor:
+            raise RuntimeError("Model is not loaded")
+        pixel_values = self.frame_preprocessor.to_tensor(images)
+        return self._predict(pixel_values, original_sizes)
 
-        objects: list[Object] = []
-        for score, label, box in zip(
-            results["scores"], results["labels"], results["boxes"]
-        ):
-            if score > 0.7:
-                box_values = box.tolist()
-                label = self.model.config.id2label[label.item()]
-                objects.append(Object(box=box_values, label=label))
-        return Objects(objects=objects)
+    def _predict(
+        self, pixel_values: torch.Tensor, original_sizes: list[tuple[int, int]]
+    ) -> list[Objects]:
+        if not self.model:
+            raise RuntimeError("Model is not loaded")
+        with torch.inference_mode():
+            outputs = self.model(pixel_values=pixel_values)
+            batch_detections = post_process(
+                outputs.logits, outputs.pred_boxes, original_sizes, threshold=0.7
+            )
+
+        labels = get_labels(self.model.config)
+        return [
+            Objects(objects=detections.to_objects(labels))
+            for detections in batch_detections
+        ]
 
 
 object_detection = ObjectDetection()
+inference_executor = InferenceExecutor(max_workers=1)
+inference_executor.register(MODEL_NAME, max_concurrency=1, max_queue_size=8)
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
+    inference_executor.start()
     object_detection.load_model()
     yield
+    inference_executor.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+@app.exception_handler(InferenceQueueFull)
+async def inference_queue_full_handler(request: Request, exc: InferenceQueueFull):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "1"},
+    )
+
+
 @app.post("/object-detection", response_model=Objects)
 async def post_object_detection(image: UploadFile = File(...)) -> Objects:
     image_object = Image.open(image.file)
-    return object_detection.predict(image_object)
+    return await inference_executor.run(
+        MODEL_NAME, object_detection.predict, image_object
+    )
+
+
+async def decode_batch(
+    images: list[UploadFile],
+) -> list[tuple[Image.Image, tuple[int, int]] | Exception]:
+    """Decodes the uploaded images concurrently in the thread pool"""
+
+    async def decode(image: UploadFile):
+        try:
+            return await run_in_threadpool(object_detection.decode, image.file)
+        except (UnidentifiedImageError, OSError):
+            return ValueError("Invalid image file")
+
+    return await asyncio.gather(*(decode(image) for image in images))
+
+
+async def predict_decoded(
+    decoded_images: list[tuple[Image.Image, tuple[int, int]]]
+) -> list[Objects]:
+    images = [image for image, _ in decoded_images]
+    original_sizes = [original_size for _, original_size in decoded_images]
+    while True:
+        try:
+            return await inference_executor.run(
+                MODEL_NAME, object_detection.predict_decoded, images, original_sizes
+            )
+        except InferenceQueueFull:
+            # The response has started: wait for a free slot instead of failing
+            await asyncio.sleep(0.1)
+
+
+async def detect_batches(
+    images: list[UploadFile], batch_size: int
+) -> AsyncGenerator[str, None]:
+    batches = [images[i : i + batch_size] for i in range(0, len(images), batch_size)]
+    # Decode the next batch while the model runs on the current one
+    decoding = asyncio.ensure_future(decode_batch(batches[0]))
+    try:
+        for i, batch in enumerate(batches):
+            decoded_batch = await decoding
+            if i + 1 < len(batches):
+                decoding = asyncio.ensure_future(decode_batch(batches[i + 1]))
+
+            valid = [item for item in decoded_batch if not isinstance(item, Exception)]
+            outputs = iter(await predict_decoded(valid) if valid else [])
+            # Invalid images are reported in place to keep the upload order
+            for image, item in zip(batch, decoded_batch):
+                if isinstance(item, Exception):
+                    result = {"filename": image.filename, "error": str(item)}
+                else:
+                    result = {"filename": image.filename, **next(outputs).dict()}
+                yield json.dumps(result) + "\n"
+    finally:
+        decoding.cancel()
+
+
+@app.post("/object-detection/batch", response_class=StreamingResponse)
+async def post_object_detection_batch(
+    images: list[UploadFile] = File(...),
+    batch_size: int = Query(BATCH_SIZE, gt=0, le=MAX_BATCH_SIZE),
+) -> StreamingResponse:
+    """
+    Runs object detection on several images, `batch_size` images per forward pass.
+
+    Results are streamed back as NDJSON, one line per image in the upload order.
+    Uploads are spooled to disk beyond 1 MB and only one batch ahead
+    is decoded at a time, so memory stays bounded whatever the number of images.
+    """
+    return StreamingResponse(
+        detect_batches(images, batch_size), media_type="application/x-ndjson"
+    )
@@ -0,0 +1,100 @@
+import statistics
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+from chapter13.chapter13_api import ObjectDetection, Objects
+from chapter13.runtime import RuntimeSettings
+
+CONFIGURATIONS = {
+    "default": RuntimeSettings(),
+    "1-thread": RuntimeSettings(num_threads=1),
+    "quantized": RuntimeSettings(quantize=True),
+    "quantized-1-thread": RuntimeSettings(quantize=True, num_threads=1),
+}
+
+
+def load_object_detection(settings: RuntimeSettings) -> ObjectDetection:
+    object_detection = ObjectDetection(settings)
+    object_detection.load_model()
+    return object_detection
+
+
+def box_iou(
+    a: tuple[float, float, float, float], b: tuple[float, float, float, float]
+) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1])
+    return intersection / (union - intersection)
+
+
+def agreement(reference: Objects, candidate: Objects, iou_threshold=0.5) -> float:
+    """Ratio of reference objects found with the same label in the candidate"""
+    if not reference.objects:
+        return 1.0 if not candidate.objects else 0.0
+    matched = 0
+    for reference_object in reference.objects:
+        if any(
+            candidate_object.label == reference_object.label
+            and box_iou(candidate_object.box, reference_object.box) >= iou_threshold
+            for candidate_object in candidate.objects
+        ):
+            matched += 1
+    return matched / len(reference.objects)
+
+
+def benchmark(
+    load: Callable[[RuntimeSettings], ObjectDetection],
+    image: Image.Image,
+    *,
+    configurations: dict[str, RuntimeSettings] = CONFIGURATIONS,
+    runs: int = 20,
+) -> dict[str, dict[str, float]]:
+    """
+    Measures the latency of each configuration and its agreement
+    with the detections of the first one.
+    """
+    results: dict[str, dict[str, float]] = {}
+    reference: Objects | None = None
+    default_num_threads = torch.get_num_threads()
+    for name, settings in configurations.items():
+        # Thread settings are global: don't leak them to the next configuration
+        torch.set_num_threads(default_num_threads)
+        object_detection = load(settings)
+        objects = object_detection.predict(image)  # Warm-up
+        if reference is None:
+            reference = objects
+
+        latencies: list[float] = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            object_detection.predict(image)
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies.sort()
+
+        results[name] = {
+            "mean_ms": statistics.mean(latencies),
+            "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+            "agreement": agreement(reference, objects),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    picture_path = Path(__file__).parent.parent / "assets" / "coffee-shop.jpg"
+    image = Image.open(picture_path)
+    image.load()
+    results = benchmark(load_object_detection, image)
+    print(f"{'configuration':<20}{'mean (ms)':>12}{'p95 (ms)':>12}{'agreement':>12}")
+    for name, result in results.items():
+        print(
+            f"{name:<20}{result['mean_ms']:>12.1f}{result['p95_ms']:>12.1f}"
+            f"{result['agreement']:>12.0%}"
+        )
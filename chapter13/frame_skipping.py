@@ -0,0 +1,90 @@
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+
+class FrameChangeDetector:
+    """
+    Tells whether a frame changed enough since the last analyzed one
+    to be worth running the detection model again.
+
+    Frames are compared as tiny grayscale thumbnails: JPEG frames are decoded
+    directly at a reduced scale, so this is much cheaper than a forward pass.
+    Frames are always analyzed after `refresh_interval` seconds, so slow
+    changes staying below the threshold are eventually picked up.
+    """
+
+    def __init__(
+        self,
+        *,
+        threshold: float = 4.0,
+        refresh_interval: float = 1.0,
+        size: tuple[int, int] = (32, 24),
+    ) -> None:
+        self.threshold = threshold
+        self.refresh_interval = refresh_interval
+        self.size = size
+        self._reference: np.ndarray | None = None
+        self._reference_time = 0.0
+
+    def thumbnail(self, data: bytes) -> np.ndarray:
+        """Downscaled luminance of an encoded frame"""
+        image = Image.open(io.BytesIO(data))
+        image.draft("L", self.size)
+        image = image.convert("L").resize(self.size, resample=Image.BILINEAR)
+        return np.asarray(image, dtype=np.int16)
+
+    def difference(self, thumbnail: np.ndarray) -> float:
+        """Mean absolute luminance difference with the reference frame, from 0 to 255"""
+        if self._reference is None or self._reference.shape != thumbnail.shape:
+            return float("inf")
+        return float(np.abs(thumbnail - self._reference).mean())
+
+    def should_detect(self, data: bytes) -> bool:
+        """Whether to analyze this frame; if so, it becomes the new reference"""
+        thumbnail = self.thumbnail(data)
+        now = time.monotonic()
+        if (
+            now - self._reference_time < self.refresh_interval
+            and self.difference(thumbnail) <= self.threshold
+        ):
+            return False
+        self._reference = thumbnail
+        self._reference_time = now
+        return True
+
+    def reset(self) -> None:
+        """Forces the next frame to be analyzed"""
+        self._reference = None
+
+
+class FrameSkippingStats:
+    """Counts skipped frames and estimates the inference time they saved"""
+
+    def __init__(self) -> None:
+        self.detected = 0
+        self.skipped = 0
+        self.inference_time = 0.0
+
+    def record_detection(self, duration: float) -> None:
+        self.detected += 1
+        self.inference_time += duration
+
+    def record_skip(self) -> None:
+        self.skipped += 1
+
+    def stats(self) -> dict[str, float]:
+        frames = self.detected + self.skipped
+        average_inference_time = (
+            self.inference_time / self.detected if self.detected else 0.0
+        )
+        return {
+            "frames": frames,
+            "detected": self.detected,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / frames if frames else 0.0,
+            "average_inference_time": average_inference_time,
+            "saved_inference_time": self.skipped * average_inference_time,
+        }
@@ -0,0 +1,88 @@
+import struct
+
+import numpy as np
+import torch
+from transformers import PretrainedConfig
+
+# Binary result frame: number of objects, FPS and credits, followed by
+# the boxes as float32 (x0, y0, x1, y1) and the label ids as uint16.
+HEADER = struct.Struct("<IfI")
+
+
+class Detections:
+    """Boxes, in original image coordinates, and label ids of the objects detected in an image"""
+
+    def __init__(self, boxes: np.ndarray, label_ids: np.ndarray) -> None:
+        self.boxes = boxes.astype("<f4", copy=False)
+        self.label_ids = label_ids.astype("<u2", copy=False)
+
+    def __len__(self) -> int:
+        return len(self.label_ids)
+
+    def to_objects(self, labels: list[str]) -> list[dict]:
+        """Returns the objects as `{"box": ..., "label": ...}` dictionaries"""
+        return [
+            {"box": box, "label": labels[label_id]}
+            for box, label_id in zip(self.boxes.tolist(), self.label_ids.tolist())
+        ]
+
+    def to_bytes(self, *, credits: int, fps: float) -> bytes:
+        """Packs the detections into a binary result frame"""
+        return (
+            HEADER.pack(len(self), fps, credits)
+            + self.boxes.tobytes()
+            + self.label_ids.tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> tuple["Detections", int, float]:
+        """Unpacks a binary result frame into the detections, credits and FPS"""
+        num_objects, fps, credits = HEADER.unpack_from(data)
+        boxes = np.frombuffer(
+            data, dtype="<f4", count=num_objects * 4, offset=HEADER.size
+        ).reshape(num_objects, 4)
+        label_ids = np.frombuffer(
+            data, dtype="<u2", count=num_objects, offset=HEADER.size + boxes.nbytes
+        )
+        return cls(boxes, label_ids), credits, fps
+
+
+def get_labels(config: PretrainedConfig) -> list[str]:
+    """Label table indexed by label id"""
+    return [config.id2label.get(i, "N/A") for i in range(config.num_labels)]
+
+
+def post_process(
+    logits: torch.Tensor,
+    pred_boxes: torch.Tensor,
+    original_sizes: list[tuple[int, int]],
+    threshold: float,
+) -> list[Detections]:
+    """
+    Same as `YolosImageProcessor.post_process_object_detection`,
+    but thresholds the whole batch at once with a mask.
+    """
+    # The last class is "no object"
+    scores, label_ids = logits.softmax(-1)[..., :-1].max(-1)
+
+    center_x, center_y, width, height = pred_boxes.unbind(-1)
+    boxes = torch.stack(
+        [
+            center_x - 0.5 * width,
+            center_y - 0.5 * height,
+            center_x + 0.5 * width,
+            center_y + 0.5 * height,
+        ],
+        dim=-1,
+    )
+    # Boxes are relative: scale them to the original size of each image
+    scale = torch.tensor(
+        [[w, h, w, h] for w, h in original_sizes], dtype=boxes.dtype
+    ).unsqueeze(1)
+    boxes = boxes * scale
+
+    mask = scores > threshold
+    return [
+        Detections(boxes[i][mask[i]].numpy(), label_ids[i][mask[i]].numpy())
+        for i in range(len(original_sizes))
+    ]
@@ -0,0 +1,86 @@
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import YolosImageProcessor
+from transformers.models.yolos.image_processing_yolos import (
+    get_size_with_aspect_ratio,
+)
+
+
+class FramePreprocessor:
+    """
+    Decodes and normalizes images for YOLOS, like `YolosImageProcessor` does.
+
+    Images should be passed right after `Image.open`, before they are loaded:
+    JPEG images are then decoded directly at a reduced scale thanks to PIL
+    draft mode, which is much faster and lighter than decoding the full image.
+    Pixel values are normalized in place in a tensor reused across calls.
+    """
+
+    def __init__(self, image_processor: YolosImageProcessor) -> None:
+        self.shortest_edge: int = image_processor.size["shortest_edge"]
+        self.longest_edge: int | None = image_processor.size.get("longest_edge")
+        self.resample = image_processor.resample
+        std = torch.tensor(image_processor.image_std).view(3, 1, 1)
+        mean = torch.tensor(image_processor.image_mean).view(3, 1, 1)
+        # (x * rescale_factor - mean) / std == x * scale - offset
+        self.scale = image_processor.rescale_factor / std
+        self.offset = mean / std
+        self._local = threading.local()
+
+    def output_size(self, size: tuple[int, int]) -> tuple[int, int]:
+        """Width and height of an image of this size once resized for the model"""
+        width, height = size
+        output_height, output_width = get_size_with_aspect_ratio(
+            (height, width), self.shortest_edge, self.longest_edge
+        )
+        return output_width, output_height
+
+    def __call__(
+        self, images: list[Image.Image]
+    ) -> tuple[torch.Tensor, list[tuple[int, int]]]:
+        """
+        Returns the pixel values of the images, padded to the same size,
+        and their original sizes to map the boxes back.
+
+        The pixel values tensor is overwritten by the next call from the same thread.
+        """
+        original_sizes = [image.size for image in images]
+        return self.to_tensor([self.decode(image) for image in images]), original_sizes
+
+    def decode(self, image: Image.Image) -> Image.Image:
+        """Decodes an RGB image at the model input size"""
+        output_size = self.output_size(image.size)
+        # No-op if the image is not a JPEG or is already loaded
+        image.draft("RGB", output_size)
+        image = image.convert("RGB")
+        if image.size != output_size:
+            image = image.resize(output_size, resample=self.resample)
+        return image
+
+    def to_tensor(self, images: list[Image.Image]) -> torch.Tensor:
+        """
+        Returns the normalized pixel values of decoded images, padded to the same size.
+
+        The pixel values tensor is overwritten by the next call from the same thread.
+        """
+        max_width = max(image.width for image in images)
+        max_height = max(image.height for image in images)
+        pixel_values = self._get_buffer((len(images), 3, max_height, max_width))
+        if any(image.size != (max_width, max_height) for image in images):
+            pixel_values.zero_()
+        for i, image in enumerate(images):
+            width, height = image.size
+            values = pixel_values[i, :, :height, :width]
+            values.copy_(torch.from_numpy(np.array(image)).permute(2, 0, 1))
+            values.mul_(self.scale).sub_(self.offset)
+        return pixel_values
+
+    def _get_buffer(self, shape: tuple[int, int, int, int]) -> torch.Tensor:
+        buffer: torch.Tensor | None = getattr(self._local, "buffer", None)
+        if buffer is None or buffer.shape != shape:
+            buffer = torch.empty(shape, dtype=torch.float32)
+            self._local.buffer = buffer
+        return buffer
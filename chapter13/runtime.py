@@ -0,0 +1,44 @@
+import warnings
+
+import torch
+from pydantic import BaseSettings, Field
+
+
+class RuntimeSettings(BaseSettings):
+    """CPU inference settings, read from `OBJECT_DETECTION_*` environment variables"""
+
+    num_threads: int | None = Field(None, gt=0)
+    num_interop_threads: int | None = Field(None, gt=0)
+    quantize: bool = False
+
+    class Config:
+        env_prefix = "object_detection_"
+
+
+def configure_threads(settings: RuntimeSettings) -> None:
+    """Sets the intra-op and inter-op thread pools sizes of torch"""
+    if settings.num_threads is not None:
+        torch.set_num_threads(settings.num_threads)
+    if (
+        settings.num_interop_threads is not None
+        and settings.num_interop_threads != torch.get_num_interop_threads()
+    ):
+        try:
+            torch.set_num_interop_threads(settings.num_interop_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work
+            warnings.warn("Inter-op threads are already configured", RuntimeWarning)
+
+
+def optimize_model(
+    model: torch.nn.Module, settings: RuntimeSettings
+) -> torch.nn.Module:
+    """Prepares a model for CPU inference"""
+    model.eval()
+    if settings.quantize:
+        # Weights of the linear layers are stored in int8,
+        # activations are quantized on the fly.
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
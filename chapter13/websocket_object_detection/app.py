@@ -1,7 +1,10 @@
 import asyncio
 import contextlib
 import io
+import time
+from collections import deque
 from pathlib import Path
+from typing import Literal
 
 import torch
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
@@ -9,8 +12,21 @@ from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from transformers import YolosForObjectDetection, YolosImageProcessor
 
+from chapter13.batching import MicroBatcher
+from chapter13.executor import InferenceExecutor, InferenceQueueFull
+from chapter13.frame_skipping import FrameChangeDetector, FrameSkippingStats
+from chapter13.postprocessing import Detections, get_labels, post_process
+from chapter13.preprocessing import FramePreprocessor
+from chapter13.runtime import RuntimeSettings, configure_threads, optimize_model
+
+MODEL_NAME = "object-detection"
+# Credits granted with each result. The client starts with one credit
+# and only captures and sends a frame when it holds one.
+CREDITS_PER_RESULT = 1
+
 
 class Object(BaseModel):
     box: tuple[float, float, float, float]
@@ -21,45 +37,142 @@ class Objects(BaseModel):
     objects: list[Object]
 
 
+class Credits(BaseModel):
+    credits: int
+    fps: float
+
+
+class DetectionResult(Objects, Credits):
+    pass
+
+
+class FrameError(Credits):
+    error: str
+
+
+# Decoded at the model input size, with its original size
+Frame = tuple[Image.Image, tuple[int, int]]
+
+
+class FrameRateMeter:
+    """Effective frames per second over the last frames"""
+
+    def __init__(self, window: int = 30) -> None:
+        self._timestamps: deque[float] = deque(maxlen=window)
+
+    def tick(self) -> None:
+        self._timestamps.append(time.monotonic())
+
+    @property
+    def fps(self) -> float:
+        if len(self._timestamps) < 2:
+            return 0.0
+        elapsed = self._timestamps[-1] - self._timestamps[0]
+        return (len(self._timestamps) - 1) / elapsed if elapsed > 0 else 0.0
+
+
 class ObjectDetection:
     image_processor: YolosImageProcessor | None = None
+    frame_preprocessor: FramePreprocessor | None = None
     model: YolosForObjectDetection | None = None
 
+    def __init__(self, settings: RuntimeSettings | None = None) -> None:
+        self.settings = settings or RuntimeSettings()
+
     def load_model(self) -> None:
         """Loads the model"""
+        configure_threads(self.settings)
         self.image_processor = YolosImageProcessor.from_pretrained("hustvl/yolos-tiny")
-        self.model = YolosForObjectDetection.from_pretrained("hustvl/yolos-tiny")
+        self.frame_preprocessor = FramePreprocessor(self.image_processor)
+        self.model = optimize_model(
+            YolosForObjectDetection.from_pretrained("hustvl/yolos-tiny"), self.settings
+        )
 
-    def predict(self, image: Image.Image) -> Objects:
-        """Runs a prediction"""
-        if not self.image_processor or not self.model:
+    @property
+    def labels(self) -> list[str]:
+        if not self.model:
+            raise RuntimeError("Model is not loaded")
+        return get_labels(self.model.config)
+
+    def decode(self, data: bytes) -> Frame:
+        """Decodes an encoded frame, raises `OSError` if it's invalid"""
+        if not self.frame_preprocessor:
             raise RuntimeError("Model is not loaded")
-        inputs = self.image_processor(images=image, return_tensors="pt")
-        outputs = self.model(**inputs)
+        image = Image.open(io.BytesIO(data))
+        original_size = image.size
+        return self.frame_preprocessor.decode(image), original_size
+
+    def predict(self, data: bytes) -> Detections:
+        """Runs a prediction"""
+        result = self.predict_batch([self.decode(data)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
 
-        target_sizes = torch.tensor([image.size[::-1]])
-        results = self.image_processor.post_process_object_detection(
-            outputs, target_sizes=target_sizes
-        )[0]
+    def predict_batch(self, frames: list[Frame]) -> list[Detections | Exception]:
+        """
+        Runs a single forward pass over frames returned by `decode`.
 
-        objects: list[Object] = []
-        for score, label, box in zip(
-            results["scores"], results["labels"], results["boxes"]
-        ):
-            if score > 0.7:
-                box_values = box.tolist()
-                label = self.model.config.id2label[label.item()]
-                objects.append(Object(box=box_values, label=label))
-        return Objects(objects=objects)
+        An invalid frame gets an exception in place of its detections,
+        without failing the others.
+        """
+        if not self.image_processor or not self.frame_preprocessor or not self.model:
+            raise RuntimeError("Model is not loaded")
+        results: list[Detections | Exception] = [
+            ValueError("Frame is not decoded") if image.mode != "RGB" else None
+            for image, _ in frames
+        ]
+        valid_frames = [
+            frame for frame, result in zip(frames, results) if result is None
+        ]
+        if valid_frames:
+            pixel_values = self.frame_preprocessor.to_tensor(
+                [image for image, _ in valid_frames]
+            )
+            with torch.inference_mode():
+                outputs = self.model(pixel_values=pixel_values)
+                batch_detections = iter(
+                    post_process(
+                        outputs.logits,
+                        outputs.pred_boxes,
+                        [original_size for _, original_size in valid_frames],
+                        threshold=0.7,
+                    )
+                )
+            results = [
+                next(batch_detections) if result is None else result
+                for result in results
+            ]
+        return results
 
 
 object_detection = ObjectDetection()
+inference_executor = InferenceExecutor(max_workers=1)
+inference_executor.register(MODEL_NAME, max_concurrency=1, max_queue_size=8)
+frame_skipping_stats = FrameSkippingStats()
+
+
+async def detect_batch(frames: list[Frame]) -> list[Detections | Exception]:
+    return await inference_executor.run(
+        MODEL_NAME, object_detection.predict_batch, frames
+    )
+
+
+# Each connection has at most one frame waiting, so while a forward pass runs,
+# the latest frame of every other connection piles up for the next batch.
+detection_batcher: MicroBatcher[Frame, Detections] = MicroBatcher(
+    detect_batch, max_batch_size=16, max_wait=0.005, max_concurrency=1
+)
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
+    inference_executor.start()
     object_detection.load_model()
+    await detection_batcher.start()
     yield
+    await detection_batcher.stop()
+    inference_executor.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -69,25 +182,84 @@ async def receive(websocket: WebSocket, queue: asyncio.Queue):
     while True:
         bytes = await websocket.receive_bytes()
         try:
-            queue.put_nowait(bytes)
+            queue.put_nowait((bytes, time.monotonic()))
         except asyncio.QueueFull:
             pass
 
 
-async def detect(websocket: WebSocket, queue: asyncio.Queue):
+async def detect(websocket: WebSocket, queue: asyncio.Queue, format: str):
+    frame_rate_meter = FrameRateMeter()
+    frame_change_detector = FrameChangeDetector()
+    labels = object_detection.labels
+    detections: Detections | None = None
+    detected_at = 0.0
     while True:
-        bytes = await queue.get()
-        image = Image.open(io.BytesIO(bytes))
-        objects = object_detection.predict(image)
-        await websocket.send_json(objects.dict())
+        bytes, received_at = await queue.get()
+        # Sent without waiting for the previous result: not answered from the
+        # cache, so a client ignoring its credits is still paced by the model
+        if received_at < detected_at:
+            frame_change_detector.reset()
+        try:
+            should_detect = await run_in_threadpool(
+                frame_change_detector.should_detect, bytes
+            )
+            if not should_detect and detections is not None:
+                # Static scene: send the previous result again
+                frame_skipping_stats.record_skip()
+            else:
+                # Decoded in this connection, so a corrupt frame only fails itself
+                frame = await run_in_threadpool(object_detection.decode, bytes)
+                start = time.perf_counter()
+                detections = await detection_batcher.submit(frame)
+                detected_at = time.monotonic()
+                frame_skipping_stats.record_detection(time.perf_counter() - start)
+        except InferenceQueueFull:
+            # Too many clients: drop the frame but give the credit back
+            frame_change_detector.reset()
+            credits = Credits(credits=CREDITS_PER_RESULT, fps=frame_rate_meter.fps)
+            await websocket.send_json(credits.dict())
+            continue
+        except (OSError, ValueError):
+            # Unidentified or truncated image: drop the frame but keep the connection
+            frame_change_detector.reset()
+            error = FrameError(
+                error="Invalid frame",
+                credits=CREDITS_PER_RESULT,
+                fps=frame_rate_meter.fps,
+            )
+            await websocket.send_json(error.dict())
+            continue
+        frame_rate_meter.tick()
+        if format == "binary":
+            await websocket.send_bytes(
+                detections.to_bytes(
+                    credits=CREDITS_PER_RESULT, fps=frame_rate_meter.fps
+                )
+            )
+        else:
+            # Boxes and labels come from the model: skip pydantic validation
+            result = DetectionResult.construct(
+                objects=detections.to_objects(labels),
+                credits=CREDITS_PER_RESULT,
+                fps=frame_rate_meter.fps,
+            )
+            await websocket.send_json(result.dict())
 
 
 @app.websocket("/object-detection")
-async def ws_object_detection(websocket: WebSocket):
+async def ws_object_detection(
+    websocket: WebSocket, format: Literal["json", "binary"] = "json"
+):
+    """
+    With `format=binary`, the label table is sent once as JSON on connect,
+    then each result is a binary frame: see `chapter13.postprocessing.HEADER`.
+    """
     await websocket.accept()
+    if format == "binary":
+        await websocket.send_json({"labels": object_detection.labels})
     queue: asyncio.Queue = asyncio.Queue(maxsize=1)
     receive_task = asyncio.create_task(receive(websocket, queue))
-    detect_task = asyncio.create_task(detect(websocket, queue))
+    detect_task = asyncio.create_task(detect(websocket, queue, format))
     try:
         done, pending = await asyncio.wait(
             {receive_task, detect_task},
@@ -101,6 +273,11 @@ async def ws_object_detection(websocket: WebSocket):
         pass
 
 
+@app.get("/frame-skipping/stats")
+async def get_frame_skipping_stats():
+    return frame_skipping_stats.stats()
+
+
 @app.get("/")
 async def index():
     return FileResponse(Path(__file__).parent / "index.html")
@@ -1,4 +1,24 @@
 const IMAGE_INTERVAL_MS = 42;
+// The server grants credits with each result:
+// we only capture and send a frame when we hold one.
+const INITIAL_CREDITS = 1;
+// Binary result frame header: number of objects (uint32), FPS (float32), credits (uint32)
+const HEADER_SIZE = 12;
+
+const decodeResult = (buffer, labels) => {
+  const view = new DataView(buffer);
+  const numObjects = view.getUint32(0, true);
+  const fps = view.getFloat32(4, true);
+  const credits = view.getUint32(8, true);
+  // Typed arrays use the platform byte order, little-endian on all common platforms
+  const boxes = new Float32Array(buffer, HEADER_SIZE, numObjects * 4);
+  const labelIds = new Uint16Array(buffer, HEADER_SIZE + boxes.byteLength, numObjects);
+  const objects = [];
+  for (let i = 0; i < numObjects; i++) {
+    objects.push({ box: boxes.subarray(i * 4, i * 4 + 4), label: labels[labelIds[i]] });
+  }
+  return { objects, fps, credits };
+};
 
 const drawObjects = (video, canvas, objects) => {
   const ctx = canvas.getContext('2d');
@@ -22,9 +42,12 @@ const drawObjects = (video, canvas, objects) => {
   }
 };
 
-const startObjectDetection = (video, canvas, deviceId) => {
-  const socket = new WebSocket(`ws://${location.host}/object-detection`);
+const startObjectDetection = (video, canvas, fpsElement, deviceId) => {
+  const socket = new WebSocket(`ws://${location.host}/object-detection?format=binary`);
+  socket.binaryType = 'arraybuffer';
+  let labels = [];
   let intervalId;
+  let credits = INITIAL_CREDITS;
 
   // Connection opened
   socket.addEventListener('open', function () {
@@ -44,8 +67,12 @@ const startObjectDetection = (video, canvas, deviceId) => {
         canvas.width = video.videoWidth;
         canvas.height = video.videoHeight;
 
-        // Send an image in the WebSocket every 42 ms
+        // Send an image in the WebSocket at most every 42 ms, if we have a credit
         intervalId = setInterval(() => {
+          if (credits <= 0) {
+            return;
+          }
+          credits -= 1;
 
           // Create a virtual canvas to draw current video image
           const canvas = document.createElement('canvas');
@@ -63,7 +90,20 @@ const startObjectDetection = (video, canvas, deviceId) => {
 
   // Listen for messages
   socket.addEventListener('message', function (event) {
-    drawObjects(video, canvas, JSON.parse(event.data));
+    // Results are binary frames, the label table and dropped frames are JSON
+    const data = typeof event.data === 'string'
+      ? JSON.parse(event.data)
+      : decodeResult(event.data, labels);
+    if (data.labels) {
+      labels = data.labels;
+      return;
+    }
+    credits += data.credits;
+    fpsElement.innerText = `${data.fps.toFixed(1)} FPS`;
+    // The server may only give the credit back if it had to drop the frame
+    if (data.objects) {
+      drawObjects(video, canvas, data);
+    }
   });
 
   // Stop the interval and video reading on close
@@ -79,6 +119,7 @@ window.addEventListener('DOMContentLoaded', (event) => {
   const video = document.getElementById('video');
   const canvas = document.getElementById('canvas');
   const cameraSelect = document.getElementById('camera-select');
+  const fpsElement = document.getElementById('fps');
   let socket;
 
   // List available cameras and fill select
@@ -105,6 +146,6 @@ window.addEventListener('DOMContentLoaded', (event) => {
     }
 
     const deviceId = cameraSelect.selectedOptions[0].value;
-    socket = startObjectDetection(video, canvas, deviceId);
+    socket = startObjectDetection(video, canvas, fpsElement, deviceId);
   });
 });
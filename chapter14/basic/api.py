@@ -2,7 +2,7 @@ from dramatiq import Message
 from fastapi import FastAPI, status
 from pydantic import UUID4, BaseModel, Field
 
-from chapter14.basic.worker import text_to_image_task
+from chapter14.basic.tasks import send_text_to_image_task
 
 
 class ImageGenerationInput(BaseModel):
@@ -24,7 +24,7 @@ app = FastAPI()
     status_code=status.HTTP_202_ACCEPTED,
 )
 async def post_image_generation(input: ImageGenerationInput) -> ImageGenerationOutput:
-    task: Message = text_to_image_task.send(
+    task: Message = send_text_to_image_task(
         input.prompt, negative_prompt=input.negative_prompt, num_steps=input.num_steps
     )
     return ImageGenerationOutput(task_id=task.message_id)
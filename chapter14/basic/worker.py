@@ -1,9 +1,9 @@
 import uuid
 
 import dramatiq
-from dramatiq.brokers.redis import RedisBroker
 from dramatiq.middleware.middleware import Middleware
 
+from chapter14.basic.broker import redis_broker
 from chapter14.basic.text_to_image import TextToImage
 
 
@@ -18,12 +18,11 @@ class TextToImageMiddleware(Middleware):
 
 
 text_to_image_middleware = TextToImageMiddleware()
-redis_broker = RedisBroker(host="localhost")
 redis_broker.add_middleware(text_to_image_middleware)
-dramatiq.set_broker(redis_broker)
 
 
-@dramatiq.actor()
+# Must match the message sent in tasks.py
+@dramatiq.actor(actor_name="text_to_image_task")
 def text_to_image_task(
     prompt: str, *, negative_prompt: str | None = None, num_steps: int = 50
 ):
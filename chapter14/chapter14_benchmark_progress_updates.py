@@ -0,0 +1,102 @@
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from chapter14.complete.database import DatabaseRunner
+from chapter14.complete.models import Base, GeneratedImage
+from chapter14.complete.progress import MemoryProgressChannel, ProgressReporter
+from chapter14.complete.worker import update_progress
+
+NUM_STEPS = 50
+
+
+async def create_image(database_url: str, num_steps: int) -> GeneratedImage:
+    engine = create_async_engine(database_url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+        image = GeneratedImage(prompt="PROMPT", num_steps=num_steps)
+        session.add(image)
+        await session.commit()
+    await engine.dispose()
+    return image
+
+
+def update_progress_asyncio_run(database_url: str, image_id: int, num_steps: int):
+    """A new event loop and session for each step"""
+    engine = create_async_engine(database_url)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def _update_progress(step: int):
+        async with session_maker() as session:
+            image = await session.get(GeneratedImage, image_id)
+            assert image is not None
+            await update_progress(session, image, step * 100 // num_steps)
+
+    for step in range(num_steps):
+        asyncio.run(_update_progress(step))
+    asyncio.run(engine.dispose())
+
+
+def update_progress_database_runner(database_url: str, image_id: int, num_steps: int):
+    """One event loop and session for all the steps"""
+    database = DatabaseRunner(database_url)
+    session: AsyncSession = database.session_maker()
+    image = database.run(session.get(GeneratedImage, image_id))
+    assert image is not None
+    for step in range(num_steps):
+        database.run(update_progress(session, image, step * 100 // num_steps))
+    database.run(session.close())
+    database.close()
+
+
+def update_progress_reporter(database_url: str, image_id: int, num_steps: int):
+    """Live progress in a side channel, only checkpoints in the database"""
+    database = DatabaseRunner(database_url)
+    session: AsyncSession = database.session_maker()
+    image = database.run(session.get(GeneratedImage, image_id))
+    assert image is not None
+    progress_reporter = ProgressReporter(
+        image_id,
+        num_steps,
+        channel=MemoryProgressChannel(),
+        persist=lambda progress: database.run(
+            update_progress(session, image, progress)
+        ),
+    )
+    for step in range(num_steps):
+        progress_reporter.report(step + 1)
+    database.run(session.close())
+    database.close()
+
+
+def benchmark(database_url: str, num_steps: int = NUM_STEPS) -> dict[str, float]:
+    """Returns the average time of a progress update in seconds, by strategy"""
+    image = asyncio.run(create_image(database_url, num_steps))
+    results: dict[str, float] = {}
+    for name, update in [
+        ("asyncio.run", update_progress_asyncio_run),
+        ("database runner", update_progress_database_runner),
+        ("progress reporter", update_progress_reporter),
+    ]:
+        start = time.perf_counter()
+        update(database_url, image.id, num_steps)
+        results[name] = (time.perf_counter() - start) / num_steps
+    return results
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = (
+            sys.argv[1]
+            if len(sys.argv) > 1
+            else f"sqlite+aiosqlite:///{Path(directory) / 'benchmark.db'}"
+        )
+        results = benchmark(database_url)
+    print(f"{'strategy':<20}{'per step (ms)':>16}")
+    for name, duration in results.items():
+        print(f"{name:<20}{duration * 1000:>16.2f}")
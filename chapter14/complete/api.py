@@ -1,21 +1,60 @@
+import asyncio
 import contextlib
+import hashlib
+import json
+import os
+import stat
+from collections.abc import AsyncGenerator
+from datetime import datetime
 
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from chapter14.complete import schemas
-from chapter14.complete.database import create_all_tables, get_async_session
+from chapter14.complete.database import (
+    async_session_maker,
+    create_all_tables,
+    get_async_session,
+)
+from chapter14.complete.encoding import get_thumbnail_name
 from chapter14.complete.models import GeneratedImage
+from chapter14.complete.progress import ProgressChannel, progress_channel
+from chapter14.complete.responses import RangeFileResponse
+from chapter14.complete.scheduling import (
+    JobScheduler,
+    ScheduledJob,
+    get_priority,
+    job_scheduler,
+)
 from chapter14.complete.settings import settings
-from chapter14.complete.storage import Storage
-from chapter14.complete.worker import text_to_image_task
+from chapter14.complete.storage import FileSystemStorage, Storage, create_storage
+from chapter14.complete.tasks import send_text_to_image_task
+
+KEEP_ALIVE_INTERVAL = 15.0
+LONG_POLL_TIMEOUT = 30.0
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_all_tables()
+    # Shared by all the requests, to reuse its connections and caches
+    app.state.storage = create_storage()
     yield
+    app.state.storage.close()
+    await progress_channel.disconnect()
+    await job_scheduler.disconnect()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -34,8 +73,16 @@ async def get_generated_image_or_404(
     return image
 
 
-async def get_storage() -> Storage:
-    return Storage()
+async def get_progress_channel() -> ProgressChannel:
+    return progress_channel
+
+
+async def get_storage(request: Request) -> Storage:
+    return request.app.state.storage
+
+
+async def get_job_scheduler() -> JobScheduler:
+    return job_scheduler
 
 
 @app.post(
@@ -45,22 +92,197 @@ async def get_storage() -> Storage:
 )
 async def create_generated_image(
     generated_image_create: schemas.GeneratedImageCreate,
+    response: Response,
     session: AsyncSession = Depends(get_async_session),
+    job_scheduler: JobScheduler = Depends(get_job_scheduler),
 ) -> GeneratedImage:
-    image = GeneratedImage(**generated_image_create.dict())
+    """
+    Requests with a seed are deterministic: an identical request
+    returns the existing image, be it generated or in progress,
+    but not if it was cancelled.
+    """
+    request_key = get_request_key(generated_image_create)
+    if request_key is not None:
+        existing_image = await get_generated_image_by_request_key(session, request_key)
+        if existing_image is not None:
+            response.status_code = status.HTTP_200_OK
+            return existing_image
+
+    image = GeneratedImage(
+        **generated_image_create.dict(exclude={"priority"}),
+        priority=get_priority(
+            generated_image_create.num_steps, generated_image_create.priority
+        ),
+        request_key=request_key,
+    )
     session.add(image)
-    await session.commit()
+    try:
+        await session.commit()
+    except IntegrityError:
+        # An identical request was created in the meantime
+        await session.rollback()
+        assert request_key is not None
+        existing_image = await get_generated_image_by_request_key(session, request_key)
+        assert existing_image is not None
+        response.status_code = status.HTTP_200_OK
+        return existing_image
 
-    text_to_image_task.send(image.id)
+    job_scheduler.enqueue(ScheduledJob(image.id, image.priority, image.tenant))
+    # Runs the next scheduled job, not necessarily this one
+    send_text_to_image_task()
 
     return image
 
 
+def get_request_key(generated_image_create: schemas.GeneratedImageCreate) -> str | None:
+    if generated_image_create.seed is None:
+        return None
+    # Scheduling doesn't change the result
+    parameters = generated_image_create.dict(exclude={"priority", "tenant"})
+    return hashlib.sha256(
+        json.dumps(parameters, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+async def get_generated_image_by_request_key(
+    session: AsyncSession, request_key: str
+) -> GeneratedImage | None:
+    select_query = select(GeneratedImage).where(
+        GeneratedImage.request_key == request_key
+    )
+    result = await session.execute(select_query)
+    return result.scalar_one_or_none()
+
+
+async def get_live_progress(
+    image: GeneratedImage, progress_channel: ProgressChannel
+) -> int:
+    # The database only stores checkpoints of the progress
+    live_progress = await progress_channel.get(image.id)
+    if live_progress is not None and live_progress > image.progress:
+        return live_progress
+    return image.progress
+
+
+async def get_generated_image_progress(
+    id: int, progress_channel: ProgressChannel
+) -> schemas.GeneratedImageProgress:
+    """
+    Reads the progress in a short-lived session,
+    so waiting clients don't hold a database connection.
+    """
+    async with async_session_maker() as session:
+        image = await session.get(GeneratedImage, id)
+    if image is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return schemas.GeneratedImageProgress(
+        progress=await get_live_progress(image, progress_channel),
+        file_name=image.file_name,
+        cancelled=image.cancelled,
+    )
+
+
+async def generated_image_events(
+    id: int, progress_channel: ProgressChannel
+) -> AsyncGenerator[str, None]:
+    # Subscribe before reading the state, not to miss a notification in between
+    async with progress_channel.subscribe(id) as subscription:
+        state = await get_generated_image_progress(id, progress_channel)
+        yield f"data: {state.json()}\n\n"
+        while state.file_name is None and not state.cancelled:
+            event = await subscription.get(timeout=KEEP_ALIVE_INTERVAL)
+            if event is None:
+                yield ": keep-alive\n\n"
+            elif (
+                event.progress > state.progress
+                or event.file_name is not None
+                or event.cancelled
+            ):
+                state = event
+                yield f"data: {state.json()}\n\n"
+
+
 @app.get("/generated-images/{id}", response_model=schemas.GeneratedImageRead)
 async def get_generated_image(
     image: GeneratedImage = Depends(get_generated_image_or_404),
-) -> GeneratedImage:
-    return image
+    progress_channel: ProgressChannel = Depends(get_progress_channel),
+) -> schemas.GeneratedImageRead:
+    generated_image = schemas.GeneratedImageRead.from_orm(image)
+    generated_image.progress = await get_live_progress(image, progress_channel)
+    return generated_image
+
+
+@app.get("/generated-images/{id}/events")
+async def get_generated_image_events(
+    id: int, progress_channel: ProgressChannel = Depends(get_progress_channel)
+) -> StreamingResponse:
+    """
+    Server-Sent Events stream of the progress,
+    until the image is available or cancelled.
+    """
+    # Fails with a 404 before the response starts
+    await get_generated_image_progress(id, progress_channel)
+    return StreamingResponse(
+        generated_image_events(id, progress_channel),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get(
+    "/generated-images/{id}/progress", response_model=schemas.GeneratedImageProgress
+)
+async def poll_generated_image_progress(
+    id: int,
+    after: int = Query(-1, ge=-1, le=100),
+    timeout: float = Query(LONG_POLL_TIMEOUT, ge=0, le=60),
+    progress_channel: ProgressChannel = Depends(get_progress_channel),
+) -> schemas.GeneratedImageProgress:
+    """
+    Long-polls the progress: waits up to `timeout` seconds for the progress
+    to be greater than `after`, or the image to be available or cancelled.
+    """
+    async with progress_channel.subscribe(id) as subscription:
+        state = await get_generated_image_progress(id, progress_channel)
+        deadline = asyncio.get_running_loop().time() + timeout
+        while (
+            state.file_name is None and not state.cancelled and state.progress <= after
+        ):
+            remaining = deadline - asyncio.get_running_loop().time()
+            event = await subscription.get(timeout=max(remaining, 0))
+            if event is None:
+                break
+            state = event
+        return state
+
+
+@app.delete("/generated-images/{id}", status_code=status.HTTP_204_NO_CONTENT)
+async def cancel_generated_image(
+    image: GeneratedImage = Depends(get_generated_image_or_404),
+    session: AsyncSession = Depends(get_async_session),
+    progress_channel: ProgressChannel = Depends(get_progress_channel),
+) -> None:
+    """
+    Cancels the generation: a queued job is skipped, a running one
+    stops at its next step. Cancelling twice has no effect.
+    """
+    if image.file_name is not None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Image is already generated.",
+        )
+    if image.cancelled:
+        return
+
+    image.cancelled_at = datetime.now()
+    # An identical request generates the image again instead of returning this one
+    image.request_key = None
+    session.add(image)
+    await session.commit()
+    # The worker only checks the progress channel while running
+    await progress_channel.cancel(
+        image.id, await get_live_progress(image, progress_channel)
+    )
 
 
 @app.get("/generated-images/{id}/url")
@@ -74,5 +296,45 @@ async def get_generated_image_url(
             detail="Image is not available yet. Please try again later.",
         )
 
-    url = storage.get_presigned_url(image.file_name, settings.storage_bucket)
-    return schemas.GeneratedImageURL(url=url)
+    url = storage.get_url(image.file_name, settings.storage_bucket)
+    thumbnail_url = (
+        storage.get_url(get_thumbnail_name(image.file_name), settings.storage_bucket)
+        if storage.encoding.thumbnail_size is not None
+        else None
+    )
+    return schemas.GeneratedImageURL(url=url, thumbnail_url=thumbnail_url)
+
+
+@app.get("/files/{bucket_name}/{object_name:path}")
+async def get_file(
+    bucket_name: str,
+    object_name: str,
+    request: Request,
+    storage: Storage = Depends(get_storage),
+) -> Response:
+    """Serves the images of the filesystem storage backend"""
+    if not isinstance(storage, FileSystemStorage):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    try:
+        path = storage.get_path(object_name, bucket_name)
+        stat_result = await run_in_threadpool(os.stat, path)
+    except (ValueError, FileNotFoundError):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    return RangeFileResponse(
+        path,
+        request_headers=request.headers,
+        stat_result=stat_result,
+        # Content-addressed: a file never changes once written
+        headers={"cache-control": "public, max-age=31536000, immutable"},
+    )
+
+
+@app.get("/queue/stats")
+async def get_queue_stats(
+    job_scheduler: JobScheduler = Depends(get_job_scheduler),
+) -> dict[str, dict[str, float]]:
+    """Pending jobs and their wait times, in seconds, by priority class"""
+    return await job_scheduler.stats()
@@ -0,0 +1,233 @@
+import queue
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+
+import torch
+from PIL import Image
+
+from chapter14.complete.text_to_image import TextToImage
+
+Callback = Callable[[int, int, torch.FloatTensor], None]
+
+
+class BatchAborted(Exception):
+    """All the jobs of the batch failed: no need to finish the pipeline call"""
+
+
+class JobCancelled(Exception):
+    """
+    Raised by a job callback to cancel its job.
+
+    The latent of the job stays in the batch: its steps are only saved
+    if the pipeline call stops early. Once it ended, `saved_steps` counts
+    the steps the pipeline didn't run and `discarded_steps` the ones it ran
+    for nothing, after the cancellation.
+    """
+
+    def __init__(self, saved_steps: int = 0, discarded_steps: int = 0) -> None:
+        super().__init__(
+            f"Generation cancelled, {saved_steps} steps saved, "
+            f"{discarded_steps} steps discarded"
+        )
+        self.saved_steps = saved_steps
+        self.discarded_steps = discarded_steps
+
+
+class GenerationJob:
+    def __init__(
+        self,
+        prompt: str,
+        negative_prompt: str | None,
+        num_steps: int,
+        seed: int | None,
+        callback: Callback | None,
+    ) -> None:
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.num_steps = num_steps
+        self.seed = seed
+        self.callback = callback
+        self.enqueued_at = time.monotonic()
+        self.future: Future[Image.Image] = Future()
+        self.error: Exception | None = None
+        # Handed back to the calling thread; `None` once the job is done
+        self.calls: queue.SimpleQueue[Callable[[], None] | None] = queue.SimpleQueue()
+        self.future.add_done_callback(lambda _: self.calls.put(None))
+
+
+class DiffusionBatcher:
+    """
+    Groups the jobs of concurrent worker threads into batched pipeline calls.
+
+    Jobs are batched with the jobs having the same number of steps, enqueued
+    at most `max_wait` seconds after the oldest one. Pipeline calls run one
+    at a time in a dedicated thread: jobs submitted meanwhile pile up
+    for the next batch.
+
+    A job whose callback raises, e.g. `JobCancelled`, is not called back
+    anymore and fails when the pipeline call ends; it stops early once all
+    the jobs of the batch failed.
+
+    Callbacks run in the batcher thread: work needing resources of the
+    calling thread, like its database runner, is handed back with
+    `run_in_caller`.
+    """
+
+    def __init__(
+        self,
+        text_to_image: TextToImage,
+        *,
+        max_batch_size: int = 4,
+        max_wait: float = 0.5,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.text_to_image = text_to_image
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._jobs: list[GenerationJob] = []
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._running = False
+        # Job whose callback is running, only used by the batcher thread
+        self._current_job: GenerationJob | None = None
+
+    def start(self) -> None:
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._condition:
+            jobs, self._jobs = self._jobs, []
+        for job in jobs:
+            job.future.set_exception(RuntimeError("Batcher is stopped"))
+
+    def generate(
+        self,
+        prompt: str,
+        *,
+        negative_prompt: str | None = None,
+        num_steps: int = 50,
+        seed: int | None = None,
+        callback: Callback | None = None,
+    ) -> Image.Image:
+        """Blocks until the job has been generated as part of a batch"""
+        job = GenerationJob(prompt, negative_prompt, num_steps, seed, callback)
+        with self._condition:
+            if not self._running:
+                raise RuntimeError("Batcher is not started")
+            self._jobs.append(job)
+            self._condition.notify_all()
+
+        error: Exception | None = None
+        while (call := job.calls.get()) is not None:
+            if error is not None:
+                continue
+            try:
+                call()
+            except Exception as e:
+                # Raised once the job is done, not to leave it running unattended
+                error = e
+        image = job.future.result()
+        if error is not None:
+            raise error
+        return image
+
+    def run_in_caller(self, function: Callable[[], None]) -> None:
+        """
+        From a job callback, runs `function` in the thread waiting for the job,
+        in order. The pipeline doesn't wait for it.
+        """
+        if self._current_job is None:
+            raise RuntimeError("Only available from a job callback")
+        self._current_job.calls.put(function)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            self._process(batch)
+
+    def _collect(self) -> list[GenerationJob] | None:
+        with self._condition:
+            while self._running and not self._jobs:
+                self._condition.wait()
+            if not self._running:
+                return None
+
+            num_steps = self._jobs[0].num_steps
+            deadline = self._jobs[0].enqueued_at + self.max_wait
+            while self._running:
+                compatible_jobs = [
+                    job for job in self._jobs if job.num_steps == num_steps
+                ]
+                remaining = deadline - time.monotonic()
+                if len(compatible_jobs) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            else:
+                return None
+
+            batch = compatible_jobs[: self.max_batch_size]
+            self._jobs = [job for job in self._jobs if job not in batch]
+            return batch
+
+    def _process(self, batch: list[GenerationJob]) -> None:
+        num_steps = batch[0].num_steps
+        steps_run = 0
+        # Steps run when each failed job raised
+        failed_at: dict[GenerationJob, int] = {}
+
+        def callback(step: int, timestep: int, latents: torch.FloatTensor):
+            nonlocal steps_run
+            steps_run = step + 1
+            for job in batch:
+                if job.callback is None or job.error is not None:
+                    continue
+                self._current_job = job
+                try:
+                    job.callback(step, timestep, latents)
+                except Exception as e:
+                    # Only fails this job, not the whole batch
+                    job.error = e
+                    failed_at[job] = steps_run
+                finally:
+                    self._current_job = None
+            if all(job.error is not None for job in batch):
+                raise BatchAborted()
+
+        images: list[Image.Image] | Exception
+        try:
+            images = self.text_to_image.generate_batch(
+                [job.prompt for job in batch],
+                negative_prompts=[job.negative_prompt for job in batch],
+                num_steps=num_steps,
+                seeds=[job.seed for job in batch],
+                callback=callback,
+            )
+            steps_run = num_steps
+        except Exception as e:
+            images = e
+        for i, job in enumerate(batch):
+            if job.error is not None:
+                if isinstance(job.error, JobCancelled):
+                    job.error.saved_steps = num_steps - steps_run
+                    job.error.discarded_steps = steps_run - failed_at[job]
+                job.future.set_exception(job.error)
+            elif isinstance(images, Exception):
+                job.future.set_exception(images)
+            else:
+                job.future.set_result(images[i])
@@ -1,10 +1,15 @@
-from collections.abc import AsyncGenerator
+import asyncio
+import threading
+from collections.abc import AsyncGenerator, Coroutine
+from typing import Any, TypeVar
 
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from chapter14.complete.models import Base
 from chapter14.complete.settings import settings
 
+T = TypeVar("T")
+
 engine = create_async_engine(settings.database_url)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
@@ -17,3 +22,44 @@ async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
 async def create_all_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+
+
+class DatabaseRunner:
+    """
+    Runs database coroutines from synchronous code on a long-lived event loop.
+
+    Pooled connections are bound to the loop that opened them,
+    so each runner has its own engine: use one per thread.
+    """
+
+    def __init__(self, database_url: str) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.engine = create_async_engine(database_url)
+        self.session_maker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    def run(self, coroutine: Coroutine[Any, Any, T]) -> T:
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self) -> None:
+        self.run(self.engine.dispose())
+        self.loop.close()
+
+
+_local = threading.local()
+
+
+def get_database_runner() -> DatabaseRunner:
+    """Returns the database runner of the current thread"""
+    runner: DatabaseRunner | None = getattr(_local, "runner", None)
+    if runner is None:
+        runner = DatabaseRunner(settings.database_url)
+        _local.runner = runner
+    return runner
+
+
+def close_database_runner() -> None:
+    """Closes the database runner of the current thread, if any"""
+    runner: DatabaseRunner | None = getattr(_local, "runner", None)
+    if runner is not None:
+        runner.close()
+        _local.runner = None
@@ -0,0 +1,87 @@
+import io
+from typing import Any, BinaryIO
+
+from PIL import Image
+
+from chapter14.complete.settings import ImageFormat, settings
+
+CONTENT_TYPES: dict[str, str] = {
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "JPEG": "image/jpeg",
+}
+EXTENSIONS: dict[str, str] = {"PNG": "png", "WEBP": "webp", "JPEG": "jpg"}
+
+
+class ImageEncoding:
+    """
+    Format of the stored images and of their thumbnails.
+
+    `quality` applies to WebP and JPEG, `compress_level` to PNG, from 0 to 9:
+    lower levels are much faster to encode but give bigger files.
+    """
+
+    def __init__(
+        self,
+        format: ImageFormat = "PNG",
+        *,
+        quality: int = 90,
+        compress_level: int = 6,
+        thumbnail_size: int | None = 256,
+    ) -> None:
+        if format not in CONTENT_TYPES:
+            raise ValueError(f"Unsupported image format: {format}")
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+        self.thumbnail_size = thumbnail_size
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+    def write(self, image: Image.Image, fp: BinaryIO) -> None:
+        """Encodes the image into a file object, which doesn't need to be seekable"""
+        params: dict[str, Any]
+        if self.format == "PNG":
+            params = {"compress_level": self.compress_level}
+        else:
+            params = {"quality": self.quality}
+        if self.format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(fp, format=self.format, **params)
+
+    def encode(self, image: Image.Image) -> tuple[io.BytesIO, int]:
+        """Encodes the image in memory, returns the buffer and its length"""
+        data = io.BytesIO()
+        self.write(image, data)
+        # The position is the length: no need to copy the buffer with getvalue()
+        length = data.tell()
+        data.seek(0)
+        return data, length
+
+    def thumbnail(self, image: Image.Image) -> Image.Image | None:
+        """Downscaled image fitting in `thumbnail_size`, if enabled"""
+        if self.thumbnail_size is None:
+            return None
+        ratio = self.thumbnail_size / max(image.size)
+        if ratio >= 1:
+            return image
+        size = (max(round(image.width * ratio), 1), max(round(image.height * ratio), 1))
+        return image.resize(size, resample=Image.LANCZOS, reducing_gap=2.0)
+
+
+def get_thumbnail_name(object_name: str) -> str:
+    return f"thumbnails/{object_name}"
+
+
+image_encoding = ImageEncoding(
+    settings.image_format,
+    quality=settings.image_quality,
+    compress_level=settings.image_compress_level,
+    thumbnail_size=settings.thumbnail_size,
+)
@@ -20,5 +20,17 @@ class GeneratedImage(Base):
     prompt: Mapped[str] = mapped_column(Text, nullable=False)
     negative_prompt: Mapped[str | None] = mapped_column(Text, nullable=True)
     num_steps: Mapped[int] = mapped_column(Integer, nullable=False)
+    seed: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    priority: Mapped[str] = mapped_column(String(16), nullable=False, default="normal")
+    tenant: Mapped[str] = mapped_column(String(64), nullable=False, default="default")
+    # Set for deterministic requests only, i.e. with a seed
+    request_key: Mapped[str | None] = mapped_column(
+        String(64), nullable=True, unique=True
+    )
 
     file_name: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    cancelled_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_at is not None
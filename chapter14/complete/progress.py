@@ -0,0 +1,291 @@
+import asyncio
+import contextlib
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+import redis
+import redis.asyncio
+import redis.asyncio.client
+
+from chapter14.complete.schemas import GeneratedImageProgress
+from chapter14.complete.settings import settings
+
+
+class ProgressSubscription:
+    """Progress notifications of a generation job"""
+
+    def __init__(self, get_message: Callable[[], Awaitable[str]]) -> None:
+        self._get_message = get_message
+
+    async def get(self, timeout: float | None = None) -> GeneratedImageProgress | None:
+        """Waits for the next notification, returns `None` after `timeout` seconds"""
+        try:
+            message = await asyncio.wait_for(self._get_message(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return GeneratedImageProgress.parse_raw(message)
+
+
+class ProgressChannel(ABC):
+    """
+    Side channel for the live progress of the generation jobs.
+
+    The worker publishes the progress, which is both stored, for `get`,
+    and notified to the subscribers of the job. The API cancels the jobs,
+    which the worker checks at each step with `is_cancelled`.
+    """
+
+    async def disconnect(self) -> None:
+        pass
+
+    @abstractmethod
+    def publish(
+        self, image_id: int, progress: int, *, file_name: str | None = None
+    ) -> None:
+        ...
+
+    @abstractmethod
+    async def get(self, image_id: int) -> int | None:
+        ...
+
+    @abstractmethod
+    async def cancel(self, image_id: int, progress: int) -> None:
+        ...
+
+    @abstractmethod
+    def is_cancelled(self, image_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def subscribe(
+        self, image_id: int
+    ) -> contextlib.AbstractAsyncContextManager[ProgressSubscription]:
+        ...
+
+
+class RedisProgressChannel(ProgressChannel):
+    def __init__(self, url: str, *, ttl: int = 3600) -> None:
+        self.url = url
+        self.ttl = ttl
+        self._client: redis.Redis | None = None
+        self._async_client: redis.asyncio.Redis | None = None
+        # A single Redis subscription connection is shared by all the subscribers:
+        # each message is fanned out to the queues of its channel
+        self._pubsub: redis.asyncio.client.PubSub | None = None
+        self._pubsub_lock = asyncio.Lock()
+        self._listener: asyncio.Task | None = None
+        self._subscribers: dict[str, set[asyncio.Queue[str]]] = {}
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    @property
+    def async_client(self) -> redis.asyncio.Redis:
+        if self._async_client is None:
+            self._async_client = redis.asyncio.Redis.from_url(self.url)
+        return self._async_client
+
+    async def disconnect(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+        if self._pubsub is not None:
+            await self._pubsub.close()
+            self._pubsub = None
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+    def publish(
+        self, image_id: int, progress: int, *, file_name: str | None = None
+    ) -> None:
+        message = GeneratedImageProgress(progress=progress, file_name=file_name)
+        pipeline = self.client.pipeline()
+        pipeline.set(self._key(image_id), progress, ex=self.ttl)
+        pipeline.publish(self._channel(image_id), message.json())
+        pipeline.execute()
+
+    async def get(self, image_id: int) -> int | None:
+        value = await self.async_client.get(self._key(image_id))
+        return int(value) if value is not None else None
+
+    async def cancel(self, image_id: int, progress: int) -> None:
+        message = GeneratedImageProgress(progress=progress, cancelled=True)
+        pipeline = self.async_client.pipeline()
+        pipeline.set(self._cancelled_key(image_id), 1, ex=self.ttl)
+        pipeline.publish(self._channel(image_id), message.json())
+        await pipeline.execute()
+
+    def is_cancelled(self, image_id: int) -> bool:
+        return bool(self.client.exists(self._cancelled_key(image_id)))
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, image_id: int) -> AsyncIterator[ProgressSubscription]:
+        channel = self._channel(image_id)
+        queue: asyncio.Queue[str] = asyncio.Queue()
+        try:
+            async with self._pubsub_lock:
+                subscribers = self._subscribers.setdefault(channel, set())
+                subscribers.add(queue)
+                if len(subscribers) == 1:
+                    await self._subscribe(channel)
+            yield ProgressSubscription(queue.get)
+        finally:
+            # Shielded: subscribers are usually cancelled, when the client leaves
+            await asyncio.shield(self._unsubscribe(channel, queue))
+
+    async def _subscribe(self, channel: str) -> None:
+        if self._pubsub is None:
+            self._pubsub = self.async_client.pubsub()
+        await self._pubsub.subscribe(channel)
+        # The connection only exists once subscribed to a first channel
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen(self._pubsub))
+
+    async def _unsubscribe(self, channel: str, queue: asyncio.Queue[str]) -> None:
+        async with self._pubsub_lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None:
+                return
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[channel]
+                if self._pubsub is not None:
+                    await self._pubsub.unsubscribe(channel)
+
+    async def _listen(self, pubsub: redis.asyncio.client.PubSub) -> None:
+        while True:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=None
+            )
+            if message is None or message["type"] != "message":
+                continue
+            channel = message["channel"].decode()
+            for queue in self._subscribers.get(channel, ()):
+                queue.put_nowait(message["data"].decode())
+
+    def _key(self, image_id: int) -> str:
+        return f"generated-images:{image_id}:progress"
+
+    def _channel(self, image_id: int) -> str:
+        return f"generated-images:{image_id}:events"
+
+    def _cancelled_key(self, image_id: int) -> str:
+        return f"generated-images:{image_id}:cancelled"
+
+
+class MemoryProgressChannel(ProgressChannel):
+    """In-process stand-in for the Redis pub/sub progress fan-out"""
+
+    def __init__(self) -> None:
+        self._progress: dict[int, int] = {}
+        self._cancelled: set[int] = set()
+        self._subscribers: dict[
+            int, list[tuple[asyncio.AbstractEventLoop, asyncio.Queue[str]]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def publish(
+        self, image_id: int, progress: int, *, file_name: str | None = None
+    ) -> None:
+        message = GeneratedImageProgress(progress=progress, file_name=file_name)
+        with self._lock:
+            self._progress[image_id] = progress
+        self._notify(image_id, message)
+
+    async def get(self, image_id: int) -> int | None:
+        with self._lock:
+            return self._progress.get(image_id)
+
+    async def cancel(self, image_id: int, progress: int) -> None:
+        with self._lock:
+            self._cancelled.add(image_id)
+        self._notify(
+            image_id, GeneratedImageProgress(progress=progress, cancelled=True)
+        )
+
+    def is_cancelled(self, image_id: int) -> bool:
+        with self._lock:
+            return image_id in self._cancelled
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, image_id: int) -> AsyncIterator[ProgressSubscription]:
+        queue: asyncio.Queue[str] = asyncio.Queue()
+        subscriber = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers.setdefault(image_id, []).append(subscriber)
+        try:
+            yield ProgressSubscription(queue.get)
+        finally:
+            with self._lock:
+                self._subscribers[image_id].remove(subscriber)
+                if not self._subscribers[image_id]:
+                    del self._subscribers[image_id]
+
+    def _notify(self, image_id: int, message: GeneratedImageProgress) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers.get(image_id, []))
+        # Safe to call from the worker threads
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, message.json())
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a generation job, in percents.
+
+    Live progress is published at most every `min_interval` seconds, unless
+    it moved by at least `min_delta`. It's only persisted to the database
+    every `checkpoint_delta`: the completion is persisted by the worker.
+    """
+
+    def __init__(
+        self,
+        image_id: int,
+        num_steps: int,
+        *,
+        channel: ProgressChannel,
+        persist: Callable[[int], None],
+        min_interval: float = 0.5,
+        min_delta: int = 10,
+        checkpoint_delta: int = 25,
+    ) -> None:
+        self.image_id = image_id
+        self.num_steps = num_steps
+        self.channel = channel
+        self.persist = persist
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.checkpoint_delta = checkpoint_delta
+        self.published = 0
+        self.published_at = time.monotonic()
+        self.persisted = 0
+
+    def report(self, completed_steps: int) -> None:
+        progress = int(completed_steps / self.num_steps * 100)
+        now = time.monotonic()
+        if progress > self.published and (
+            progress - self.published >= self.min_delta
+            or now - self.published_at >= self.min_interval
+        ):
+            self.channel.publish(self.image_id, progress)
+            self.published = progress
+            self.published_at = now
+        if progress < 100 and progress - self.persisted >= self.checkpoint_delta:
+            self.persist(progress)
+            self.persisted = progress
+
+    def complete(self, file_name: str) -> None:
+        """Notifies the completion, once persisted by the worker"""
+        self.channel.publish(self.image_id, 100, file_name=file_name)
+        self.published = 100
+
+
+progress_channel: ProgressChannel = RedisProgressChannel(settings.redis_url)
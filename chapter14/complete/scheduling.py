@@ -0,0 +1,312 @@
+import collections
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import redis
+import redis.asyncio
+
+from chapter14.complete.schemas import Priority
+from chapter14.complete.settings import settings
+
+# Highest first
+PRIORITIES: tuple[Priority, ...] = ("high", "normal", "low")
+
+ENQUEUE_SCRIPT = """
+-- The tenant is in the ring if and only if it has pending jobs
+if redis.call("RPUSH", KEYS[2], ARGV[2]) == 1 then
+    redis.call("RPUSH", KEYS[1], ARGV[1])
+end
+redis.call("ZADD", KEYS[3], ARGV[3], ARGV[4])
+"""
+
+DEQUEUE_SCRIPT = """
+local prefix, now = ARGV[1], tonumber(ARGV[2])
+for i = 3, #ARGV do
+    local class = prefix .. ":" .. ARGV[i]
+    local tenant = redis.call("LPOP", class .. ":tenants")
+    if tenant then
+        local queue = class .. ":tenant:" .. tenant
+        local job = redis.call("LPOP", queue)
+        if redis.call("LLEN", queue) > 0 then
+            redis.call("RPUSH", class .. ":tenants", tenant)
+        end
+        local image_id = string.match(job, "^(%d+):")
+        local enqueued_at = tonumber(redis.call("ZSCORE", class .. ":enqueued", image_id))
+        redis.call("ZREM", class .. ":enqueued", image_id)
+        redis.call("INCR", class .. ":dequeued")
+        redis.call("INCRBYFLOAT", class .. ":wait_total", now - enqueued_at)
+        return {ARGV[i], tenant, job, tostring(enqueued_at)}
+    end
+end
+return nil
+"""
+
+
+def get_priority(num_steps: int, priority: Priority | None = None) -> Priority:
+    """Jobs without an explicit priority are high priority if they're previews"""
+    if priority is not None:
+        return priority
+    return "high" if num_steps <= settings.preview_max_steps else "normal"
+
+
+class ScheduledJob:
+    def __init__(
+        self,
+        image_id: int,
+        priority: Priority,
+        tenant: str,
+        *,
+        attempts: int = 0,
+        enqueued_at: float | None = None,
+    ) -> None:
+        self.image_id = image_id
+        self.priority = priority
+        self.tenant = tenant
+        self.attempts = attempts
+        self.enqueued_at = enqueued_at if enqueued_at is not None else time.time()
+
+    def __repr__(self) -> str:
+        return (
+            f"ScheduledJob(image_id={self.image_id}, priority={self.priority!r}, "
+            f"tenant={self.tenant!r}, attempts={self.attempts})"
+        )
+
+
+class JobScheduler(ABC):
+    """
+    Pending generation jobs, in the order they should run.
+
+    Priority classes are strictly ordered. Within a class, tenants take
+    turns, so a tenant submitting many jobs doesn't starve the others,
+    and the jobs of a tenant run in submission order.
+
+    The dramatiq messages are only tokens, one per job: a worker receiving
+    a message runs the job at the head of the scheduler.
+    """
+
+    async def disconnect(self) -> None:
+        pass
+
+    @abstractmethod
+    def enqueue(self, job: ScheduledJob) -> None:
+        ...
+
+    @abstractmethod
+    def dequeue(self) -> ScheduledJob | None:
+        ...
+
+    @abstractmethod
+    def record_cancellation(
+        self, job: ScheduledJob, saved_steps: int, discarded_steps: int
+    ) -> None:
+        """
+        Counts a cancelled job, the diffusion steps it didn't run
+        and the ones it ran for nothing
+        """
+
+    @abstractmethod
+    async def stats(self) -> dict[str, dict[str, float]]:
+        """Queue depth, wait times, in seconds, and cancellations by priority class"""
+
+
+class RedisJobScheduler(JobScheduler):
+    def __init__(self, url: str, *, prefix: str = "text-to-image") -> None:
+        self.url = url
+        self.prefix = prefix
+        # Connects on first use
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        # Both are atomic, so concurrent workers never get the same job
+        self._enqueue = self.client.register_script(ENQUEUE_SCRIPT)
+        self._dequeue = self.client.register_script(DEQUEUE_SCRIPT)
+        self._async_client: redis.asyncio.Redis | None = None
+
+    @property
+    def async_client(self) -> redis.asyncio.Redis:
+        if self._async_client is None:
+            self._async_client = redis.asyncio.Redis.from_url(
+                self.url, decode_responses=True
+            )
+        return self._async_client
+
+    async def disconnect(self) -> None:
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+    def enqueue(self, job: ScheduledJob) -> None:
+        class_key = self._class_key(job.priority)
+        self._enqueue(
+            keys=[
+                f"{class_key}:tenants",
+                f"{class_key}:tenant:{job.tenant}",
+                f"{class_key}:enqueued",
+            ],
+            args=[
+                job.tenant,
+                f"{job.image_id}:{job.attempts}",
+                job.enqueued_at,
+                job.image_id,
+            ],
+        )
+
+    def dequeue(self) -> ScheduledJob | None:
+        result = self._dequeue(args=[self.prefix, time.time(), *PRIORITIES])
+        if result is None:
+            return None
+        priority, tenant, entry, enqueued_at = result
+        image_id, attempts = entry.split(":")
+        return ScheduledJob(
+            int(image_id),
+            priority,
+            tenant,
+            attempts=int(attempts),
+            enqueued_at=float(enqueued_at),
+        )
+
+    def record_cancellation(
+        self, job: ScheduledJob, saved_steps: int, discarded_steps: int
+    ) -> None:
+        class_key = self._class_key(job.priority)
+        pipeline = self.client.pipeline()
+        pipeline.incr(f"{class_key}:cancelled")
+        pipeline.incrby(f"{class_key}:saved_steps", saved_steps)
+        pipeline.incrby(f"{class_key}:discarded_steps", discarded_steps)
+        pipeline.execute()
+
+    async def stats(self) -> dict[str, dict[str, float]]:
+        pipeline = self.async_client.pipeline()
+        for priority in PRIORITIES:
+            class_key = self._class_key(priority)
+            pipeline.zcard(f"{class_key}:enqueued")
+            pipeline.zrange(f"{class_key}:enqueued", 0, 0, withscores=True)
+            pipeline.get(f"{class_key}:dequeued")
+            pipeline.get(f"{class_key}:wait_total")
+            pipeline.get(f"{class_key}:cancelled")
+            pipeline.get(f"{class_key}:saved_steps")
+            pipeline.get(f"{class_key}:discarded_steps")
+        results = await pipeline.execute()
+        now = time.time()
+        stats: dict[str, dict[str, float]] = {}
+        for i, priority in enumerate(PRIORITIES):
+            (
+                depth,
+                oldest,
+                dequeued,
+                wait_total,
+                cancelled,
+                saved_steps,
+                discarded_steps,
+            ) = results[i * 7 : i * 7 + 7]
+            stats[priority] = get_queue_stats(
+                depth=depth,
+                oldest_enqueued_at=oldest[0][1] if oldest else None,
+                dequeued=int(dequeued or 0),
+                wait_total=float(wait_total or 0),
+                cancelled=int(cancelled or 0),
+                saved_steps=int(saved_steps or 0),
+                discarded_steps=int(discarded_steps or 0),
+                now=now,
+            )
+        return stats
+
+    def _class_key(self, priority: Priority) -> str:
+        return f"{self.prefix}:{priority}"
+
+
+class MemoryJobScheduler(JobScheduler):
+    """In-process stand-in for the Redis Lua priority and fair-share queue"""
+
+    def __init__(self) -> None:
+        # Pending jobs by tenant: the first tenant is the next one to run a job
+        self._queues: dict[
+            Priority, collections.OrderedDict[str, collections.deque[ScheduledJob]]
+        ] = {priority: collections.OrderedDict() for priority in PRIORITIES}
+        self._dequeued: dict[Priority, int] = dict.fromkeys(PRIORITIES, 0)
+        self._wait_total: dict[Priority, float] = dict.fromkeys(PRIORITIES, 0.0)
+        self._cancelled: dict[Priority, int] = dict.fromkeys(PRIORITIES, 0)
+        self._saved_steps: dict[Priority, int] = dict.fromkeys(PRIORITIES, 0)
+        self._discarded_steps: dict[Priority, int] = dict.fromkeys(PRIORITIES, 0)
+        self._lock = threading.Lock()
+
+    def enqueue(self, job: ScheduledJob) -> None:
+        with self._lock:
+            queues = self._queues[job.priority]
+            queues.setdefault(job.tenant, collections.deque()).append(job)
+
+    def dequeue(self) -> ScheduledJob | None:
+        with self._lock:
+            for priority in PRIORITIES:
+                queues = self._queues[priority]
+                if not queues:
+                    continue
+                tenant, queue = queues.popitem(last=False)
+                job = queue.popleft()
+                # Back at the end of the turn
+                if queue:
+                    queues[tenant] = queue
+                self._dequeued[priority] += 1
+                self._wait_total[priority] += time.time() - job.enqueued_at
+                return job
+            return None
+
+    def record_cancellation(
+        self, job: ScheduledJob, saved_steps: int, discarded_steps: int
+    ) -> None:
+        with self._lock:
+            self._cancelled[job.priority] += 1
+            self._saved_steps[job.priority] += saved_steps
+            self._discarded_steps[job.priority] += discarded_steps
+
+    async def stats(self) -> dict[str, dict[str, float]]:
+        now = time.time()
+        with self._lock:
+            stats: dict[str, dict[str, float]] = {}
+            for priority in PRIORITIES:
+                jobs = [
+                    job for queue in self._queues[priority].values() for job in queue
+                ]
+                stats[priority] = get_queue_stats(
+                    depth=len(jobs),
+                    oldest_enqueued_at=min(
+                        (job.enqueued_at for job in jobs), default=None
+                    ),
+                    dequeued=self._dequeued[priority],
+                    wait_total=self._wait_total[priority],
+                    cancelled=self._cancelled[priority],
+                    saved_steps=self._saved_steps[priority],
+                    discarded_steps=self._discarded_steps[priority],
+                    now=now,
+                )
+            return stats
+
+
+def get_queue_stats(
+    *,
+    depth: int,
+    oldest_enqueued_at: float | None,
+    dequeued: int,
+    wait_total: float,
+    cancelled: int,
+    saved_steps: int,
+    discarded_steps: int,
+    now: float,
+) -> dict[str, float]:
+    return {
+        "depth": depth,
+        # Current wait of the oldest pending job
+        "oldest_wait": (
+            now - oldest_enqueued_at if oldest_enqueued_at is not None else 0.0
+        ),
+        "dequeued": dequeued,
+        # Wait of the jobs which already started
+        "average_wait": wait_total / dequeued if dequeued else 0.0,
+        "cancelled": cancelled,
+        # Diffusion steps cancelled jobs didn't run, before or while running
+        "saved_steps": saved_steps,
+        # Diffusion steps run for cancelled jobs, e.g. batched with live ones
+        "discarded_steps": discarded_steps,
+    }
+
+
+job_scheduler: JobScheduler = RedisJobScheduler(settings.redis_url)
@@ -1,27 +1,46 @@
 from datetime import datetime
+from typing import Literal
 
 from pydantic import BaseModel, Field
 
+Priority = Literal["high", "normal", "low"]
+
 
 class GeneratedImageBase(BaseModel):
     prompt: str
     negative_prompt: str | None
     num_steps: int = Field(50, gt=0, le=50)
+    seed: int | None = Field(None, ge=0, lt=2**31)
 
     class Config:
         orm_mode = True
 
 
 class GeneratedImageCreate(GeneratedImageBase):
-    pass
+    # By default, previews are high priority and other jobs are normal priority
+    priority: Priority | None = None
+    tenant: str = Field("default", regex=r"^[\w.-]{1,64}$")
 
 
 class GeneratedImageRead(GeneratedImageBase):
     id: int
+    priority: Priority
+    tenant: str
     created_at: datetime
     progress: int
     file_name: str | None
+    cancelled: bool
+
+
+class GeneratedImageProgress(BaseModel):
+    progress: int
+    file_name: str | None
+    cancelled: bool = False
+
+    class Config:
+        orm_mode = True
 
 
 class GeneratedImageURL(BaseModel):
     url: str
+    thumbnail_url: str | None
@@ -1,12 +1,38 @@
+from pathlib import Path
+from typing import Literal
+
 from pydantic import BaseSettings
 
+ImageFormat = Literal["PNG", "WEBP", "JPEG"]
+
 
 class Settings(BaseSettings):
     database_url: str
-    storage_endpoint: str
-    storage_access_key: str
-    storage_secret_key: str
+    storage_backend: Literal["minio", "filesystem"] = "minio"
     storage_bucket: str
+    # Minio backend
+    storage_endpoint: str = "localhost:9000"
+    storage_access_key: str = ""
+    storage_secret_key: str = ""
+    storage_region: str | None = None
+    storage_max_connections: int = 10
+    # Images bigger than this, uncompressed, are encoded and uploaded in parts
+    storage_multipart_threshold: int = 16 * 1024 * 1024
+    storage_part_size: int = 8 * 1024 * 1024
+    # Filesystem backend
+    storage_directory: Path = Path("storage")
+    storage_base_url: str = "/files"
+    image_format: ImageFormat = "PNG"
+    image_quality: int = 90
+    image_compress_level: int = 6
+    thumbnail_size: int | None = 256
+    redis_url: str = "redis://localhost:6379"
+    text_to_image_max_batch_size: int = 4
+    text_to_image_max_wait: float = 0.5
+    # Jobs with at most this number of steps are high priority by default
+    preview_max_steps: int = 10
+    # Attempts of a job, which is scheduled again after a failure
+    text_to_image_max_attempts: int = 3
 
     class Config:
         env_file = ".env"
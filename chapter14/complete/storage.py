@@ -1,48 +1,271 @@
-import io
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from pathlib import Path
 
+import certifi
+import urllib3
 from minio import Minio
+from minio.error import S3Error
 from PIL.Image import Image
 
+from chapter14.complete.cache import LRUCache
+from chapter14.complete.encoding import (
+    ImageEncoding,
+    get_thumbnail_name,
+    image_encoding,
+)
 from chapter14.complete.settings import settings
 
 
-class Storage:
-    def __init__(self) -> None:
-        self.client = Minio(
+class Storage(ABC):
+    """
+    Storage backend of the generated images, meant to be shared by the whole process.
+    """
+
+    encoding: ImageEncoding
+
+    def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def upload_image(self, image: Image, bucket_name: str) -> str:
+        """Stores the image and its thumbnail, returns the object name of the image"""
+
+    @abstractmethod
+    def get_url(self, object_name: str, bucket_name: str) -> str:
+        ...
+
+
+class MinioStorage(Storage):
+    """
+    Object storage client.
+
+    Its connection pool is reused across requests, the existing buckets
+    are only checked once and the presigned URLs are reused until
+    `presigned_url_margin` before they expire.
+
+    Images bigger than `multipart_threshold`, uncompressed, are encoded while
+    being uploaded in parts, so the whole encoded image is never in memory.
+    """
+
+    def __init__(
+        self,
+        *,
+        client: Minio | None = None,
+        max_connections: int = 10,
+        encoding: ImageEncoding = image_encoding,
+        multipart_threshold: int = 16 * 1024 * 1024,
+        part_size: int = 8 * 1024 * 1024,
+        presigned_url_margin: timedelta = timedelta(hours=1),
+        presigned_url_cache_size: int = 1024,
+    ) -> None:
+        # Same as the Minio defaults, with a configurable pool size
+        timeout = timedelta(minutes=5).seconds
+        self.http_client = urllib3.PoolManager(
+            timeout=urllib3.util.Timeout(connect=timeout, read=timeout),
+            maxsize=max_connections,
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            retries=urllib3.Retry(
+                total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+            ),
+        )
+        self.client = client or Minio(
             settings.storage_endpoint,
             access_key=settings.storage_access_key,
             secret_key=settings.storage_secret_key,
+            # Otherwise, it's looked up on the server
+            region=settings.storage_region,
+            http_client=self.http_client,
         )
+        self.encoding = encoding
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.presigned_url_margin = presigned_url_margin
+        self.existing_buckets: set[str] = set()
+        self._buckets_lock = threading.Lock()
+        # URL and the monotonic time until which it can be served, by object
+        self.presigned_urls_cache: LRUCache[
+            tuple[str, str, timedelta], tuple[str, float]
+        ] = LRUCache(maxsize=presigned_url_cache_size)
+
+    def close(self) -> None:
+        self.http_client.clear()
 
     def ensure_bucket(self, bucket_name: str):
-        bucket_exists = self.client.bucket_exists(bucket_name)
-        if not bucket_exists:
-            self.client.make_bucket(bucket_name)
+        if bucket_name in self.existing_buckets:
+            return
+        with self._buckets_lock:
+            if bucket_name in self.existing_buckets:
+                return
+            bucket_exists = self.client.bucket_exists(bucket_name)
+            if not bucket_exists:
+                try:
+                    self.client.make_bucket(bucket_name)
+                except S3Error as e:
+                    # Created by another process in the meantime
+                    if e.code != "BucketAlreadyOwnedByYou":
+                        raise
+            self.existing_buckets.add(bucket_name)
 
-    def upload_image(self, image: Image, object_name: str, bucket_name: str):
+    def upload_image(self, image: Image, bucket_name: str) -> str:
         self.ensure_bucket(bucket_name)
+        object_name = f"{uuid.uuid4()}.{self.encoding.extension}"
 
-        image_data = io.BytesIO()
-        image.save(image_data, format="PNG")
-        image_data.seek(0)
-        image_data_length = len(image_data.getvalue())
+        thumbnail = self.encoding.thumbnail(image)
+        if (
+            image.width * image.height * len(image.getbands())
+            > self.multipart_threshold
+        ):
+            self._upload_streaming(image, object_name, bucket_name)
+        else:
+            self._upload(image, object_name, bucket_name)
+        if thumbnail is not None:
+            self._upload(thumbnail, get_thumbnail_name(object_name), bucket_name)
+        return object_name
 
+    def _upload(self, image: Image, object_name: str, bucket_name: str):
+        image_data, image_data_length = self.encoding.encode(image)
         self.client.put_object(
             bucket_name,
             object_name,
             image_data,
             length=image_data_length,
-            content_type="image/png",
+            content_type=self.encoding.content_type,
         )
 
+    def _upload_streaming(self, image: Image, object_name: str, bucket_name: str):
+        read_fd, write_fd = os.pipe()
+
+        def encode():
+            with open(write_fd, "wb") as writer:
+                self.encoding.write(image, writer)
+
+        with ThreadPoolExecutor(1) as executor:
+            # Closed before waiting for the encoder, so it can't block on the pipe
+            with open(read_fd, "rb") as reader:
+                encoded = executor.submit(encode)
+                self.client.put_object(
+                    bucket_name,
+                    object_name,
+                    reader,
+                    length=-1,
+                    part_size=self.part_size,
+                    content_type=self.encoding.content_type,
+                )
+        try:
+            encoded.result()
+        except Exception:
+            # The upload completed with a truncated image
+            self.client.remove_object(bucket_name, object_name)
+            raise
+
+    def get_url(self, object_name: str, bucket_name: str) -> str:
+        return self.get_presigned_url(object_name, bucket_name)
+
     def get_presigned_url(
         self,
         object_name: str,
         bucket_name: str,
         *,
-        expires: timedelta = timedelta(days=7)
+        expires: timedelta = timedelta(days=7),
     ) -> str:
-        return self.client.presigned_get_object(
+        key = (bucket_name, object_name, expires)
+        cached = self.presigned_urls_cache.get(key)
+        if cached is not None:
+            url, valid_until = cached
+            if time.monotonic() < valid_until:
+                return url
+
+        url = self.client.presigned_get_object(
             bucket_name, object_name, expires=expires
         )
+        valid_for = (expires - self.presigned_url_margin).total_seconds()
+        if valid_for > 0:
+            self.presigned_urls_cache.set(key, (url, time.monotonic() + valid_for))
+        return url
+
+
+class FileSystemStorage(Storage):
+    """
+    Stores the images in a local directory, for single-node deployments and tests.
+
+    Files are named after the hash of their content and written atomically:
+    a file is either absent or complete, and never changes once written.
+    They are served by the API under `base_url`.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        *,
+        encoding: ImageEncoding = image_encoding,
+        base_url: str = "/files",
+    ) -> None:
+        self.directory = directory.resolve()
+        self.encoding = encoding
+        self.base_url = base_url
+
+    def get_path(self, object_name: str, bucket_name: str) -> Path:
+        """Raises `ValueError` if the path is outside of the storage directory"""
+        path = (self.directory / bucket_name / object_name).resolve()
+        if not path.is_relative_to(self.directory):
+            raise ValueError("Path is outside of the storage directory")
+        return path
+
+    def upload_image(self, image: Image, bucket_name: str) -> str:
+        image_data, _ = self.encoding.encode(image)
+        with image_data.getbuffer() as buffer:
+            digest = hashlib.sha256(buffer).hexdigest()
+            object_name = f"{digest}.{self.encoding.extension}"
+            self._write(self.get_path(object_name, bucket_name), buffer)
+
+        thumbnail = self.encoding.thumbnail(image)
+        if thumbnail is not None:
+            thumbnail_data, _ = self.encoding.encode(thumbnail)
+            with thumbnail_data.getbuffer() as buffer:
+                self._write(
+                    self.get_path(get_thumbnail_name(object_name), bucket_name), buffer
+                )
+        return object_name
+
+    def get_url(self, object_name: str, bucket_name: str) -> str:
+        return f"{self.base_url}/{bucket_name}/{object_name}"
+
+    def _write(self, path: Path, data: memoryview) -> None:
+        # Same name, same content: it's already there
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # In the same directory, so the rename is atomic
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, prefix=".", suffix=".tmp", delete=False
+        ) as file:
+            try:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, path)
+
+
+def create_storage() -> Storage:
+    """Storage backend selected in the settings"""
+    if settings.storage_backend == "filesystem":
+        return FileSystemStorage(
+            settings.storage_directory, base_url=settings.storage_base_url
+        )
+    return MinioStorage(
+        max_connections=settings.storage_max_connections,
+        multipart_threshold=settings.storage_multipart_threshold,
+        part_size=settings.storage_part_size,
+    )
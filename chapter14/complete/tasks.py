@@ -0,0 +1,24 @@
+"""
+Sends the worker tasks, from the API.
+
+Messages are routed by actor name: the API process never imports
+the actual implementation, nor torch and diffusers. No actor is declared
+here, so it can't replace the real one in a process importing both.
+"""
+
+from dramatiq import Message
+
+from chapter14.complete.broker import redis_broker
+
+
+def send_text_to_image_task() -> Message:
+    """Same as `chapter14.complete.worker.text_to_image_task.send`"""
+    return redis_broker.enqueue(
+        Message(
+            queue_name="default",
+            actor_name="text_to_image_task",
+            args=(),
+            kwargs={},
+            options={},
+        )
+    )
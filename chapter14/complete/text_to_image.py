@@ -4,10 +4,18 @@ import torch
 from diffusers import StableDiffusionPipeline
 from PIL import Image
 
+from chapter14.complete.cache import LRUCache
+
 
 class TextToImage:
     pipe: StableDiffusionPipeline | None = None
 
+    def __init__(self, *, prompt_cache_size: int = 128) -> None:
+        # Text encoder outputs, by prompt
+        self.prompt_embeds_cache: LRUCache[str, torch.FloatTensor] = LRUCache(
+            maxsize=prompt_cache_size
+        )
+
     def load_model(self) -> None:
         # Enable CUDA GPU
         if torch.cuda.is_available():
@@ -29,14 +37,67 @@ class TextToImage:
         *,
         negative_prompt: str | None = None,
         num_steps: int = 50,
+        seed: int | None = None,
         callback: Callable[[int, int, torch.FloatTensor], None] | None = None
     ) -> Image.Image:
+        return self.generate_batch(
+            [prompt],
+            negative_prompts=[negative_prompt],
+            num_steps=num_steps,
+            seeds=[seed],
+            callback=callback,
+        )[0]
+
+    def generate_batch(
+        self,
+        prompts: list[str],
+        *,
+        negative_prompts: list[str | None],
+        num_steps: int = 50,
+        seeds: list[int | None],
+        callback: Callable[[int, int, torch.FloatTensor], None] | None = None
+    ) -> list[Image.Image]:
+        """Generates several images with the same number of steps in a single pass"""
         if not self.pipe:
             raise RuntimeError("Pipeline is not loaded")
         return self.pipe(
-            prompt,
-            negative_prompt=negative_prompt,
+            prompt_embeds=torch.cat([self.encode_prompt(prompt) for prompt in prompts]),
+            # Same as the unconditional embeddings the pipeline would compute
+            negative_prompt_embeds=torch.cat(
+                [
+                    self.encode_prompt(negative_prompt or "")
+                    for negative_prompt in negative_prompts
+                ]
+            ),
             num_inference_steps=num_steps,
             guidance_scale=9.0,
+            # One generator per image, so each seed gives the same image as alone
+            generator=[get_generator(seed) for seed in seeds],
             callback=callback,
-        ).images[0]
+        ).images
+
+    def encode_prompt(self, prompt: str) -> torch.FloatTensor:
+        """Runs the text encoder, or returns its cached output for this prompt"""
+        if not self.pipe:
+            raise RuntimeError("Pipeline is not loaded")
+        prompt_embeds = self.prompt_embeds_cache.get(prompt)
+        if prompt_embeds is None:
+            with torch.no_grad():
+                prompt_embeds = self.pipe._encode_prompt(
+                    prompt,
+                    self.pipe.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=False,
+                )
+            self.prompt_embeds_cache.set(prompt, prompt_embeds)
+        return prompt_embeds
+
+
+def get_generator(seed: int | None) -> torch.Generator:
+    # Generated on CPU, so a seed gives the same image whatever the device
+    generator = torch.Generator()
+    if seed is not None:
+        generator.manual_seed(seed)
+    else:
+        generator.seed()
+    return generator
@@ -1,15 +1,16 @@
-import asyncio
-import uuid
-
 import dramatiq
-from dramatiq.brokers.redis import RedisBroker
 from dramatiq.middleware.middleware import Middleware
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from chapter14.complete.database import async_session_maker
+from chapter14.complete.batching import DiffusionBatcher, JobCancelled
+from chapter14.complete.broker import redis_broker
+from chapter14.complete.database import close_database_runner, get_database_runner
 from chapter14.complete.models import GeneratedImage
+from chapter14.complete.progress import ProgressReporter, progress_channel
+from chapter14.complete.scheduling import ScheduledJob, job_scheduler
 from chapter14.complete.settings import settings
-from chapter14.complete.storage import Storage
+from chapter14.complete.storage import create_storage
 from chapter14.complete.text_to_image import TextToImage
 
 
@@ -17,70 +18,124 @@ class TextToImageMiddleware(Middleware):
     def __init__(self) -> None:
         super().__init__()
         self.text_to_image = TextToImage()
+        self.batcher = DiffusionBatcher(
+            self.text_to_image,
+            max_batch_size=settings.text_to_image_max_batch_size,
+            max_wait=settings.text_to_image_max_wait,
+        )
 
     def after_process_boot(self, broker):
         self.text_to_image.load_model()
+        self.batcher.start()
         return super().after_process_boot(broker)
 
+    def before_process_stop(self, broker):
+        self.batcher.stop()
+        return super().before_process_stop(broker)
 
-text_to_image_middleware = TextToImageMiddleware()
-redis_broker = RedisBroker(host="localhost")
-redis_broker.add_middleware(text_to_image_middleware)
-dramatiq.set_broker(redis_broker)
-
-
-def get_image(id: int) -> GeneratedImage:
-    async def _get_image(id: int) -> GeneratedImage:
-        async with async_session_maker() as session:
-            select_query = select(GeneratedImage).where(GeneratedImage.id == id)
-            result = await session.execute(select_query)
-            image = result.scalar_one_or_none()
-
-            if image is None:
-                raise Exception("Image does not exist")
-
-            return image
-
-    return asyncio.run(_get_image(id))
-
-
-def update_progress(image: GeneratedImage, step: int):
-    async def _update_progress(image: GeneratedImage, step: int):
-        async with async_session_maker() as session:
-            image.progress = int((step / image.num_steps) * 100)
-            session.add(image)
-            await session.commit()
 
-    asyncio.run(_update_progress(image, step))
+class DatabaseRunnerMiddleware(Middleware):
+    def before_worker_thread_shutdown(self, broker, thread):
+        close_database_runner()
 
 
-def update_file_name(image: GeneratedImage, file_name: str):
-    async def _update_progress(image: GeneratedImage, file_name: str):
-        async with async_session_maker() as session:
-            image.file_name = file_name
-            session.add(image)
-            await session.commit()
-
-    asyncio.run(_update_progress(image, file_name))
-
-
-@dramatiq.actor()
-def text_to_image_task(image_id: int):
-    image = get_image(image_id)
-
-    def callback(step: int, _timestep, _tensor):
-        update_progress(image, step)
-
-    image_output = text_to_image_middleware.text_to_image.generate(
-        image.prompt,
-        negative_prompt=image.negative_prompt,
-        num_steps=image.num_steps,
-        callback=callback,
-    )
-
-    file_name = f"{uuid.uuid4()}.png"
-
-    storage = Storage()
-    storage.upload_image(image_output, file_name, settings.storage_bucket)
-
-    update_file_name(image, file_name)
+text_to_image_middleware = TextToImageMiddleware()
+redis_broker.add_middleware(text_to_image_middleware)
+redis_broker.add_middleware(DatabaseRunnerMiddleware())
+
+# Shared by the worker threads, to reuse its connections
+storage = create_storage()
+
+
+async def get_image(session: AsyncSession, id: int) -> GeneratedImage:
+    select_query = select(GeneratedImage).where(GeneratedImage.id == id)
+    result = await session.execute(select_query)
+    image = result.scalar_one_or_none()
+
+    if image is None:
+        raise Exception("Image does not exist")
+
+    return image
+
+
+async def update_progress(session: AsyncSession, image: GeneratedImage, progress: int):
+    image.progress = progress
+    session.add(image)
+    await session.commit()
+
+
+async def update_file_name(
+    session: AsyncSession, image: GeneratedImage, file_name: str
+):
+    image.file_name = file_name
+    image.progress = 100
+    session.add(image)
+    await session.commit()
+
+
+# Must match the message sent in tasks.py
+@dramatiq.actor(actor_name="text_to_image_task")
+def text_to_image_task():
+    # Messages are tokens: runs the job the scheduler tells to run now
+    job = job_scheduler.dequeue()
+    if job is None:
+        return
+    try:
+        generate_image(job.image_id)
+    except JobCancelled as e:
+        # Not a failure: frees the worker, without retry
+        job_scheduler.record_cancellation(job, e.saved_steps, e.discarded_steps)
+    except Exception:
+        attempts = job.attempts + 1
+        if attempts < settings.text_to_image_max_attempts:
+            # Picked by the retry of this message, or by another one
+            job_scheduler.enqueue(
+                ScheduledJob(job.image_id, job.priority, job.tenant, attempts=attempts)
+            )
+        raise
+
+
+def generate_image(image_id: int):
+    # The event loop and the connection are reused across steps and tasks
+    database = get_database_runner()
+    session = database.session_maker()
+    try:
+        image = database.run(get_image(session, image_id))
+        # Cancelled while queued
+        if image.cancelled:
+            raise JobCancelled(saved_steps=image.num_steps)
+
+        progress_reporter = ProgressReporter(
+            image.id,
+            image.num_steps,
+            channel=progress_channel,
+            # Called in the batcher thread: the session belongs to this one
+            persist=lambda progress: text_to_image_middleware.batcher.run_in_caller(
+                lambda: database.run(update_progress(session, image, progress))
+            ),
+        )
+
+        def callback(step: int, _timestep, _tensor):
+            # Cancelled while running: the batcher counts the steps it saved
+            if progress_channel.is_cancelled(image.id):
+                raise JobCancelled()
+            progress_reporter.report(step + 1)
+
+        # Batched with the jobs of the other worker threads
+        image_output = text_to_image_middleware.batcher.generate(
+            image.prompt,
+            negative_prompt=image.negative_prompt,
+            num_steps=image.num_steps,
+            seed=image.seed,
+            callback=callback,
+        )
+
+        if progress_channel.is_cancelled(image.id):
+            raise JobCancelled(discarded_steps=image.num_steps)
+
+        file_name = storage.upload_image(image_output, settings.storage_bucket)
+
+        database.run(update_file_name(session, image, file_name))
+        progress_reporter.complete(file_name)
+    finally:
+        database.run(session.close())
@@ -1,5 +1,8 @@
 import asyncio
+import os
+import tempfile
 from collections.abc import AsyncGenerator
+from pathlib import Path
 
 import httpx
 import pytest
@@ -8,6 +11,16 @@ from asgi_lifespan import LifespanManager
 from fastapi import FastAPI
 from httpx_ws.transport import ASGIWebSocketTransport
 
+# chapter14.complete reads its settings from the environment when imported
+os.environ.setdefault(
+    "DATABASE_URL",
+    f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / 'chapter14.db'}",
+)
+os.environ.setdefault("STORAGE_ENDPOINT", "localhost:9000")
+os.environ.setdefault("STORAGE_ACCESS_KEY", "ACCESS_KEY")
+os.environ.setdefault("STORAGE_SECRET_KEY", "SECRET_KEY")
+os.environ.setdefault("STORAGE_BUCKET", "chapter14")
+
 
 @pytest.fixture(scope="session")
 def event_loop():
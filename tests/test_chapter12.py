@@ -1,15 +1,31 @@
+import asyncio
+import json
+import threading
+import time
+from pathlib import Path
+
 import httpx
 import joblib
+import numpy
 import pytest
 from fastapi import status
-from sklearn.pipeline import Pipeline
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.pipeline import Pipeline, make_pipeline
 
+from chapter12.batching import MicroBatcher
+from chapter12.cache import LRUCache
 from chapter12.chapter12_async_not_async import app as chapter12_async_not_async_app
 from chapter12.chapter12_caching import app as chapter12_caching_app
-from chapter12.chapter12_caching import memory
+from chapter12.chapter12_caching import clear_caches, memory, memory_cache
+from chapter12.chapter12_caching import newgroups_model as caching_newsgroups_model
+from chapter12.chapter12_prediction_endpoint import MODEL_FILE, NewsgroupsModel
 from chapter12.chapter12_prediction_endpoint import (
     app as chapter12_prediction_endpoint_app,
 )
+from chapter12.compiled_export import export_pipeline
+from chapter12.compiled_model import CompiledPipeline
+from chapter12.executor import InferenceExecutor, InferenceQueueFull
 
 
 def test_chapter12_dump_joblib() -> None:
@@ -35,6 +51,92 @@ def test_chapter12_load_joblib() -> None:
     }
 
 
+def test_chapter12_load_model_mmap() -> None:
+    model = NewsgroupsModel(mmap_mode="r")
+    model.load_model()
+
+    assert model.model is not None
+    assert isinstance(model.model[-1].feature_log_prob_, numpy.memmap)
+
+
+@pytest.mark.parametrize("mode", ["default", "mmap", "preload"])
+def test_chapter12_benchmark_model_loading(mode: str) -> None:
+    from chapter12.chapter12_benchmark_model_loading import benchmark
+
+    results = benchmark(mode, num_workers=2)
+
+    assert len(results) == 2
+    for result in results:
+        assert result["load_time"] > 0
+        assert 0 < result["pss"] <= result["rss"]
+
+
+class TestChapter12CompiledModel:
+    texts = [
+        "computer cpu memory ram",
+        "God bless the Mac, and its ENCRYPTION key!",
+        "Ünïcode café résumé",
+        "",
+        "zzzz qqqq",
+        "The clipper chip is an NSA escrow scheme. Jesus said love thy neighbour.",
+    ]
+
+    @pytest.fixture(scope="class")
+    def models(
+        self, tmp_path_factory: pytest.TempPathFactory
+    ) -> tuple[Pipeline, CompiledPipeline, list[str], Path]:
+        loaded_model: tuple[Pipeline, list[str]] = joblib.load(MODEL_FILE)
+        model, targets = loaded_model
+        artifact_file = tmp_path_factory.mktemp("compiled") / "newsgroups_model.npz"
+        export_pipeline(model, targets, artifact_file)
+        compiled_model, compiled_targets = CompiledPipeline.load(artifact_file)
+        assert compiled_targets == targets
+        return model, compiled_model, targets, artifact_file
+
+    def test_transform(self, models):
+        model, compiled_model, _, _ = models
+        assert numpy.allclose(
+            model[0].transform(self.texts).toarray(),
+            compiled_model.transform(self.texts).toarray(),
+            rtol=0,
+            atol=1e-12,
+        )
+
+    def test_predict(self, models):
+        model, compiled_model, _, _ = models
+        assert numpy.array_equal(
+            model.predict(self.texts), compiled_model.predict(self.texts)
+        )
+
+    def test_predict_proba(self, models):
+        model, compiled_model, _, _ = models
+        assert numpy.allclose(
+            model.predict_proba(self.texts),
+            compiled_model.predict_proba(self.texts),
+            rtol=0,
+            atol=1e-12,
+        )
+
+    def test_newsgroups_model(self, models):
+        model, _, targets, artifact_file = models
+        newsgroups_model = NewsgroupsModel(model_file=str(artifact_file))
+        newsgroups_model.load_model()
+
+        assert isinstance(newsgroups_model.model, CompiledPipeline)
+        assert newsgroups_model.targets == targets
+        assert (
+            newsgroups_model.predict_batch(self.texts)
+            == model.predict(self.texts).tolist()
+        )
+
+    def test_unsupported_pipeline(self, tmp_path: Path):
+        model = make_pipeline(TfidfVectorizer(ngram_range=(1, 2)), MultinomialNB())
+        model.fit(["a first document", "another one"], [0, 1])
+
+        with pytest.raises(ValueError):
+            export_pipeline(model, ["first", "second"], tmp_path / "model.npz")
+
+
 @pytest.mark.fastapi(app=chapter12_prediction_endpoint_app)
 @pytest.mark.asyncio
 class TestChapter12PredictionEndpoint:
@@ -52,6 +154,184 @@ class TestChapter12PredictionEndpoint:
         json = response.json()
         assert json == {"category": "comp.sys.mac.hardware"}
 
+    async def test_concurrent_payloads(self, client: httpx.AsyncClient):
+        texts = ["computer cpu memory ram", "god jesus church bible"] * 10
+        responses = await asyncio.gather(
+            *(client.post("/prediction", json={"text": text}) for text in texts)
+        )
+
+        for text, response in zip(texts, responses):
+            assert response.status_code == status.HTTP_200_OK
+            expected = (
+                "comp.sys.mac.hardware"
+                if text.startswith("computer")
+                else "soc.religion.christian"
+            )
+            assert response.json() == {"category": expected}
+
+    async def test_predictions_ndjson(self, client: httpx.AsyncClient):
+        lines = [
+            '{"text": "computer cpu memory ram"}',
+            "",
+            "INVALID",
+            '{"text": "god jesus church bible"}',
+        ] * 5
+
+        async def body():
+            for line in lines:
+                yield (line + "\n").encode()
+
+        response = await client.post(
+            "/predictions",
+            params={"chunk_size": 3},
+            content=body(),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert len(results) == 15
+        for i in range(0, 15, 3):
+            assert results[i] == {"category": "comp.sys.mac.hardware"}
+            assert "error" in results[i + 1]
+            assert results[i + 2] == {"category": "soc.religion.christian"}
+
+    async def test_predictions_invalid_chunk_size(self, client: httpx.AsyncClient):
+        response = await client.post("/predictions", params={"chunk_size": 0})
+
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+class TestChapter12MicroBatcher:
+    async def test_coalesce(self):
+        batches: list[list[int]] = []
+
+        async def batch_function(items: list[int]) -> list[int]:
+            batches.append(items)
+            return [item * 2 for item in items]
+
+        batcher: MicroBatcher[int, int] = MicroBatcher(
+            batch_function, max_batch_size=4, max_wait=0.05
+        )
+        await batcher.start()
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+        await batcher.stop()
+
+        assert results == [i * 2 for i in range(10)]
+        assert [len(batch) for batch in batches] == [4, 4, 2]
+
+    async def test_max_concurrency(self):
+        batches: list[list[int]] = []
+
+        async def batch_function(items: list[int]) -> list[int]:
+            batches.append(items)
+            await asyncio.sleep(0.05)
+            return items
+
+        batcher: MicroBatcher[int, int] = MicroBatcher(
+            batch_function, max_batch_size=16, max_wait=0, max_concurrency=1
+        )
+        await batcher.start()
+        first = asyncio.create_task(batcher.submit(0))
+        await asyncio.sleep(0.01)
+        # Those pile up while the first batch is running
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(1, 6)))
+        await first
+        await batcher.stop()
+
+        assert results == [1, 2, 3, 4, 5]
+        assert batches == [[0], [1, 2, 3, 4, 5]]
+
+    async def test_exception(self):
+        async def batch_function(items: list[int]) -> list[int]:
+            raise ValueError()
+
+        batcher: MicroBatcher[int, int] = MicroBatcher(batch_function)
+        await batcher.start()
+        with pytest.raises(ValueError):
+            await batcher.submit(1)
+        await batcher.stop()
+
+    async def test_not_started(self):
+        async def batch_function(items: list[int]) -> list[int]:
+            return items
+
+        batcher: MicroBatcher[int, int] = MicroBatcher(batch_function)
+        with pytest.raises(RuntimeError):
+            await batcher.submit(1)
+
+
+@pytest.mark.asyncio
+class TestChapter12InferenceExecutor:
+    async def test_run_in_thread(self):
+        executor = InferenceExecutor(max_workers=2)
+        executor.register("model", max_concurrency=1)
+        executor.start()
+
+        def blocking() -> str:
+            time.sleep(0.2)
+            return threading.current_thread().name
+
+        task = asyncio.create_task(executor.run("model", blocking))
+        # The event loop is still free while the inference runs
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        assert executor.pending("model") == 1
+
+        thread_name = await task
+        assert thread_name.startswith("inference")
+        assert executor.pending("model") == 0
+        executor.shutdown()
+
+    async def test_concurrency_limit(self):
+        executor = InferenceExecutor(max_workers=4)
+        executor.register("model", max_concurrency=2, max_queue_size=8)
+        executor.start()
+
+        running = 0
+        max_running = 0
+        lock = threading.Lock()
+
+        def blocking() -> None:
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            time.sleep(0.05)
+            with lock:
+                running -= 1
+
+        await asyncio.gather(*(executor.run("model", blocking) for _ in range(6)))
+        assert max_running == 2
+        executor.shutdown()
+
+    async def test_queue_full(self):
+        executor = InferenceExecutor(max_workers=1)
+        executor.register("model", max_concurrency=1, max_queue_size=2)
+        executor.start()
+
+        results = await asyncio.gather(
+            *(executor.run("model", time.sleep, 0.05) for _ in range(3)),
+            return_exceptions=True,
+        )
+        assert isinstance(results[2], InferenceQueueFull)
+        executor.shutdown()
+
+    async def test_not_started(self):
+        executor = InferenceExecutor()
+        executor.register("model")
+        with pytest.raises(RuntimeError):
+            await executor.run("model", time.sleep, 0)
+
+    async def test_unknown_model(self):
+        executor = InferenceExecutor()
+        executor.start()
+        with pytest.raises(KeyError):
+            await executor.run("model", time.sleep, 0)
+        executor.shutdown()
+
 
 @pytest.mark.fastapi(app=chapter12_caching_app)
 @pytest.mark.asyncio
@@ -73,11 +353,114 @@ class TestChapter12Caching:
             json = response.json()
             assert json == {"category": "comp.sys.mac.hardware"}
 
+    async def test_cache_stats(self, client: httpx.AsyncClient):
+        clear_caches()
+        response = await client.get("/cache/stats")
+        before = response.json()
+
+        for _ in range(3):
+            response = await client.post("/prediction", json={"text": "sci crypt"})
+            assert response.status_code == status.HTTP_200_OK
+
+        response = await client.get("/cache/stats")
+        assert response.status_code == status.HTTP_200_OK
+        after = response.json()
+        assert after["memory"]["hits"] - before["memory"]["hits"] == 2
+        assert after["memory"]["misses"] - before["memory"]["misses"] == 1
+        assert after["disk"]["misses"] - before["disk"]["misses"] == 1
+
     async def test_delete_cache(self, client: httpx.AsyncClient):
         response = await client.delete("/cache")
 
         assert response.status_code == status.HTTP_204_NO_CONTENT
 
+    async def test_reload_model(self, client: httpx.AsyncClient):
+        response = await client.get("/model")
+        assert response.status_code == status.HTTP_200_OK
+        fingerprint = response.json()["fingerprint"]
+        assert fingerprint is not None
+
+        response = await client.post("/model/reload")
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        response = await client.get("/model")
+        json = response.json()
+        assert json["reloading"] is False
+        assert json["fingerprint"] == fingerprint
+        last_reload = json["last_reload"]
+        assert last_reload["fingerprint"] == fingerprint
+        assert last_reload["load_time"] > 0
+        assert last_reload["swap_latency"] >= 0
+
+    async def test_reload_model_already_reloading(self, client: httpx.AsyncClient):
+        # Reserved by another request whose background task didn't run yet
+        assert caching_newsgroups_model.begin_reload()
+        try:
+            response = await client.post("/model/reload")
+            assert response.status_code == status.HTTP_409_CONFLICT
+
+            response = await client.get("/model")
+            assert response.json()["reloading"] is True
+        finally:
+            caching_newsgroups_model.finish_reload()
+
+        response = await client.post("/model/reload")
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+    async def test_reload_model_invalidate_cache(self, client: httpx.AsyncClient):
+        response = await client.post("/prediction", json={"text": "sci crypt"})
+        assert response.status_code == status.HTTP_200_OK
+
+        # Simulate a previous model version
+        loaded_model = caching_newsgroups_model.loaded_model
+        assert loaded_model is not None
+        memory_cache.set(("OLD_FINGERPRINT", "sci crypt"), 0)
+        loaded_model.fingerprint = "OLD_FINGERPRINT"
+
+        response = await client.post("/model/reload")
+        assert response.status_code == status.HTTP_202_ACCEPTED
+
+        response = await client.get("/model")
+        json = response.json()
+        assert json["fingerprint"] != "OLD_FINGERPRINT"
+        assert json["last_reload"]["invalidated_entries"] == 1
+
+        response = await client.post("/prediction", json={"text": "sci crypt"})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"category": "sci.crypt"}
+
+
+class TestChapter12LRUCache:
+    def test_eviction(self):
+        cache: LRUCache[str, int] = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.stats() == {"size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+    def test_ttl(self):
+        cache: LRUCache[str, int] = LRUCache(ttl=0.05)
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+        time.sleep(0.1)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_invalidate(self):
+        cache: LRUCache[tuple[str, str], int] = LRUCache()
+        cache.set(("v1", "a"), 1)
+        cache.set(("v1", "b"), 2)
+        cache.set(("v2", "a"), 3)
+
+        assert cache.invalidate(lambda key: key[0] == "v1") == 2
+        assert cache.get(("v1", "a")) is None
+        assert cache.get(("v2", "a")) == 3
+
 
 @pytest.mark.fastapi(app=chapter12_async_not_async_app)
 @pytest.mark.asyncio
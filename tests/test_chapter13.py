@@ -1,20 +1,244 @@
 import asyncio
+import json
+import time
 from pathlib import Path
 
 import httpx
+import numpy as np
 import pytest
+import torch
 from fastapi import status
 from httpx_ws import aconnect_ws
+from PIL import Image
+from transformers import YolosConfig, YolosForObjectDetection, YolosImageProcessor
 
+from chapter13.batching import MicroBatcher
+from chapter13.chapter13_api import ObjectDetection, Objects
 from chapter13.chapter13_api import app as chapter13_api_app
+from chapter13.chapter13_benchmark_runtime import agreement, benchmark
+from chapter13.frame_skipping import FrameChangeDetector, FrameSkippingStats
+from chapter13.postprocessing import Detections, post_process
+from chapter13.preprocessing import FramePreprocessor
+from chapter13.runtime import RuntimeSettings, configure_threads, optimize_model
+from chapter13.websocket_object_detection.app import (
+    FrameRateMeter,
+    frame_skipping_stats,
+)
 from chapter13.websocket_object_detection.app import (
     app as chapter13_websocket_object_detection_app,
 )
 
 coffee_shop_image_file = Path(__file__).parent.parent / "assets" / "coffee-shop.jpg"
+cat_image_file = Path(__file__).parent.parent / "assets" / "cat.jpg"
 detected_labels = {"person", "couch", "chair", "laptop", "dining table"}
 
 
+def load_tiny_object_detection(settings: RuntimeSettings) -> ObjectDetection:
+    """Randomly initialized YOLOS model, small enough to be built locally"""
+    torch.manual_seed(0)
+    config = YolosConfig(
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        image_size=[64, 64],
+        num_detection_tokens=10,
+        id2label={i: f"label{i}" for i in range(4)},
+    )
+    object_detection = ObjectDetection(settings)
+    object_detection.image_processor = YolosImageProcessor(
+        size={"shortest_edge": 64, "longest_edge": 96}
+    )
+    object_detection.frame_preprocessor = FramePreprocessor(
+        object_detection.image_processor
+    )
+    object_detection.model = optimize_model(YolosForObjectDetection(config), settings)
+    return object_detection
+
+
+class TestChapter13FramePreprocessor:
+    image_processor = YolosImageProcessor(
+        size={"shortest_edge": 512, "longest_edge": 1333}
+    )
+
+    def test_same_as_image_processor(self):
+        images = [Image.open(coffee_shop_image_file), Image.open(cat_image_file)]
+        for image in images:
+            image.load()
+        frame_preprocessor = FramePreprocessor(self.image_processor)
+
+        pixel_values, original_sizes = frame_preprocessor(images)
+
+        expected = self.image_processor(images=images, return_tensors="pt")
+        assert pixel_values.shape == expected["pixel_values"].shape
+        assert torch.allclose(pixel_values, expected["pixel_values"], atol=1e-5)
+        assert original_sizes == [image.size for image in images]
+
+    def test_draft(self):
+        frame_preprocessor = FramePreprocessor(self.image_processor)
+        image = Image.open(coffee_shop_image_file)
+        original_size = image.size
+
+        pixel_values, original_sizes = frame_preprocessor([image])
+
+        # Decoded at a reduced scale, but still resized to the model input size
+        assert image.size != original_size
+        assert original_sizes == [original_size]
+        width, height = frame_preprocessor.output_size(original_size)
+        assert pixel_values.shape == (1, 3, height, width)
+
+    def test_reuse_buffer(self):
+        frame_preprocessor = FramePreprocessor(self.image_processor)
+
+        first, _ = frame_preprocessor([Image.open(coffee_shop_image_file)])
+        second, _ = frame_preprocessor([Image.open(coffee_shop_image_file)])
+        assert first.data_ptr() == second.data_ptr()
+
+
+class TestChapter13PostProcessing:
+    def test_same_as_image_processor(self):
+        object_detection = load_tiny_object_detection(RuntimeSettings())
+        assert object_detection.image_processor is not None
+        assert object_detection.model is not None
+        images = [Image.open(coffee_shop_image_file), Image.open(cat_image_file)]
+        original_sizes = [image.size for image in images]
+        pixel_values = object_detection.image_processor(
+            images=images, return_tensors="pt"
+        )["pixel_values"]
+        with torch.inference_mode():
+            outputs = object_detection.model(pixel_values=pixel_values)
+
+        # Randomly initialized model: scores are low
+        batch_detections = post_process(
+            outputs.logits, outputs.pred_boxes, original_sizes, threshold=0.2
+        )
+
+        results = object_detection.image_processor.post_process_object_detection(
+            outputs,
+            threshold=0.2,
+            target_sizes=torch.tensor([size[::-1] for size in original_sizes]),
+        )
+        assert sum(len(detections) for detections in batch_detections) > 0
+        for detections, result in zip(batch_detections, results):
+            assert detections.label_ids.tolist() == result["labels"].tolist()
+            assert torch.allclose(
+                torch.from_numpy(detections.boxes), result["boxes"], atol=1e-3
+            )
+
+    def test_to_objects(self):
+        detections = Detections(
+            np.array([[0.0, 1.0, 2.0, 3.0]]), np.array([1], dtype=np.int64)
+        )
+        assert detections.to_objects(["a", "b"]) == [
+            {"box": [0.0, 1.0, 2.0, 3.0], "label": "b"}
+        ]
+
+    @pytest.mark.parametrize("num_objects", [0, 3])
+    def test_bytes(self, num_objects: int):
+        detections = Detections(
+            np.arange(num_objects * 4, dtype=np.float32).reshape(num_objects, 4),
+            np.arange(num_objects),
+        )
+
+        data = detections.to_bytes(credits=1, fps=12.5)
+        assert len(data) == 12 + num_objects * (4 * 4 + 2)
+
+        decoded, credits, fps = Detections.from_bytes(data)
+        assert credits == 1
+        assert fps == 12.5
+        assert np.array_equal(decoded.boxes, detections.boxes)
+        assert np.array_equal(decoded.label_ids, detections.label_ids)
+
+
+class TestChapter13Runtime:
+    def test_settings_from_env(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setenv("OBJECT_DETECTION_NUM_THREADS", "2")
+        monkeypatch.setenv("OBJECT_DETECTION_QUANTIZE", "true")
+
+        settings = RuntimeSettings()
+        assert settings.num_threads == 2
+        assert settings.num_interop_threads is None
+        assert settings.quantize is True
+
+    def test_configure_threads(self):
+        num_threads = torch.get_num_threads()
+        try:
+            configure_threads(RuntimeSettings(num_threads=1))
+            assert torch.get_num_threads() == 1
+        finally:
+            torch.set_num_threads(num_threads)
+
+    def test_quantize(self):
+        object_detection = load_tiny_object_detection(RuntimeSettings(quantize=True))
+
+        assert object_detection.model is not None
+        assert not object_detection.model.training
+        module_types = {type(module) for module in object_detection.model.modules()}
+        assert torch.ao.nn.quantized.dynamic.Linear in module_types
+        assert torch.nn.Linear not in module_types
+
+    @pytest.mark.parametrize("quantize", [False, True])
+    def test_predict(self, quantize: bool):
+        object_detection = load_tiny_object_detection(
+            RuntimeSettings(quantize=quantize)
+        )
+        image = Image.open(coffee_shop_image_file)
+
+        objects = object_detection.predict(image)
+        assert isinstance(objects, Objects)
+
+    def test_predict_decoded(self):
+        object_detection = load_tiny_object_detection(RuntimeSettings())
+        image_files = [coffee_shop_image_file, cat_image_file]
+
+        decoded = [object_detection.decode(open(file, "rb")) for file in image_files]
+        batch_objects = object_detection.predict_decoded(
+            [image for image, _ in decoded], [size for _, size in decoded]
+        )
+
+        assert [size for _, size in decoded] == [
+            Image.open(file).size for file in image_files
+        ]
+        assert len(batch_objects) == 2
+        for objects in batch_objects:
+            assert isinstance(objects, Objects)
+
+    def test_benchmark(self):
+        image = Image.open(coffee_shop_image_file)
+        configurations = {
+            "default": RuntimeSettings(),
+            "quantized": RuntimeSettings(quantize=True),
+        }
+
+        results = benchmark(
+            load_tiny_object_detection, image, configurations=configurations, runs=2
+        )
+        assert set(results) == {"default", "quantized"}
+        assert results["default"]["agreement"] == 1.0
+        for result in results.values():
+            assert result["mean_ms"] > 0
+            assert 0 <= result["agreement"] <= 1
+
+    def test_agreement(self):
+        reference = Objects.parse_obj(
+            {
+                "objects": [
+                    {"box": (0, 0, 10, 10), "label": "cat"},
+                    {"box": (20, 20, 30, 30), "label": "dog"},
+                ]
+            }
+        )
+        candidate = Objects.parse_obj(
+            {
+                "objects": [
+                    {"box": (1, 1, 10, 10), "label": "cat"},
+                    {"box": (20, 20, 30, 30), "label": "cat"},
+                ]
+            }
+        )
+        assert agreement(reference, candidate) == 0.5
+
+
 @pytest.mark.fastapi(app=chapter13_api_app)
 @pytest.mark.asyncio
 class TestChapter13API:
@@ -36,6 +260,39 @@ class TestChapter13API:
             assert "box" in object
             assert object["label"] in detected_labels
 
+    async def test_batch(self, client: httpx.AsyncClient):
+        files = [
+            ("images", ("coffee-shop.jpg", open(coffee_shop_image_file, "rb"))),
+            ("images", ("invalid.jpg", b"not an image")),
+            ("images", ("cat.jpg", open(cat_image_file, "rb"))),
+        ]
+        response = await client.post(
+            "/object-detection/batch", files=files, params={"batch_size": 2}
+        )
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [result["filename"] for result in results] == [
+            "coffee-shop.jpg",
+            "invalid.jpg",
+            "cat.jpg",
+        ]
+        assert len(results[0]["objects"]) > 0
+        for object in results[0]["objects"]:
+            assert object["label"] in detected_labels
+        assert "error" in results[1]
+        assert "objects" in results[2]
+
+    async def test_batch_invalid_batch_size(self, client: httpx.AsyncClient):
+        response = await client.post(
+            "/object-detection/batch",
+            files={"images": open(coffee_shop_image_file, "rb")},
+            params={"batch_size": 0},
+        )
+
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
 
 @pytest.mark.fastapi(app=chapter13_websocket_object_detection_app)
 @pytest.mark.asyncio
@@ -51,6 +308,52 @@ class TestChapter13WebSocketobjectDetection:
                     assert "box" in object
                     assert object["label"] in detected_labels
 
+    async def test_credits(self, client: httpx.AsyncClient):
+        async with aconnect_ws("/object-detection", client) as websocket:
+            with open(coffee_shop_image_file, "rb") as image:
+                image_bytes = image.read()
+            for i in range(3):
+                await websocket.send_bytes(image_bytes)
+                result = await websocket.receive_json()
+                assert result["credits"] == 1
+                if i == 0:
+                    assert result["fps"] == 0.0
+                else:
+                    assert result["fps"] > 0.0
+
+    async def test_binary(self, client: httpx.AsyncClient):
+        async with aconnect_ws(
+            "/object-detection", client, params={"format": "binary"}
+        ) as websocket:
+            labels = (await websocket.receive_json())["labels"]
+            with open(coffee_shop_image_file, "rb") as image:
+                await websocket.send_bytes(image.read())
+            detections, credits, fps = Detections.from_bytes(
+                await websocket.receive_bytes()
+            )
+            assert credits == 1
+            assert len(detections) > 0
+            for object in detections.to_objects(labels):
+                assert object["label"] in detected_labels
+
+    async def test_frame_skipping(self, client: httpx.AsyncClient):
+        stats_before = frame_skipping_stats.stats()
+        async with aconnect_ws("/object-detection", client) as websocket:
+            with open(coffee_shop_image_file, "rb") as image:
+                image_bytes = image.read()
+            results = []
+            for _ in range(3):
+                await websocket.send_bytes(image_bytes)
+                results.append(await websocket.receive_json())
+            assert results[1]["objects"] == results[0]["objects"]
+            assert results[2]["objects"] == results[0]["objects"]
+
+        response = await client.get("/frame-skipping/stats")
+        stats = response.json()
+        assert stats["detected"] == stats_before["detected"] + 1
+        assert stats["skipped"] == stats_before["skipped"] + 2
+        assert stats["saved_inference_time"] > 0
+
     async def test_backpressure(self, client: httpx.AsyncClient):
         QUEUE_LIMIT = 10
         async with aconnect_ws("/object-detection", client) as websocket:
@@ -62,3 +365,119 @@ class TestChapter13WebSocketobjectDetection:
                 assert result is not None
                 with pytest.raises(asyncio.TimeoutError):
                     await websocket.receive_json(timeout=0.1)
+
+    async def test_multiple_clients(self, client: httpx.AsyncClient):
+        async def detect_frames(image_bytes: bytes):
+            async with aconnect_ws("/object-detection", client) as websocket:
+                for _ in range(2):
+                    await websocket.send_bytes(image_bytes)
+                    result = await websocket.receive_json()
+                    objects = result["objects"]
+                    assert len(objects) > 0
+                    for object in objects:
+                        assert object["label"] in detected_labels
+
+        with open(coffee_shop_image_file, "rb") as image:
+            image_bytes = image.read()
+        await asyncio.gather(*(detect_frames(image_bytes) for _ in range(4)))
+
+    async def test_invalid_frame(self, client: httpx.AsyncClient):
+        with open(coffee_shop_image_file, "rb") as image:
+            image_bytes = image.read()
+
+        async def detect_frames():
+            async with aconnect_ws("/object-detection", client) as websocket:
+                for _ in range(3):
+                    await websocket.send_bytes(image_bytes)
+                    result = await websocket.receive_json()
+                    assert "objects" in result
+
+        async def send_invalid_frame():
+            async with aconnect_ws("/object-detection", client) as websocket:
+                await websocket.send_bytes(b"not an image")
+                result = await websocket.receive_json()
+                assert result["error"] == "Invalid frame"
+                assert result["credits"] == 1
+
+                # The connection is still usable
+                await websocket.send_bytes(image_bytes)
+                result = await websocket.receive_json()
+                assert "objects" in result
+
+        await asyncio.gather(detect_frames(), send_invalid_frame())
+
+
+@pytest.mark.asyncio
+class TestChapter13MicroBatcher:
+    async def test_item_exception(self):
+        async def batch_function(items: list[int]) -> list[int | Exception]:
+            return [ValueError() if item < 0 else item * 2 for item in items]
+
+        batcher: MicroBatcher[int, int] = MicroBatcher(batch_function, max_wait=0.05)
+        await batcher.start()
+        results = await asyncio.gather(
+            *(batcher.submit(i) for i in [1, -1, 2]), return_exceptions=True
+        )
+        await batcher.stop()
+
+        assert results[0] == 2
+        assert isinstance(results[1], ValueError)
+        assert results[2] == 4
+
+
+class TestChapter13FrameSkipping:
+    def test_static_frames(self):
+        frame_change_detector = FrameChangeDetector(refresh_interval=60)
+        with open(coffee_shop_image_file, "rb") as image:
+            image_bytes = image.read()
+
+        assert frame_change_detector.should_detect(image_bytes) is True
+        assert frame_change_detector.should_detect(image_bytes) is False
+
+    def test_changed_frames(self):
+        frame_change_detector = FrameChangeDetector(refresh_interval=60)
+        with open(coffee_shop_image_file, "rb") as image:
+            coffee_shop_bytes = image.read()
+        with open(cat_image_file, "rb") as image:
+            cat_bytes = image.read()
+
+        assert frame_change_detector.should_detect(coffee_shop_bytes) is True
+        assert frame_change_detector.should_detect(cat_bytes) is True
+        assert frame_change_detector.should_detect(cat_bytes) is False
+
+        frame_change_detector.reset()
+        assert frame_change_detector.should_detect(cat_bytes) is True
+
+    def test_refresh_interval(self):
+        frame_change_detector = FrameChangeDetector(refresh_interval=0.01)
+        with open(coffee_shop_image_file, "rb") as image:
+            image_bytes = image.read()
+
+        assert frame_change_detector.should_detect(image_bytes) is True
+        time.sleep(0.02)
+        assert frame_change_detector.should_detect(image_bytes) is True
+
+    def test_stats(self):
+        stats = FrameSkippingStats()
+        assert stats.stats()["skip_rate"] == 0.0
+
+        stats.record_detection(0.2)
+        stats.record_detection(0.4)
+        stats.record_skip()
+        stats.record_skip()
+
+        result = stats.stats()
+        assert result["frames"] == 4
+        assert result["skip_rate"] == 0.5
+        assert result["average_inference_time"] == pytest.approx(0.3)
+        assert result["saved_inference_time"] == pytest.approx(0.6)
+
+
+def test_frame_rate_meter():
+    frame_rate_meter = FrameRateMeter(window=3)
+    assert frame_rate_meter.fps == 0.0
+
+    for _ in range(5):
+        frame_rate_meter.tick()
+        time.sleep(0.01)
+    assert 0 < frame_rate_meter.fps <= 100
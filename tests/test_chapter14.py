@@ -1,16 +1,101 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
 from typing import Any
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import httpx
+import numpy as np
 import pytest
+import redis.asyncio
+import torch
+from diffusers import (
+    AutoencoderKL,
+    DDIMScheduler,
+    StableDiffusionPipeline,
+    UNet2DConditionModel,
+)
 from dramatiq import Message
 from fastapi import status
+from minio import Minio
 from PIL import Image
+from starlette.datastructures import Headers
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
 
 from chapter14.basic.api import app as chapter14_app
+from chapter14.basic.broker import redis_broker
 from chapter14.basic.text_to_image import TextToImage
-from chapter14.basic.worker import text_to_image_task
+from chapter14.chapter14_benchmark_progress_updates import benchmark
+from chapter14.complete import worker as complete_worker
+from chapter14.complete.api import app as chapter14_complete_app
+from chapter14.complete.api import (
+    get_job_scheduler,
+    get_progress_channel,
+    get_storage,
+)
+from chapter14.complete.batching import DiffusionBatcher, JobCancelled
+from chapter14.complete.broker import redis_broker as complete_redis_broker
+from chapter14.complete.cache import LRUCache
+from chapter14.complete.database import (
+    async_session_maker,
+    close_database_runner,
+    get_database_runner,
+)
+from chapter14.complete.encoding import ImageEncoding
+from chapter14.complete.models import Base, GeneratedImage
+from chapter14.complete.progress import (
+    MemoryProgressChannel,
+    ProgressChannel,
+    ProgressReporter,
+    RedisProgressChannel,
+)
+from chapter14.complete.responses import RangeFileResponse
+from chapter14.complete.scheduling import (
+    MemoryJobScheduler,
+    ScheduledJob,
+    get_priority,
+)
+from chapter14.complete.settings import ImageFormat
+from chapter14.complete.storage import FileSystemStorage, MinioStorage
+from chapter14.complete.text_to_image import TextToImage as CompleteTextToImage
+
+memory_progress_channel = MemoryProgressChannel()
+memory_job_scheduler = MemoryJobScheduler()
+
+
+def test_chapter14_benchmark_progress_updates(tmp_path: Path):
+    results = benchmark(f"sqlite+aiosqlite:///{tmp_path / 'benchmark.db'}", 5)
+
+    assert set(results) == {"asyncio.run", "database runner", "progress reporter"}
+    assert all(duration > 0 for duration in results.values())
+
+
+def test_chapter14_database_runner_per_thread():
+    runner = get_database_runner()
+    assert get_database_runner() is runner
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        other_runner = executor.submit(get_database_runner).result()
+        executor.submit(close_database_runner).result()
+    assert other_runner is not runner
+    assert other_runner.loop.is_closed()
+
+    close_database_runner()
+    assert runner.loop.is_closed()
+    assert get_database_runner() is not runner
+    close_database_runner()
 
 
 def test_chapter14_basic_text_to_image():
@@ -22,6 +107,52 @@ def test_chapter14_basic_text_to_image():
     assert isinstance(image, Image.Image)
 
 
+@pytest.mark.parametrize("module", ["chapter14.basic.api", "chapter14.complete.api"])
+def test_chapter14_api_import_is_light(module: str, tmp_path: Path):
+    script = f"""
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{
+    "import_time": time.perf_counter() - start,
+    # ru_maxrss would include the RSS of the parent process at fork time
+    "max_rss_mb": next(
+        int(line.split()[1]) / 1024
+        for line in open("/proc/self/status")
+        if line.startswith("VmHWM:")
+    ),
+    "modules": [name for name in ("torch", "diffusers") if name in sys.modules],
+}}))
+"""
+    env = {
+        "DATABASE_URL": f"sqlite+aiosqlite:///{tmp_path / 'chapter14.db'}",
+        "STORAGE_ENDPOINT": "localhost:9000",
+        "STORAGE_ACCESS_KEY": "ACCESS_KEY",
+        "STORAGE_SECRET_KEY": "SECRET_KEY",
+        "STORAGE_BUCKET": "BUCKET",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=Path(__file__).parent.parent,
+        env=env,
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    metrics = json.loads(result.stdout)
+
+    # Importing torch alone takes seconds and hundreds of MB
+    assert metrics["modules"] == []
+    assert metrics["import_time"] < 3.0
+    assert metrics["max_rss_mb"] < 150
+
+
+def test_chapter14_api_keeps_worker_actor():
+    # Both the worker and the API are imported in this process
+    actor = complete_redis_broker.get_actor("text_to_image_task")
+    assert actor is complete_worker.text_to_image_task
+
+
 @pytest.mark.fastapi(app=chapter14_app)
 @pytest.mark.asyncio
 class TestChapter14BasicAPI:
@@ -41,18 +172,1112 @@ class TestChapter14BasicAPI:
         assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
     async def test_valid(self, client: httpx.AsyncClient):
-        message_mock = MagicMock(spec=Message)
-        message_mock.message_id = str(uuid.uuid4())
-
         with patch.object(
-            text_to_image_task, "send", return_value=message_mock
-        ) as send_mock:
+            redis_broker, "enqueue", side_effect=lambda message: message
+        ) as enqueue_mock:
             response = await client.post("/image-generation", json={"prompt": "PROMPT"})
 
             assert response.status_code == status.HTTP_202_ACCEPTED
             json = response.json()
-            assert json["task_id"] == message_mock.message_id
 
-            send_mock.assert_called_once_with(
-                "PROMPT", negative_prompt=None, num_steps=50
+            enqueue_mock.assert_called_once()
+            message: Message = enqueue_mock.call_args.args[0]
+            assert json["task_id"] == message.message_id
+            assert message.queue_name == "default"
+            assert message.actor_name == "text_to_image_task"
+            assert message.args == ("PROMPT",)
+            assert message.kwargs == {"negative_prompt": None, "num_steps": 50}
+
+
+def test_chapter14_prompt_embeds_cache():
+    text_to_image = CompleteTextToImage()
+    pipe = MagicMock()
+    pipe._encode_prompt.side_effect = lambda prompt, *args, **kwargs: torch.full(
+        (1, 77, 8), float(len(prompt))
+    )
+    pipe.return_value.images = [MagicMock(spec=Image.Image)]
+    text_to_image.pipe = pipe
+
+    for _ in range(2):
+        text_to_image.generate("PROMPT", negative_prompt="NEGATIVE", seed=42)
+
+    # Prompt and negative prompt are only encoded once
+    assert [call.args[0] for call in pipe._encode_prompt.call_args_list] == [
+        "PROMPT",
+        "NEGATIVE",
+    ]
+    kwargs = pipe.call_args.kwargs
+    assert "prompt" not in kwargs
+    assert torch.equal(kwargs["prompt_embeds"], torch.full((1, 77, 8), 6.0))
+    assert torch.equal(kwargs["negative_prompt_embeds"], torch.full((1, 77, 8), 8.0))
+    assert [generator.initial_seed() for generator in kwargs["generator"]] == [42]
+    assert text_to_image.prompt_embeds_cache.stats()["hits"] == 2
+
+
+def test_chapter14_lru_cache():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    # "b" is the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "hits": 3, "misses": 1, "evictions": 1}
+
+
+def tiny_pipeline(directory: Path) -> StableDiffusionPipeline:
+    """Randomly initialized Stable Diffusion pipeline, generating 16x16 images"""
+    torch.manual_seed(0)
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1}
+    for character in "abcdefghijklmnopqrstuvwxyz":
+        vocab[character] = len(vocab)
+        vocab[f"{character}</w>"] = len(vocab)
+    (directory / "vocab.json").write_text(json.dumps(vocab))
+    (directory / "merges.txt").write_text("#version: 0.2\n")
+    pipe = StableDiffusionPipeline(
+        vae=AutoencoderKL(
+            block_out_channels=(8, 8),
+            down_block_types=("DownEncoderBlock2D",) * 2,
+            up_block_types=("UpDecoderBlock2D",) * 2,
+            latent_channels=4,
+            norm_num_groups=4,
+            sample_size=16,
+        ),
+        text_encoder=CLIPTextModel(
+            CLIPTextConfig(
+                vocab_size=len(vocab),
+                hidden_size=8,
+                intermediate_size=16,
+                num_hidden_layers=1,
+                num_attention_heads=2,
+                max_position_embeddings=16,
+                bos_token_id=0,
+                eos_token_id=1,
+                pad_token_id=1,
+            )
+        ),
+        tokenizer=CLIPTokenizer(
+            str(directory / "vocab.json"),
+            str(directory / "merges.txt"),
+            model_max_length=16,
+        ),
+        unet=UNet2DConditionModel(
+            sample_size=8,
+            layers_per_block=1,
+            block_out_channels=(8, 16),
+            down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+            up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+            cross_attention_dim=8,
+            attention_head_dim=2,
+            norm_num_groups=4,
+        ),
+        scheduler=DDIMScheduler(clip_sample=False, steps_offset=1),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+@pytest.fixture
+def tiny_text_to_image(tmp_path: Path) -> CompleteTextToImage:
+    text_to_image = CompleteTextToImage()
+    text_to_image.pipe = tiny_pipeline(tmp_path)
+    return text_to_image
+
+
+def test_chapter14_generate_batch(tiny_text_to_image: CompleteTextToImage):
+    images = tiny_text_to_image.generate_batch(
+        ["a cat", "a dog", "a bird"],
+        negative_prompts=[None, "ugly", None],
+        num_steps=2,
+        seeds=[1, 2, 3],
+    )
+    assert len(images) == 3
+    assert all(image.size == (16, 16) for image in images)
+
+    # A seeded image is the same whether it's generated alone or in a batch
+    image = tiny_text_to_image.generate(
+        "a dog", negative_prompt="ugly", num_steps=2, seed=2
+    )
+    difference = np.abs(
+        np.asarray(image, dtype=np.int16) - np.asarray(images[1], dtype=np.int16)
+    )
+    assert difference.max() <= 1
+
+
+class TestChapter14DiffusionBatcher:
+    def generate_concurrently(
+        self, batcher: DiffusionBatcher, jobs: list[dict[str, Any]]
+    ) -> list[Image.Image]:
+        with concurrent.futures.ThreadPoolExecutor(len(jobs)) as executor:
+            futures = [executor.submit(batcher.generate, **job) for job in jobs]
+            return [future.result() for future in futures]
+
+    def test_coalesce_jobs(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image, max_batch_size=3, max_wait=5)
+        steps: dict[str, list[int]] = {"a cat": [], "a dog": [], "a bird": []}
+        batcher.start()
+        with patch.object(
+            tiny_text_to_image,
+            "generate_batch",
+            wraps=tiny_text_to_image.generate_batch,
+        ) as generate_batch_mock:
+            images = self.generate_concurrently(
+                batcher,
+                [
+                    {
+                        "prompt": prompt,
+                        "num_steps": 2,
+                        "seed": 1,
+                        "callback": lambda step, *_, prompt=prompt: steps[
+                            prompt
+                        ].append(step),
+                    }
+                    for prompt in steps
+                ],
+            )
+        batcher.stop()
+
+        # The batch is full before `max_wait`: a single pipeline call
+        generate_batch_mock.assert_called_once()
+        assert len(generate_batch_mock.call_args.args[0]) == 3
+        assert len(images) == 3
+        assert steps == {"a cat": [0, 1], "a dog": [0, 1], "a bird": [0, 1]}
+
+    def test_separate_num_steps(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image, max_batch_size=4, max_wait=0.2)
+        batcher.start()
+        with patch.object(
+            tiny_text_to_image,
+            "generate_batch",
+            wraps=tiny_text_to_image.generate_batch,
+        ) as generate_batch_mock:
+            self.generate_concurrently(
+                batcher,
+                [
+                    {"prompt": "a cat", "num_steps": 2},
+                    {"prompt": "a dog", "num_steps": 3},
+                    {"prompt": "a bird", "num_steps": 2},
+                ],
+            )
+        batcher.stop()
+
+        assert sorted(
+            (call.kwargs["num_steps"], len(call.args[0]))
+            for call in generate_batch_mock.call_args_list
+        ) == [(2, 2), (3, 1)]
+
+    def test_callback_error(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image, max_batch_size=2, max_wait=5)
+
+        def failing_callback(*_):
+            raise ValueError("Callback error")
+
+        batcher.start()
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            failing = executor.submit(
+                batcher.generate, "a cat", num_steps=2, callback=failing_callback
+            )
+            succeeding = executor.submit(batcher.generate, "a dog", num_steps=2)
+            # Only the job of the failing callback fails
+            with pytest.raises(ValueError):
+                failing.result()
+            assert succeeding.result().size == (16, 16)
+        batcher.stop()
+
+    def test_abort_when_all_jobs_failed(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image, max_batch_size=1)
+        steps: list[int] = []
+
+        def cancelling_callback(step: int, *_):
+            steps.append(step)
+            raise ValueError("Cancelled")
+
+        batcher.start()
+        # Fails with its own error, and the pipeline stops after the first step
+        with pytest.raises(ValueError):
+            batcher.generate("a cat", num_steps=10, callback=cancelling_callback)
+        assert steps == [0]
+        batcher.stop()
+
+    def cancel_batched_jobs(
+        self, batcher: DiffusionBatcher, cancel_steps: list[int | None]
+    ) -> list[Image.Image | JobCancelled]:
+        def cancelling_callback(cancel_step: int | None):
+            def callback(step: int, *_):
+                if step == cancel_step:
+                    raise JobCancelled()
+
+            return callback
+
+        batcher.start()
+        with concurrent.futures.ThreadPoolExecutor(len(cancel_steps)) as executor:
+            futures = [
+                executor.submit(
+                    batcher.generate,
+                    "a cat",
+                    num_steps=5,
+                    callback=cancelling_callback(cancel_step),
+                )
+                for cancel_step in cancel_steps
+            ]
+            concurrent.futures.wait(futures)
+        batcher.stop()
+        return [future.exception() or future.result() for future in futures]
+
+    def test_cancel_with_live_job(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image, max_batch_size=2, max_wait=5)
+        cancelled, live = self.cancel_batched_jobs(batcher, [1, None])
+
+        assert isinstance(live, Image.Image)
+        # The pipeline kept running the cancelled latent for the live job
+        assert isinstance(cancelled, JobCancelled)
+        assert cancelled.saved_steps == 0
+        assert cancelled.discarded_steps == 3
+
+    def test_cancel_all_jobs(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image, max_batch_size=2, max_wait=5)
+        first, second = self.cancel_batched_jobs(batcher, [1, 2])
+
+        # The pipeline stopped after the third step
+        assert isinstance(first, JobCancelled)
+        assert (first.saved_steps, first.discarded_steps) == (2, 1)
+        assert isinstance(second, JobCancelled)
+        assert (second.saved_steps, second.discarded_steps) == (2, 0)
+
+    def test_run_in_caller(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image, max_wait=0)
+        callback_threads: set[int] = set()
+        caller_calls: list[tuple[int, int]] = []
+
+        def callback(step: int, *_):
+            callback_threads.add(threading.get_ident())
+            batcher.run_in_caller(
+                lambda: caller_calls.append((step, threading.get_ident()))
+            )
+
+        batcher.start()
+        batcher.generate("a cat", num_steps=3, callback=callback)
+        batcher.stop()
+
+        # Run in order by the thread waiting for the job
+        assert callback_threads != {threading.get_ident()}
+        assert caller_calls == [(step, threading.get_ident()) for step in range(3)]
+
+        with pytest.raises(RuntimeError):
+            batcher.run_in_caller(lambda: None)
+
+    def test_not_started(self, tiny_text_to_image: CompleteTextToImage):
+        batcher = DiffusionBatcher(tiny_text_to_image)
+        with pytest.raises(RuntimeError):
+            batcher.generate("a cat")
+
+
+def test_chapter14_storage_bucket_exists_cache():
+    client = MagicMock(spec=Minio)
+    client.bucket_exists.return_value = False
+    storage = MinioStorage(client=client)
+
+    for _ in range(3):
+        storage.upload_image(Image.new("RGB", (8, 8)), "bucket")
+
+    client.bucket_exists.assert_called_once_with("bucket")
+    client.make_bucket.assert_called_once_with("bucket")
+    # Images and their thumbnails
+    assert client.put_object.call_count == 6
+    storage.close()
+
+
+@pytest.mark.parametrize(
+    "format,content_type",
+    [("PNG", "image/png"), ("WEBP", "image/webp"), ("JPEG", "image/jpeg")],
+)
+def test_chapter14_image_encoding(format: ImageFormat, content_type: str):
+    encoding = ImageEncoding(format, thumbnail_size=64)
+    image = Image.new("RGB", (512, 256), "red")
+
+    data, length = encoding.encode(image)
+    assert data.tell() == 0
+    assert length == len(data.getbuffer())
+    assert Image.open(data).format == format
+    assert encoding.content_type == content_type
+
+    thumbnail = encoding.thumbnail(image)
+    assert thumbnail is not None and thumbnail.size == (64, 32)
+    assert encoding.thumbnail(Image.new("RGB", (32, 32))) is not None
+    assert ImageEncoding(format, thumbnail_size=None).thumbnail(image) is None
+
+
+class TestChapter14StorageUpload:
+    def get_storage(self, **kwargs) -> tuple[MinioStorage, MagicMock, dict[str, bytes]]:
+        client = MagicMock(spec=Minio)
+        client.bucket_exists.return_value = True
+        uploads: dict[str, bytes] = {}
+
+        def put_object(bucket_name, object_name, data, length, **kwargs):
+            uploads[object_name] = data.read()
+            assert length in (-1, len(uploads[object_name]))
+
+        client.put_object.side_effect = put_object
+        storage = MinioStorage(
+            client=client,
+            encoding=ImageEncoding("WEBP", thumbnail_size=32),
+            **kwargs,
+        )
+        return storage, client, uploads
+
+    def test_upload(self):
+        storage, client, uploads = self.get_storage()
+        object_name = storage.upload_image(Image.new("RGB", (128, 128)), "bucket")
+
+        assert object_name.endswith(".webp")
+        assert Image.open(io.BytesIO(uploads[object_name])).size == (128, 128)
+        thumbnail = Image.open(io.BytesIO(uploads[f"thumbnails/{object_name}"]))
+        assert thumbnail.size == (32, 32)
+        for call in client.put_object.call_args_list:
+            assert call.kwargs["content_type"] == "image/webp"
+            assert call.kwargs["length"] > 0
+
+    def test_upload_streaming(self):
+        storage, client, uploads = self.get_storage(
+            multipart_threshold=0, part_size=5 * 1024 * 1024
+        )
+        object_name = storage.upload_image(Image.new("RGB", (128, 128)), "bucket")
+
+        # Encoded while being uploaded, in parts of unknown total length
+        call = client.put_object.call_args_list[0]
+        assert call.kwargs["length"] == -1
+        assert call.kwargs["part_size"] == 5 * 1024 * 1024
+        assert Image.open(io.BytesIO(uploads[object_name])).size == (128, 128)
+        assert f"thumbnails/{object_name}" in uploads
+
+    def test_upload_streaming_encoding_error(self):
+        storage, client, _ = self.get_storage(multipart_threshold=0)
+        with patch.object(storage.encoding, "write", side_effect=OSError()):
+            with pytest.raises(OSError):
+                storage.upload_image(Image.new("RGB", (128, 128)), "bucket")
+        object_name = client.put_object.call_args.args[1]
+        client.remove_object.assert_called_once_with("bucket", object_name)
+
+
+def test_chapter14_storage_presigned_url_cache():
+    client = MagicMock(spec=Minio)
+    client.presigned_get_object.side_effect = lambda bucket, name, **kwargs: str(
+        uuid.uuid4()
+    )
+    storage = MinioStorage(client=client, presigned_url_margin=timedelta(seconds=60))
+
+    url = storage.get_presigned_url("image.png", "bucket")
+    assert storage.get_presigned_url("image.png", "bucket") == url
+    assert storage.get_presigned_url("other.png", "bucket") != url
+    assert client.presigned_get_object.call_count == 2
+
+    # Not reused within the margin before expiry
+    now = time.monotonic()
+    with patch.object(time, "monotonic", return_value=now + 7 * 86400 - 30):
+        assert storage.get_presigned_url("image.png", "bucket") != url
+
+    # Never cached when expiring within the margin
+    expires = timedelta(seconds=30)
+    url = storage.get_presigned_url("image.png", "bucket", expires=expires)
+    assert storage.get_presigned_url("image.png", "bucket", expires=expires) != url
+    storage.close()
+
+
+def test_chapter14_filesystem_storage(tmp_path: Path):
+    storage = FileSystemStorage(tmp_path, encoding=ImageEncoding("PNG"))
+    image = Image.new("RGB", (512, 512), "red")
+
+    object_name = storage.upload_image(image, "bucket")
+    path = storage.get_path(object_name, "bucket")
+    # Named after its content
+    assert object_name == f"{hashlib.sha256(path.read_bytes()).hexdigest()}.png"
+    thumbnail_path = storage.get_path(f"thumbnails/{object_name}", "bucket")
+    assert Image.open(thumbnail_path).size == (256, 256)
+
+    # Same content, same file, and no temporary file left behind
+    assert storage.upload_image(image, "bucket") == object_name
+    assert sorted(p.name for p in (tmp_path / "bucket").iterdir()) == [
+        object_name,
+        "thumbnails",
+    ]
+    assert storage.get_url(object_name, "bucket") == f"/files/bucket/{object_name}"
+
+    with pytest.raises(ValueError):
+        storage.get_path("../../etc/passwd", "bucket")
+
+
+@pytest.mark.asyncio
+async def test_chapter14_range_file_response_zerocopysend(tmp_path: Path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(bytes(range(100)))
+    response = RangeFileResponse(
+        path,
+        request_headers=Headers({"range": "bytes=10-19"}),
+        stat_result=os.stat(path),
+    )
+    messages: list[dict[str, Any]] = []
+
+    async def send(message):
+        if message["type"] == "http.response.zerocopysend":
+            file = message["file"]
+            file.seek(message["offset"])
+            message = {**message, "body": file.read(message["count"])}
+        messages.append(message)
+
+    scope = {"type": "http", "extensions": {"http.response.zerocopysend": {}}}
+    await response(scope, MagicMock(), send)
+
+    assert messages[0]["status"] == status.HTTP_206_PARTIAL_CONTENT
+    assert messages[1]["type"] == "http.response.zerocopysend"
+    assert messages[1]["body"] == bytes(range(10, 20))
+
+
+class TestChapter14JobScheduler:
+    def test_priority(self):
+        scheduler = MemoryJobScheduler()
+        scheduler.enqueue(ScheduledJob(1, "low", "a"))
+        scheduler.enqueue(ScheduledJob(2, "normal", "a"))
+        scheduler.enqueue(ScheduledJob(3, "high", "a"))
+        scheduler.enqueue(ScheduledJob(4, "normal", "a"))
+
+        jobs = [scheduler.dequeue() for _ in range(5)]
+        assert [job.image_id if job else None for job in jobs] == [3, 2, 4, 1, None]
+
+    def test_fair_share(self):
+        scheduler = MemoryJobScheduler()
+        for image_id in range(1, 101):
+            scheduler.enqueue(ScheduledJob(image_id, "normal", "bulk"))
+        scheduler.enqueue(ScheduledJob(101, "normal", "a"))
+        scheduler.enqueue(ScheduledJob(102, "normal", "a"))
+        scheduler.enqueue(ScheduledJob(103, "normal", "b"))
+
+        jobs = [scheduler.dequeue() for _ in range(6)]
+        # Tenants take turns, each one in submission order
+        assert [(job.tenant, job.image_id) for job in jobs if job] == [
+            ("bulk", 1),
+            ("a", 101),
+            ("b", 103),
+            ("bulk", 2),
+            ("a", 102),
+            ("bulk", 3),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_stats(self):
+        scheduler = MemoryJobScheduler()
+        scheduler.enqueue(ScheduledJob(1, "normal", "a", enqueued_at=time.time() - 10))
+        scheduler.enqueue(ScheduledJob(2, "normal", "a", enqueued_at=time.time() - 5))
+        scheduler.enqueue(ScheduledJob(3, "high", "a"))
+
+        stats = await scheduler.stats()
+        assert stats["normal"]["depth"] == 2
+        assert stats["normal"]["oldest_wait"] == pytest.approx(10, abs=1)
+        assert stats["low"] == {
+            "depth": 0,
+            "oldest_wait": 0.0,
+            "dequeued": 0,
+            "average_wait": 0.0,
+            "cancelled": 0,
+            "saved_steps": 0,
+            "discarded_steps": 0,
+        }
+
+        scheduler.dequeue()
+        scheduler.dequeue()
+        stats = await scheduler.stats()
+        assert stats["high"]["dequeued"] == 1
+        assert stats["normal"]["dequeued"] == 1
+        assert stats["normal"]["average_wait"] == pytest.approx(10, abs=1)
+        assert stats["normal"]["oldest_wait"] == pytest.approx(5, abs=1)
+
+    def test_get_priority(self):
+        assert get_priority(5) == "high"
+        assert get_priority(50) == "normal"
+        assert get_priority(5, "low") == "low"
+
+
+class TestChapter14WorkerScheduling:
+    def test_run_next_job(self):
+        scheduler = MemoryJobScheduler()
+        scheduler.enqueue(ScheduledJob(1, "normal", "a"))
+        scheduler.enqueue(ScheduledJob(2, "high", "a"))
+        with patch.object(complete_worker, "job_scheduler", scheduler), patch.object(
+            complete_worker, "generate_image"
+        ) as generate_image_mock:
+            for _ in range(3):
+                complete_worker.text_to_image_task()
+
+        assert [call.args for call in generate_image_mock.call_args_list] == [
+            (2,),
+            (1,),
+        ]
+
+    def test_reschedule_failed_job(self):
+        scheduler = MemoryJobScheduler()
+        scheduler.enqueue(ScheduledJob(1, "normal", "a"))
+        with patch.object(complete_worker, "job_scheduler", scheduler), patch.object(
+            complete_worker, "generate_image", side_effect=ValueError()
+        ) as generate_image_mock:
+            for _ in range(4):
+                with contextlib.suppress(ValueError):
+                    complete_worker.text_to_image_task()
+
+        # Given up after the maximum number of attempts
+        assert generate_image_mock.call_count == 3
+        assert scheduler.dequeue() is None
+
+
+class TestChapter14WorkerCancellation:
+    def create_image(self, **kwargs) -> int:
+        database = get_database_runner()
+
+        async def _create_image() -> int:
+            async with database.engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            async with database.session_maker() as session:
+                image = GeneratedImage(prompt="a cat", num_steps=5, **kwargs)
+                session.add(image)
+                await session.commit()
+                return image.id
+
+        return database.run(_create_image())
+
+    def run_task(
+        self,
+        image_id: int,
+        text_to_image: CompleteTextToImage,
+        progress_channel: ProgressChannel,
+    ) -> MemoryJobScheduler:
+        scheduler = MemoryJobScheduler()
+        scheduler.enqueue(ScheduledJob(image_id, "normal", "a"))
+        batcher = DiffusionBatcher(text_to_image, max_wait=0)
+        batcher.start()
+        with patch.object(complete_worker, "job_scheduler", scheduler), patch.object(
+            complete_worker, "progress_channel", progress_channel
+        ), patch.object(complete_worker.text_to_image_middleware, "batcher", batcher):
+            complete_worker.text_to_image_task()
+        batcher.stop()
+        return scheduler
+
+    def test_skip_cancelled(self, tiny_text_to_image: CompleteTextToImage):
+        image_id = self.create_image(cancelled_at=datetime.now())
+        with patch.object(tiny_text_to_image, "generate_batch") as generate_batch_mock:
+            scheduler = self.run_task(
+                image_id, tiny_text_to_image, MemoryProgressChannel()
+            )
+
+        generate_batch_mock.assert_not_called()
+        stats = asyncio.run(scheduler.stats())["normal"]
+        assert stats["cancelled"] == 1
+        assert stats["saved_steps"] == 5
+
+    def test_abort_running(self, tiny_text_to_image: CompleteTextToImage):
+        image_id = self.create_image()
+        progress_channel = MagicMock(spec=ProgressChannel)
+        # Cancelled during the second step
+        progress_channel.is_cancelled.side_effect = [False, True]
+        pipe_scheduler = tiny_text_to_image.pipe.scheduler
+        with patch.object(
+            pipe_scheduler, "step", wraps=pipe_scheduler.step
+        ) as step_mock:
+            scheduler = self.run_task(image_id, tiny_text_to_image, progress_channel)
+
+        assert step_mock.call_count == 2
+        stats = asyncio.run(scheduler.stats())["normal"]
+        assert stats["cancelled"] == 1
+        assert stats["saved_steps"] == 3
+        assert stats["discarded_steps"] == 0
+        # Not retried
+        assert scheduler.dequeue() is None
+
+
+class RecordingProgressChannel(MemoryProgressChannel):
+    def __init__(self) -> None:
+        super().__init__()
+        self.published: list[int] = []
+
+    def publish(
+        self, image_id: int, progress: int, *, file_name: str | None = None
+    ) -> None:
+        self.published.append(progress)
+
+
+class TestChapter14ProgressReporter:
+    def test_coalesce_by_delta(self):
+        channel = RecordingProgressChannel()
+        persisted: list[int] = []
+        progress_reporter = ProgressReporter(
+            1, 50, channel=channel, persist=persisted.append, min_interval=60
+        )
+
+        for step in range(50):
+            progress_reporter.report(step + 1)
+        progress_reporter.complete("image.png")
+
+        assert channel.published == [10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 100]
+        assert persisted == [26, 52, 78]
+
+    def test_coalesce_by_time(self):
+        channel = RecordingProgressChannel()
+        progress_reporter = ProgressReporter(
+            1,
+            50,
+            channel=channel,
+            persist=lambda _: None,
+            min_interval=0,
+            min_delta=100,
+        )
+
+        for step in range(5):
+            progress_reporter.report(step + 1)
+
+        assert channel.published == [2, 4, 6, 8, 10]
+
+
+@pytest.mark.asyncio
+class TestChapter14RedisProgressChannel:
+    async def test_unsubscribe_on_cancel(self):
+        messages: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+
+        async def get_message(**kwargs) -> dict[str, Any]:
+            return await messages.get()
+
+        pubsub = AsyncMock()
+        pubsub.get_message.side_effect = get_message
+        channel = RedisProgressChannel("redis://localhost:6379")
+
+        async def get_progress(cancel: bool) -> int | None:
+            async with channel.subscribe(1) as subscription:
+                if cancel:
+                    await asyncio.sleep(60)
+                event = await subscription.get()
+                return event.progress if event else None
+
+        with patch.object(redis.asyncio.Redis, "pubsub", return_value=pubsub):
+            cancelled = asyncio.create_task(get_progress(True))
+            live = asyncio.create_task(get_progress(False))
+            await asyncio.sleep(0.01)
+            # A single subscription for both subscribers
+            pubsub.subscribe.assert_awaited_once_with("generated-images:1:events")
+
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            assert len(channel._subscribers["generated-images:1:events"]) == 1
+            pubsub.unsubscribe.assert_not_awaited()
+
+            await messages.put(
+                {
+                    "type": "message",
+                    "channel": b"generated-images:1:events",
+                    "data": b'{"progress": 50}',
+                }
+            )
+            assert await live == 50
+            assert channel._subscribers == {}
+            pubsub.unsubscribe.assert_awaited_once_with("generated-images:1:events")
+            await channel.disconnect()
+
+
+@pytest.mark.fastapi(
+    app=chapter14_complete_app,
+    dependency_overrides={
+        get_progress_channel: lambda: memory_progress_channel,
+        get_job_scheduler: lambda: memory_job_scheduler,
+    },
+)
+@pytest.mark.asyncio
+class TestChapter14CompleteAPI:
+    async def test_live_progress(self, client: httpx.AsyncClient):
+        with patch.object(complete_redis_broker, "enqueue") as enqueue_mock:
+            response = await client.post(
+                "/generated-images", json={"prompt": "PROMPT", "num_steps": 10}
+            )
+            assert response.status_code == status.HTTP_201_CREATED
+            id = response.json()["id"]
+            # A token: the worker runs the next scheduled job
+            enqueue_mock.assert_called_once()
+            message: Message = enqueue_mock.call_args.args[0]
+            assert message.actor_name == "text_to_image_task"
+            assert message.args == ()
+
+        response = await client.get(f"/generated-images/{id}")
+        assert response.json()["progress"] == 0
+
+        memory_progress_channel.publish(id, 40)
+        response = await client.get(f"/generated-images/{id}")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["progress"] == 40
+
+    async def test_not_found(self, client: httpx.AsyncClient):
+        response = await client.get("/generated-images/0")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        response = await client.get("/generated-images/0/events")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        response = await client.get("/generated-images/0/progress")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    async def test_events(self, client: httpx.AsyncClient):
+        id = await self.create_generated_image(client)
+
+        async def publish():
+            await asyncio.sleep(0.05)
+            memory_progress_channel.publish(id, 50)
+            memory_progress_channel.publish(id, 100, file_name="image.png")
+
+        publish_task = asyncio.create_task(publish())
+        async with client.stream("GET", f"/generated-images/{id}/events") as response:
+            assert response.status_code == status.HTTP_200_OK
+            assert response.headers["content-type"].startswith("text/event-stream")
+            events = [
+                json.loads(line.removeprefix("data: "))
+                async for line in response.aiter_lines()
+                if line.startswith("data: ")
+            ]
+        await publish_task
+
+        assert events == [
+            {"progress": 0, "file_name": None, "cancelled": False},
+            {"progress": 50, "file_name": None, "cancelled": False},
+            {"progress": 100, "file_name": "image.png", "cancelled": False},
+        ]
+
+    async def test_long_poll(self, client: httpx.AsyncClient):
+        id = await self.create_generated_image(client)
+
+        response = await client.get(f"/generated-images/{id}/progress")
+        assert response.json() == {"progress": 0, "file_name": None, "cancelled": False}
+
+        async def publish():
+            await asyncio.sleep(0.05)
+            memory_progress_channel.publish(id, 20)
+
+        publish_task = asyncio.create_task(publish())
+        response = await client.get(
+            f"/generated-images/{id}/progress", params={"after": 0}
+        )
+        await publish_task
+        assert response.json() == {
+            "progress": 20,
+            "file_name": None,
+            "cancelled": False,
+        }
+
+    async def test_long_poll_timeout(self, client: httpx.AsyncClient):
+        id = await self.create_generated_image(client)
+
+        response = await client.get(
+            f"/generated-images/{id}/progress", params={"after": 0, "timeout": 0.05}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"progress": 0, "file_name": None, "cancelled": False}
+
+    async def test_deduplicate_deterministic_requests(self, client: httpx.AsyncClient):
+        payload = {"prompt": "DEDUPLICATE", "num_steps": 10, "seed": 42}
+        with patch.object(complete_redis_broker, "enqueue") as enqueue_mock:
+            response = await client.post("/generated-images", json=payload)
+            assert response.status_code == status.HTTP_201_CREATED
+            id = response.json()["id"]
+
+            response = await client.post("/generated-images", json=payload)
+            assert response.status_code == status.HTTP_200_OK
+            assert response.json()["id"] == id
+
+            response = await client.post(
+                "/generated-images", json={**payload, "seed": 43}
+            )
+            assert response.status_code == status.HTTP_201_CREATED
+            assert response.json()["id"] != id
+
+            assert enqueue_mock.call_count == 2
+
+    async def test_no_deduplication_without_seed(self, client: httpx.AsyncClient):
+        payload = {"prompt": "RANDOM", "num_steps": 10}
+        with patch.object(complete_redis_broker, "enqueue") as enqueue_mock:
+            first_response = await client.post("/generated-images", json=payload)
+            second_response = await client.post("/generated-images", json=payload)
+
+            assert first_response.status_code == status.HTTP_201_CREATED
+            assert second_response.status_code == status.HTTP_201_CREATED
+            assert first_response.json()["id"] != second_response.json()["id"]
+            assert enqueue_mock.call_count == 2
+
+    async def test_url_shared_storage(self, client: httpx.AsyncClient):
+        id = await self.create_generated_image(client)
+        async with async_session_maker() as session:
+            image = await session.get(GeneratedImage, id)
+            assert image is not None
+            image.file_name = "image.png"
+            await session.commit()
+
+        storage = chapter14_complete_app.state.storage
+        with patch.object(
+            storage.client, "presigned_get_object", return_value="URL"
+        ) as presigned_get_object_mock:
+            for _ in range(2):
+                response = await client.get(f"/generated-images/{id}/url")
+                assert response.status_code == status.HTTP_200_OK
+                assert response.json() == {"url": "URL", "thumbnail_url": "URL"}
+
+        # The same storage, and its URL cache, is used across requests
+        assert [call.args[1] for call in presigned_get_object_mock.call_args_list] == [
+            "image.png",
+            "thumbnails/image.png",
+        ]
+
+    async def test_minio_no_files(self, client: httpx.AsyncClient):
+        response = await client.get("/files/chapter14/image.png")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    async def test_schedule(self, client: httpx.AsyncClient):
+        while memory_job_scheduler.dequeue() is not None:
+            pass
+
+        with patch.object(complete_redis_broker, "enqueue"):
+            for payload in [
+                {"prompt": "BULK", "num_steps": 50, "tenant": "bulk"},
+                {"prompt": "BULK", "num_steps": 50, "tenant": "bulk"},
+                {"prompt": "OTHER", "num_steps": 50, "tenant": "other"},
+                {"prompt": "PREVIEW", "num_steps": 5, "tenant": "other"},
+                {"prompt": "LOW", "num_steps": 5, "priority": "low"},
+            ]:
+                response = await client.post("/generated-images", json=payload)
+                assert response.status_code == status.HTTP_201_CREATED
+
+        json = response.json()
+        assert json["priority"] == "low"
+        assert json["tenant"] == "default"
+
+        response = await client.get("/queue/stats")
+        assert response.status_code == status.HTTP_200_OK
+        stats = response.json()
+        assert [stats[priority]["depth"] for priority in ("high", "normal", "low")] == [
+            1,
+            3,
+            1,
+        ]
+
+        jobs = []
+        while (job := memory_job_scheduler.dequeue()) is not None:
+            jobs.append((job.priority, job.tenant))
+        assert jobs == [
+            ("high", "other"),
+            ("normal", "bulk"),
+            ("normal", "other"),
+            ("normal", "bulk"),
+            ("low", "default"),
+        ]
+
+    async def test_invalid_tenant(self, client: httpx.AsyncClient):
+        response = await client.post(
+            "/generated-images", json={"prompt": "PROMPT", "tenant": "a:b"}
+        )
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    async def test_cancel(self, client: httpx.AsyncClient):
+        id = await self.create_generated_image(client)
+
+        response = await client.delete(f"/generated-images/{id}")
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert memory_progress_channel.is_cancelled(id)
+
+        response = await client.get(f"/generated-images/{id}")
+        assert response.json()["cancelled"] is True
+
+        # Idempotent
+        response = await client.delete(f"/generated-images/{id}")
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+
+        response = await client.delete("/generated-images/0")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    async def test_cancel_deterministic_request(self, client: httpx.AsyncClient):
+        payload = {"prompt": "CANCEL", "num_steps": 10, "seed": 42}
+        with patch.object(complete_redis_broker, "enqueue") as enqueue_mock:
+            response = await client.post("/generated-images", json=payload)
+            id = response.json()["id"]
+
+            response = await client.delete(f"/generated-images/{id}")
+            assert response.status_code == status.HTTP_204_NO_CONTENT
+
+            # Generated again, not the cancelled image
+            response = await client.post("/generated-images", json=payload)
+            assert response.status_code == status.HTTP_201_CREATED
+            json = response.json()
+            assert json["id"] != id
+            assert json["cancelled"] is False
+            assert enqueue_mock.call_count == 2
+
+            # Deduplicated with the new one
+            response = await client.post("/generated-images", json=payload)
+            assert response.status_code == status.HTTP_200_OK
+            assert response.json()["id"] == json["id"]
+
+    async def test_cancel_generated(self, client: httpx.AsyncClient):
+        id = await self.create_generated_image(client)
+        async with async_session_maker() as session:
+            image = await session.get(GeneratedImage, id)
+            assert image is not None
+            image.file_name = "image.png"
+            await session.commit()
+
+        response = await client.delete(f"/generated-images/{id}")
+        assert response.status_code == status.HTTP_409_CONFLICT
+
+    async def test_cancel_events(self, client: httpx.AsyncClient):
+        id = await self.create_generated_image(client)
+
+        async def cancel():
+            await asyncio.sleep(0.05)
+            memory_progress_channel.publish(id, 20)
+            response = await client.delete(f"/generated-images/{id}")
+            assert response.status_code == status.HTTP_204_NO_CONTENT
+
+        cancel_task = asyncio.create_task(cancel())
+        async with client.stream("GET", f"/generated-images/{id}/events") as response:
+            events = [
+                json.loads(line.removeprefix("data: "))
+                async for line in response.aiter_lines()
+                if line.startswith("data: ")
+            ]
+        await cancel_task
+
+        # The stream ends with the cancellation
+        assert events[-1] == {"progress": 20, "file_name": None, "cancelled": True}
+
+        response = await client.get(f"/generated-images/{id}/progress?after=20")
+        assert response.json()["cancelled"] is True
+
+    async def create_generated_image(self, client: httpx.AsyncClient) -> int:
+        with patch.object(complete_redis_broker, "enqueue"):
+            response = await client.post(
+                "/generated-images", json={"prompt": "PROMPT", "num_steps": 10}
+            )
+        return response.json()["id"]
+
+
+filesystem_storage = FileSystemStorage(Path(tempfile.mkdtemp()))
+
+
+@pytest.mark.fastapi(
+    app=chapter14_complete_app,
+    dependency_overrides={
+        get_progress_channel: lambda: memory_progress_channel,
+        get_job_scheduler: lambda: memory_job_scheduler,
+        get_storage: lambda: filesystem_storage,
+    },
+)
+@pytest.mark.asyncio
+class TestChapter14FileSystemStorageAPI:
+    async def test_url(self, client: httpx.AsyncClient):
+        object_name = await self.create_generated_image(client)
+
+        response = await client.get(f"/generated-images/{self.id}/url")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {
+            "url": f"/files/chapter14/{object_name}",
+            "thumbnail_url": f"/files/chapter14/thumbnails/{object_name}",
+        }
+
+        response = await client.get(response.json()["thumbnail_url"])
+        assert response.status_code == status.HTTP_200_OK
+        assert Image.open(io.BytesIO(response.content)).size == (256, 256)
+
+    async def test_get_file(self, client: httpx.AsyncClient):
+        object_name = await self.create_generated_image(client)
+        content = filesystem_storage.get_path(object_name, "chapter14").read_bytes()
+
+        response = await client.get(f"/files/chapter14/{object_name}")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.content == content
+        assert response.headers["content-type"] == "image/png"
+        assert response.headers["accept-ranges"] == "bytes"
+        assert "immutable" in response.headers["cache-control"]
+        etag = response.headers["etag"]
+
+        response = await client.get(
+            f"/files/chapter14/{object_name}", headers={"If-None-Match": etag}
+        )
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response.content == b""
+
+    @pytest.mark.parametrize(
+        "range_header,content_range,slice_",
+        [
+            ("bytes=0-9", "bytes 0-9/{size}", slice(0, 10)),
+            ("bytes=10-", "bytes 10-{last}/{size}", slice(10, None)),
+            ("bytes=-5", "bytes {start}-{last}/{size}", slice(-5, None)),
+            ("bytes=5-100000", "bytes 5-{last}/{size}", slice(5, None)),
+        ],
+    )
+    async def test_get_file_range(
+        self,
+        client: httpx.AsyncClient,
+        range_header: str,
+        content_range: str,
+        slice_: slice,
+    ):
+        object_name = await self.create_generated_image(client)
+        content = filesystem_storage.get_path(object_name, "chapter14").read_bytes()
+        size = len(content)
+
+        response = await client.get(
+            f"/files/chapter14/{object_name}", headers={"Range": range_header}
+        )
+        assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+        assert response.content == content[slice_]
+        assert response.headers["content-range"] == content_range.format(
+            size=size, last=size - 1, start=size - 5
+        )
+
+    async def test_get_file_range_not_satisfiable(self, client: httpx.AsyncClient):
+        object_name = await self.create_generated_image(client)
+        size = filesystem_storage.get_path(object_name, "chapter14").stat().st_size
+
+        response = await client.get(
+            f"/files/chapter14/{object_name}", headers={"Range": f"bytes={size}-"}
+        )
+        assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        assert response.headers["content-range"] == f"bytes */{size}"
+
+    async def test_get_file_stale_if_range(self, client: httpx.AsyncClient):
+        object_name = await self.create_generated_image(client)
+
+        response = await client.get(
+            f"/files/chapter14/{object_name}",
+            headers={"Range": "bytes=0-9", "If-Range": '"STALE"'},
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+    async def test_get_file_not_found(self, client: httpx.AsyncClient):
+        response = await client.get("/files/chapter14/unknown.png")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+        response = await client.get("/files/chapter14/thumbnails")
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+    async def create_generated_image(self, client: httpx.AsyncClient) -> str:
+        """Creates a generated image stored in the filesystem, returns its file name"""
+        with patch.object(complete_redis_broker, "enqueue"):
+            response = await client.post(
+                "/generated-images", json={"prompt": "PROMPT", "num_steps": 10}
             )
+        self.id = response.json()["id"]
+        object_name = filesystem_storage.upload_image(
+            Image.new("RGB", (512, 512), "blue"), "chapter14"
+        )
+        # Worker's job
+        async with async_session_maker() as session:
+            image = await session.get(GeneratedImage, self.id)
+            assert image is not None
+            image.file_name = object_name
+            await session.commit()
+        return object_name